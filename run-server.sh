@@ -1,3 +1,7 @@
 #!/bin/bash
 
-python3 src/server.py $@
+# e.g. ./run-server.sh --host 0.0.0.0 --port 8080 --workers 64 --queuesize 256
+# Blocks on three block servers, each block kept on two of them:
+#   ./run-server.sh --port 8091 & ./run-server.sh --port 8092 & ./run-server.sh --port 8093 &
+#   ./run-server.sh --port 8080 --replicas 2 --blockservers http://localhost:8091 http://localhost:8092 http://localhost:8093
+python3 src/server.py "$@"
@@ -0,0 +1,487 @@
+import argparse
+import hashlib
+import http.client
+import os
+import random
+import shutil
+import subprocess
+import threading
+import time
+
+import client
+from blockstore import MemoryBlockStore, DiskBlockStore, CachedBlockStore
+
+SLEEPTIME = 1
+URL = 'http://localhost:8080'
+
+def startServer(*args):
+	"""
+	Start `server.py` in a subprocess and wait for it to accept requests.
+	"""
+	proc = subprocess.Popen(['python', 'server.py', *args],
+		stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	time.sleep(SLEEPTIME)
+	return proc
+
+def stopServer(proc):
+	proc.terminate()
+	proc.wait()
+
+def makeDir(basedir):
+	if os.path.exists(basedir):
+		shutil.rmtree(basedir)
+	os.mkdir(basedir)
+
+def benchTransfer(args):
+	"""
+	Upload then download one large file at several parallelism levels and report MB/s.
+	"""
+	basedir = './bench/'
+	client.batchBytes = args.batchbytes
+	content = os.urandom(args.size)
+	mb = args.size / 1e6
+	for parallelism in args.parallelism:
+		proc = startServer()
+		try:
+			makeDir(basedir)
+			with open(basedir + 'big.dat', 'wb') as f:
+				f.write(content)
+			proxy = client.connect(URL)
+			pool = client.TransferPool(URL, parallelism)
+			hashlist = dict(client.scandir(basedir, args.blocksize))['big.dat']
+
+			t = time.perf_counter()
+			client.upload(proxy, 'big.dat', 1, hashlist, {}, basedir, args.blocksize, 0, pool)
+			tUp = time.perf_counter() - t
+
+			os.remove(basedir + 'big.dat')
+			t = time.perf_counter()
+			client.download(proxy, basedir, 'big.dat', hashlist, args.blocksize, pool)
+			tDown = time.perf_counter() - t
+			pool.shutdown()
+
+			with open(basedir + 'big.dat', 'rb') as f:
+				assert f.read() == content
+			print('parallelism={:<3d} upload {:8.1f} MB/s   download {:8.1f} MB/s'.format(
+				parallelism, mb / tUp, mb / tDown))
+		finally:
+			stopServer(proc)
+			shutil.rmtree(basedir)
+
+def benchScan(args):
+	"""
+	Hash a directory of files with several worker counts and report MB/s.
+	"""
+	basedir = './bench/'
+	makeDir(basedir)
+	try:
+		for i in range(args.files):
+			with open(basedir + 'f{}.dat'.format(i), 'wb') as f:
+				f.write(os.urandom(args.size // args.files))
+		mb = args.size / 1e6
+		for workers in args.workers:
+			client.hashWorkers = workers
+			t = time.perf_counter()
+			for _ in client.scandir(basedir, args.blocksize):
+				pass
+			print('workers={:<3d} scan {:8.1f} MB/s'.format(workers, mb / (time.perf_counter() - t)))
+	finally:
+		shutil.rmtree(basedir)
+
+def benchIndex(args):
+	"""
+	Save and load a local index of many files, in the text and binary formats, and save
+	it again after a few files changed; report the file size and times.
+	"""
+	basedir = './bench/'
+	makeDir(basedir)
+	rng = random.Random(0)
+	localIndex = {}
+	stats = {}
+	for i in range(args.files):
+		fname = 'f{}.dat'.format(i)
+		localIndex[fname] = [1, [hashlib.sha256(b'%d %d' % (i, j)).hexdigest() for j in range(args.blocks)]]
+		stats[fname] = (args.blocks * 4096, 1600000000000000000 + i, 1000000 + i, 'fixed-4096')
+	cursor = {'epoch': hashlib.md5(b'epoch').hexdigest(), 'seq': args.files, 'token': 0}
+	changed = rng.sample(sorted(localIndex), max(1, args.files // 100))
+	saved = client.indexFormat
+	try:
+		for fmt in ('text', 'binary'):
+			client.indexFormat = fmt
+			client.indexFiles.clear()
+			if os.path.exists(basedir + 'index.txt'):
+				os.unlink(basedir + 'index.txt')
+			t = time.perf_counter()
+			client.dumpLocalIndex(localIndex, basedir, stats, cursor)
+			save = time.perf_counter() - t
+			size = os.path.getsize(basedir + 'index.txt')
+			client.indexFiles.clear()
+			t = time.perf_counter()
+			loaded = client.parseIndexFile(basedir, {}, {})
+			load = time.perf_counter() - t
+			for fname in changed:
+				loaded[fname] = [2, loaded[fname][1][1:]]
+			t = time.perf_counter()
+			client.dumpLocalIndex(loaded, basedir, stats, cursor)
+			update = time.perf_counter() - t
+			print('{:<6s} {:8.1f} MB   save {:7.1f} ms   load {:7.1f} ms   save after {} changes {:7.1f} ms'.format(
+				fmt, size / 1e6, 1000 * save, 1000 * load, len(changed), 1000 * update))
+	finally:
+		client.indexFormat = saved
+		client.indexFiles.clear()
+		shutil.rmtree(basedir)
+
+def newBytes(old, new, blocksize):
+	"""
+	Bytes of `new` that are in blocks `old` does not have, i.e. what an upload would send.
+	"""
+	have = {old[o:o+n] for o, n in client.blockSpans(old, blocksize)}
+	sent = {new[o:o+n] for o, n in client.blockSpans(new, blocksize)} - have
+	return sum(map(len, sent))
+
+def benchChunking(args):
+	"""
+	Report the bytes re-uploaded after typical edits with fixed and content-defined blocks,
+	and what each costs to chunk and hash a file.
+	"""
+	content = os.urandom(args.size)
+	mid = args.size // 2
+	edits = {
+		'insert at start': b'x' + content,
+		'insert in middle': content[:mid] + b'x' * 10 + content[mid:],
+		'append': content + os.urandom(1000),
+		'modify in middle': content[:mid] + b'x' * 100 + content[mid+100:],
+		'delete in middle': content[:mid] + content[mid+100:],
+	}
+	for mode in ('fixed', 'cdc'):
+		client.chunking = mode
+		t = time.perf_counter()
+		for o, n in client.blockSpans(content, args.blocksize):
+			hashlib.sha256(content[o:o+n]).hexdigest()
+		print('{:<6s} chunk and hash {:8.1f} MB/s'.format(mode, len(content) / 1e6 / (time.perf_counter() - t)))
+		for edit, new in edits.items():
+			sent = newBytes(content, new, args.blocksize)
+			print('{:<6s} {:<17s} {:10d} bytes sent ({:5.1f}%)'.format(mode, edit, sent, 100 * sent / len(new)))
+
+def benchBlockstore(args):
+	"""
+	Put then get a set of blocks in each block store backend and report throughput.
+	"""
+	blocks = [os.urandom(args.blocksize) for _ in range(args.blocks)]
+	hashes = [hashlib.sha256(b).hexdigest() for b in blocks]
+	mb = args.blocks * args.blocksize / 1e6
+	backends = [('memory', lambda: MemoryBlockStore())]
+	for fsync in DiskBlockStore.FSYNC_POLICIES:
+		backends.append(('disk/fsync=' + fsync, lambda fsync=fsync: DiskBlockStore('./bench_blocks/', fsync)))
+	for name, make in backends:
+		shutil.rmtree('./bench_blocks/', ignore_errors=True)
+		store = make()
+		try:
+			t = time.perf_counter()
+			for h, b in zip(hashes, blocks):
+				store.put(h, b)
+			tPut = time.perf_counter() - t
+			t = time.perf_counter()
+			for h in hashes:
+				store.get(h)
+			tGet = time.perf_counter() - t
+			print('{:<18s} put {:8.1f} MB/s {:8.0f} ops/s   get {:8.1f} MB/s {:8.0f} ops/s'.format(
+				name, mb / tPut, args.blocks / tPut, mb / tGet, args.blocks / tGet))
+		finally:
+			shutil.rmtree('./bench_blocks/', ignore_errors=True)
+
+def benchCommit(args):
+	"""
+	Sync a directory of many small files, committing them in batches of several sizes,
+	and report files/s.
+	"""
+	basedir = './bench/'
+	for commitFiles in args.commitfiles:
+		client.commitFiles = commitFiles
+		proc = startServer('--metadir', './bench_meta/')
+		try:
+			makeDir(basedir)
+			for i in range(args.files):
+				with open(basedir + 'f{}.txt'.format(i), 'wb') as f:
+					f.write(os.urandom(args.size))
+			proxy = client.connect(URL)
+			t = time.perf_counter()
+			client.synchronize(proxy, basedir, 4096)
+			elapsed = time.perf_counter() - t
+			print('commitfiles={:<5d} {:8.0f} files/s'.format(commitFiles, args.files / elapsed))
+		finally:
+			stopServer(proc)
+			shutil.rmtree(basedir)
+			shutil.rmtree('./bench_meta/', ignore_errors=True)
+
+def benchRaft(args):
+	"""
+	Commit metadata updates from concurrent clients to a single metadata server and to
+	replicated clusters, and report updates/s and mean latency.
+	"""
+	for nodes in args.nodes:
+		urls = ['http://localhost:{}'.format(8081 + i) for i in range(nodes)]
+		procs = [startServer('--port', '8080')]
+		for url in urls:
+			peers = [peer for peer in urls if peer != url]
+			procs.append(startServer('--port', url[-4:], *(['--blockservers', URL, '--peers', *peers] if peers else [])))
+		try:
+			proxy = client.connect(urls[0])
+			proxy.surfstore.getfileinfomap()  # waits for a leader
+			latencies = []
+
+			def work(worker):
+				proxy = client.connect(urls[0])
+				for i in range(args.updates):
+					t = time.perf_counter()
+					proxy.surfstore.updatefile('w{}.txt'.format(worker), i + 1, [hashlib.sha256(b'%d' % i).hexdigest()])
+					latencies.append(time.perf_counter() - t)
+			workers = [threading.Thread(target=work, args=(i,)) for i in range(args.clients)]
+			t = time.perf_counter()
+			for w in workers:
+				w.start()
+			for w in workers:
+				w.join()
+			elapsed = time.perf_counter() - t
+			print('{} metadata server(s): {:7.0f} updates/s   mean latency {:6.1f} ms'.format(
+				nodes, len(latencies) / elapsed, 1000 * sum(latencies) / len(latencies)))
+		finally:
+			for proc in procs:
+				stopServer(proc)
+			client.blockRings.clear()
+
+def benchReplicas(args):
+	"""
+	Read the whole file map of a metadata server holding `files` entries from concurrent
+	clients, spread over the primary and its read replicas, and report reads/s.
+	"""
+	for count in args.replicas:
+		procs = [startServer('--port', '8080')]
+		urls = [URL] + ['http://localhost:{}'.format(8081 + i) for i in range(count)]
+		procs += [startServer('--port', url[-4:], '--follow', URL) for url in urls[1:]]
+		try:
+			digest = hashlib.sha256(b'').hexdigest()
+			client.connect(URL).surfstore.updatefiles([['f{}.txt'.format(i), 1, [digest]] for i in range(args.files)])
+			reads = []
+
+			def work(worker):
+				proxy = client.connect(urls[worker % len(urls)])
+				for _ in range(args.reads):
+					proxy.surfstore.getfileinfomap()
+					reads.append(1)
+			workers = [threading.Thread(target=work, args=(i,)) for i in range(args.clients)]
+			t = time.perf_counter()
+			for w in workers:
+				w.start()
+			for w in workers:
+				w.join()
+			elapsed = time.perf_counter() - t
+			print('primary + {} replica(s): {:7.1f} getfileinfomap/s'.format(count, len(reads) / elapsed))
+		finally:
+			for proc in procs:
+				stopServer(proc)
+			client.blockRings.clear()
+
+def benchCache(args):
+	"""
+	Read blocks from the disk block store with a skewed popularity (a few blocks get
+	most reads, interleaved with one-off scans), behind caches of several sizes.
+	"""
+	blocks = [os.urandom(args.blocksize) for _ in range(args.blocks)]
+	hashes = [hashlib.sha256(b).hexdigest() for b in blocks]
+	rng = random.Random(0)
+	reads = []
+	for _ in range(args.reads):
+		if rng.random() < 0.2:
+			reads.append(rng.choice(hashes))
+		else:
+			reads.append(hashes[min(int(rng.paretovariate(1.2)) - 1, len(hashes) - 1)])
+	shutil.rmtree('./bench_blocks/', ignore_errors=True)
+	disk = DiskBlockStore('./bench_blocks/', 'never')
+	try:
+		for h, b in zip(hashes, blocks):
+			disk.put(h, b)
+		for mb in args.cachemb:
+			store = CachedBlockStore(disk, int(mb * 1024 * 1024)) if mb else disk
+			t = time.perf_counter()
+			for h in reads:
+				store.get(h)
+			elapsed = time.perf_counter() - t
+			hits = store.stats()['cachehits'] if mb else 0
+			print('cache {:6.1f} MB   hit rate {:5.1f}%   {:8.0f} gets/s'.format(
+				mb, 100 * hits / len(reads), len(reads) / elapsed))
+	finally:
+		shutil.rmtree('./bench_blocks/', ignore_errors=True)
+
+def serverResources(proc):
+	"""
+	(resident MB, threads) of a server process, from /proc.
+	"""
+	fields = {}
+	with open('/proc/{}/status'.format(proc.pid)) as f:
+		for line in f:
+			name, _, value = line.partition(':')
+			fields[name] = value.split()
+	return int(fields['VmRSS'][0]) / 1024, int(fields['Threads'][0])
+
+def benchServer(args):
+	"""
+	Hold many idle keep-alive connections on each server engine, then measure the
+	call throughput of a set of busy clients.
+	"""
+	engines = {
+		'threaded': [],
+		'pooled': ['--workers', str(args.clients), '--queuesize', str(args.idle + args.clients)],
+		'asyncio': ['--asyncio'],
+	}
+	ping = b"<?xml version='1.0'?><methodCall><methodName>surfstore.ping</methodName><params></params></methodCall>"
+	hashes = [hashlib.sha256(str(i).encode()).hexdigest() for i in range(100)]
+	for engine in args.engines:
+		proc = startServer(*engines[engine])
+		idle = []
+		try:
+			for _ in range(args.idle):
+				conn = http.client.HTTPConnection('localhost', 8080)
+				conn.request('POST', '/RPC2', ping, {'Content-Type': 'text/xml'})
+				conn.getresponse().read()
+				idle.append(conn)
+			rss, threads = serverResources(proc)
+
+			def work():
+				proxy = client.connect(URL)
+				for _ in range(args.calls):
+					proxy.surfstore.hasblocks(hashes)
+			workers = [threading.Thread(target=work) for _ in range(args.clients)]
+			t = time.perf_counter()
+			for w in workers:
+				w.start()
+			for w in workers:
+				w.join()
+			elapsed = time.perf_counter() - t
+			print('{:<9s} {:6d} idle conns: {:7.1f} MB RSS {:6d} threads   {:7.0f} calls/s from {} clients'.format(
+				engine, args.idle, rss, threads, args.clients * args.calls / elapsed, args.clients))
+		finally:
+			for conn in idle:
+				conn.close()
+			stopServer(proc)
+
+def serverCPU(proc):
+	"""
+	CPU seconds (user + system) used by a server process so far, from /proc.
+	"""
+	with open('/proc/{}/stat'.format(proc.pid)) as f:
+		fields = f.read().rsplit(')', 1)[1].split()
+	return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def benchWire(args):
+	"""
+	Upload then download one file with blocks sent as XML-RPC and as binary frames,
+	and report MB/s and the CPU time the client and server spent per MB.
+	"""
+	basedir = './bench/'
+	client.batchBytes = args.batchbytes
+	content = os.urandom(args.size)
+	mb = args.size / 1e6
+	for protocol in ('xmlrpc', 'binary'):
+		client.protocol = protocol
+		proc = startServer()
+		try:
+			makeDir(basedir)
+			with open(basedir + 'big.dat', 'wb') as f:
+				f.write(content)
+			proxy = client.connect(URL)
+			hashlist = dict(client.scandir(basedir, args.blocksize))['big.dat']
+
+			cpu = time.process_time(), serverCPU(proc)
+			t = time.perf_counter()
+			client.upload(proxy, 'big.dat', 1, hashlist, {}, basedir, args.blocksize, 0)
+			tUp = time.perf_counter() - t
+			os.remove(basedir + 'big.dat')
+			t = time.perf_counter()
+			client.download(proxy, basedir, 'big.dat', hashlist, args.blocksize)
+			tDown = time.perf_counter() - t
+			cpuClient = time.process_time() - cpu[0]
+			cpuServer = serverCPU(proc) - cpu[1]
+
+			with open(basedir + 'big.dat', 'rb') as f:
+				assert f.read() == content
+			print('{:<7s} upload {:7.1f} MB/s   download {:7.1f} MB/s   CPU/MB client {:5.1f} ms  server {:5.1f} ms'.format(
+				protocol, mb / tUp, mb / tDown, 1000 * cpuClient / (2 * mb), 1000 * cpuServer / (2 * mb)))
+		finally:
+			stopServer(proc)
+			shutil.rmtree(basedir)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="SurfStore benchmarks")
+	sub = parser.add_subparsers(dest='bench', required=True)
+
+	p = sub.add_parser('transfer', help='Block upload/download throughput')
+	p.add_argument('--size', type=int, default=64 * 1024 * 1024, help='File size in bytes')
+	p.add_argument('--blocksize', type=int, default=4096, help='Block size')
+	p.add_argument('--batchbytes', type=int, default=client.batchBytes, help='Byte budget of a single block transfer call')
+	p.add_argument('--parallelism', type=int, nargs='+', default=[1, 2, 4, 8], help='Parallelism levels to compare')
+	p.set_defaults(func=benchTransfer)
+
+	p = sub.add_parser('scan', help='Directory hashing throughput')
+	p.add_argument('--size', type=int, default=256 * 1024 * 1024, help='Total bytes to hash')
+	p.add_argument('--files', type=int, default=4, help='Number of files the bytes are spread over')
+	p.add_argument('--blocksize', type=int, default=4096, help='Block size')
+	p.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help='Hash worker counts to compare')
+	p.set_defaults(func=benchScan)
+
+	p = sub.add_parser('index', help='Local index size and load/save time, text vs binary format')
+	p.add_argument('--files', type=int, default=20000, help='Number of files in the index')
+	p.add_argument('--blocks', type=int, default=16, help='Blocks per file')
+	p.set_defaults(func=benchIndex)
+
+	p = sub.add_parser('chunking', help='Bytes re-uploaded after edits and chunking throughput, fixed vs content-defined blocks')
+	p.add_argument('--size', type=int, default=4 * 1024 * 1024, help='File size in bytes')
+	p.add_argument('--blocksize', type=int, default=4096, help='Block size')
+	p.set_defaults(func=benchChunking)
+
+	p = sub.add_parser('blockstore', help='Block store backend put/get throughput')
+	p.add_argument('--blocks', type=int, default=2000, help='Number of blocks')
+	p.add_argument('--blocksize', type=int, default=4096, help='Block size')
+	p.set_defaults(func=benchBlockstore)
+
+	p = sub.add_parser('commit', help='Sync throughput of many small files by metadata batch size')
+	p.add_argument('--files', type=int, default=5000, help='Number of files')
+	p.add_argument('--size', type=int, default=100, help='File size in bytes')
+	p.add_argument('--commitfiles', type=int, nargs='+', default=[1, 100, 1000], help='Files per updatefiles call to compare')
+	p.set_defaults(func=benchCommit)
+
+	p = sub.add_parser('raft', help='Metadata commit throughput and latency with replication')
+	p.add_argument('--nodes', type=int, nargs='+', default=[1, 3, 5], help='Cluster sizes to compare')
+	p.add_argument('--clients', type=int, default=16, help='Concurrent clients')
+	p.add_argument('--updates', type=int, default=200, help='updatefile calls per client')
+	p.set_defaults(func=benchRaft)
+
+	p = sub.add_parser('replicas', help='Metadata read throughput with read replicas')
+	p.add_argument('--replicas', type=int, nargs='+', default=[0, 1, 3], help='Replica counts to compare')
+	p.add_argument('--files', type=int, default=2000, help='Entries in the file map')
+	p.add_argument('--clients', type=int, default=16, help='Concurrent clients')
+	p.add_argument('--reads', type=int, default=20, help='getfileinfomap calls per client')
+	p.set_defaults(func=benchReplicas)
+
+	p = sub.add_parser('cache', help='Hit rate and get throughput of the hot block cache')
+	p.add_argument('--blocks', type=int, default=5000, help='Number of blocks in the store')
+	p.add_argument('--blocksize', type=int, default=4096, help='Block size')
+	p.add_argument('--reads', type=int, default=50000, help='Number of block reads')
+	p.add_argument('--cachemb', type=float, nargs='+', default=[0, 1, 4, 16], help='Cache sizes to compare, in MB')
+	p.set_defaults(func=benchCache)
+
+	p = sub.add_parser('server', help='Idle connection footprint and call throughput of the server engines')
+	p.add_argument('--idle', type=int, default=2000, help='Idle keep-alive connections to hold open')
+	p.add_argument('--clients', type=int, default=16, help='Busy clients')
+	p.add_argument('--calls', type=int, default=200, help='hasblocks calls per busy client')
+	p.add_argument('--engines', nargs='+', default=['threaded', 'pooled', 'asyncio'], help='Engines to compare')
+	p.set_defaults(func=benchServer)
+
+	p = sub.add_parser('wire', help='Block transfer throughput and CPU cost, XML-RPC vs binary frames')
+	p.add_argument('--size', type=int, default=64 * 1024 * 1024, help='File size in bytes')
+	p.add_argument('--blocksize', type=int, default=4096, help='Block size')
+	p.add_argument('--batchbytes', type=int, default=client.batchBytes, help='Byte budget of a single block transfer call')
+	p.set_defaults(func=benchWire)
+
+	args = parser.parse_args()
+	args.func(args)
@@ -0,0 +1,232 @@
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+# Block stores map a block's hash value to its bytes.
+# All of them offer get(h) (KeyError if missing), put(h, data), has(h), len(),
+# delete(h) (returns the size of the block, or None if it was missing) and keys()
+# (a snapshot of the stored hash values), and are safe to call from concurrent request threads without extra locking:
+# blocks are immutable and keyed by their content, so racing puts of a hash store
+# the same bytes.
+
+class MemoryBlockStore:
+    """Keeps every block in a dict; lost when the server stops"""
+
+    def __init__(self):
+        self.blocks = dict()  # hashvalue -> bytes
+
+    def get(self, h):
+        return self.blocks[h]
+
+    def put(self, h, data):
+        self.blocks[h] = data
+
+    def has(self, h):
+        return h in self.blocks
+
+    def delete(self, h):
+        data = self.blocks.pop(h, None)
+        return None if data is None else len(data)
+
+    def keys(self):
+        return list(self.blocks)
+
+    def __len__(self):
+        return len(self.blocks)
+
+
+class DiskBlockStore:
+    """
+    Content-addressed store keeping each block in its own file, sharded by hash
+    prefix: <root>/ab/cd/abcd...
+
+    Blocks are written to a temporary file and linked into place, so a reader never
+    sees a partial block. `fsync` picks the durability of a put:
+    - 'never':  leave flushing to the OS (fastest, recent blocks may be lost on power failure)
+    - 'data':   fsync the block file before linking it into place
+    - 'always': also fsync the shard directory, so the new directory entry is durable too
+    """
+
+    FSYNC_POLICIES = ('never', 'data', 'always')
+
+    def __init__(self, root, fsync='always'):
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError('unknown fsync policy: {}'.format(fsync))
+        self.root = root
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self.count = 0
+        for dirpath, _, files in os.walk(root):
+            for name in files:
+                if name.endswith('.tmp'):
+                    # Left behind by a put interrupted by a crash
+                    os.unlink(os.path.join(dirpath, name))
+                else:
+                    self.count += 1
+
+    def path(self, h):
+        return os.path.join(self.root, h[:2], h[2:4], h)
+
+    def get(self, h):
+        try:
+            with open(self.path(h), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError(h)
+
+    def put(self, h, data):
+        path = self.path(h)
+        if os.path.exists(path):
+            return
+        shard = os.path.dirname(path)
+        os.makedirs(shard, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=shard, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                if self.fsync != 'never':
+                    f.flush()
+                    os.fsync(f.fileno())
+            # Unlike a rename, link() fails if another thread stored the block meanwhile
+            os.link(tmp, path)
+        except FileExistsError:
+            return
+        finally:
+            os.unlink(tmp)
+        if self.fsync == 'always':
+            dirfd = os.open(shard, os.O_RDONLY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+        with self.lock:
+            self.count += 1
+
+    def has(self, h):
+        return os.path.exists(self.path(h))
+
+    def delete(self, h):
+        path = self.path(h)
+        try:
+            size = os.path.getsize(path)
+            os.unlink(path)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            self.count -= 1
+        return size
+
+    def keys(self):
+        return [name for _, _, files in os.walk(self.root) for name in files if not name.endswith('.tmp')]
+
+    def __len__(self):
+        return self.count
+
+
+class CachedBlockStore:
+    """
+    Keeps the most requested blocks of another store in memory, up to `capacity` bytes,
+    so popular blocks are served without touching the backing store. Blocks are cached
+    in their stored (encoded) form, which is what binary protocol replies are made of.
+
+    Eviction is segmented LRU: a block enters a probation segment when it is read or
+    written, and is promoted to a protected segment (at most `protectedShare` of the
+    capacity) when it is read again. Blocks are evicted from the cold end of probation,
+    so one large download streaming through cannot flush the popular blocks.
+    """
+
+    def __init__(self, backend, capacity, protectedShare=0.8):
+        self.backend = backend
+        self.capacity = capacity
+        self.protectedCapacity = int(capacity * protectedShare)
+        self.probation = OrderedDict()  # hashvalue -> bytes, least recently used first
+        self.protected = OrderedDict()
+        self.probationBytes = 0
+        self.protectedBytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.deletes = 0  # a block read from the backend is only cached if none happened meanwhile
+
+    def get(self, h):
+        with self.lock:
+            data = self.protected.get(h)
+            if data is not None:
+                self.protected.move_to_end(h)
+                self.hits += 1
+                return data
+            data = self.probation.pop(h, None)
+            if data is not None:
+                self.probationBytes -= len(data)
+                self.promote(h, data)
+                self.hits += 1
+                return data
+            self.misses += 1
+            deletes = self.deletes
+        data = self.backend.get(h)
+        self.admit(h, data, deletes)
+        return data
+
+    def put(self, h, data):
+        self.backend.put(h, data)
+        self.admit(h, data)
+
+    def has(self, h):
+        return h in self.protected or h in self.probation or self.backend.has(h)
+
+    def delete(self, h):
+        size = self.backend.delete(h)
+        with self.lock:
+            self.deletes += 1
+            data = self.protected.pop(h, None)
+            if data is not None:
+                self.protectedBytes -= len(data)
+            data = self.probation.pop(h, None)
+            if data is not None:
+                self.probationBytes -= len(data)
+        return size
+
+    def keys(self):
+        return self.backend.keys()
+
+    def __len__(self):
+        return len(self.backend)
+
+    def admit(self, h, data, deletes=None):
+        if len(data) > self.capacity:
+            return
+        with self.lock:
+            if h in self.protected or h in self.probation:
+                return
+            if deletes is not None and deletes != self.deletes:
+                # The block may have been deleted since it was read
+                return
+            self.probation[h] = data
+            self.probationBytes += len(data)
+            self.evict()
+
+    def promote(self, h, data):
+        """Move a block to protected, demoting the coldest protected blocks over its share. Called with the lock held."""
+        self.protected[h] = data
+        self.protectedBytes += len(data)
+        while self.protectedBytes > self.protectedCapacity:
+            old, oldData = self.protected.popitem(last=False)
+            self.protectedBytes -= len(oldData)
+            self.probation[old] = oldData
+            self.probationBytes += len(oldData)
+        self.evict()
+
+    def evict(self):
+        """Drop the coldest probation blocks until the cache fits. Called with the lock held."""
+        while self.probation and self.probationBytes + self.protectedBytes > self.capacity:
+            _, data = self.probation.popitem(last=False)
+            self.probationBytes -= len(data)
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(cachehits=self.hits, cachemisses=self.misses, cacheevictions=self.evictions,
+                        cachebytes=self.probationBytes + self.protectedBytes, cachecapacity=self.capacity)
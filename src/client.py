@@ -1,37 +1,587 @@
 import argparse
+import collections
+import http.client
+import itertools
+import mmap
+import os
+import shutil
+import threading
+import urllib.parse
 import xmlrpc.client
 
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
 import hashlib
 import pdb
+import random
+import time
 
-def scandir(basedir: str, blocksize: int):
-	fname2hashlist = {}
-	hash2block = {}
+import cdc
+import codec
+import collector
+import indexfile
+import raft
+import replica
+import ring
+import wire
+
+# Byte budget of a single getblocks/putblocks call
+batchBytes = 4 * 1024 * 1024
+
+# Number of files whose new versions are committed by a single updatefiles call
+commitFiles = 1000
+
+# How files are split into blocks: 'fixed' cuts every `blocksize` bytes, 'cdc' cuts
+# content-defined chunks of `blocksize` bytes on average (see cdc.py)
+chunking = 'fixed'
+
+# Where the content-defined chunks of the files hashed or downloaded last are, as
+# path -> (statKey, hash -> (offset, length)), so that reading their blocks back does
+# not chunk them again: the gear hash runs in Python, at a few MB/s, holding the GIL
+chunkSpans = {}
+chunkSpansLock = threading.Lock()
+
+# Number of threads hashing files during a scan, and the size of the file
+# segments they are handed (hashlib releases the GIL while hashing)
+hashWorkers = os.cpu_count() or 1
+segmentBytes = 8 * 1024 * 1024
+
+# Encoding of block calls: 'binary' uses the framing of wire.py with servers that
+# support it and XML-RPC with the others, 'xmlrpc' always uses XML-RPC
+protocol = 'binary'
+
+# Codec blocks are compressed with before an upload in the binary protocol ('raw',
+# 'zlib' or 'lzma', see codec.py); blocks that do not shrink are sent raw
+compression = 'zlib'
+
+# Blocks uploaded in the binary protocol, and their size before and after encoding
+compressionStats = dict(blocks=0, plainbytes=0, sentbytes=0)
+compressionLock = threading.Lock()
+
+# How often a call rejected by an overloaded server (HTTP 503) is retried, and the
+# longest wait between attempts; waits double from `retryDelay`, with jitter
+overloadRetries = 8
+retryDelay = 0.05
+maxRetryDelay = 5.0
+
+# A download is written to `.<fname><partialSuffix>` and then renamed over the file
+partialSuffix = '.surfpart'
+
+# Format index.txt is saved in: 'binary' (see indexfile.py) or 'text'; both are read
+indexFormat = 'binary'
+
+# index.txt path -> its IndexFile, remembering what is on disk between a load and a save
+indexFiles = {}
+
+# Number of TCP connections opened to the server so far
+connectionCount = 0
+connectionLock = threading.Lock()
+
+class CountingHTTPConnection(http.client.HTTPConnection):
+	def connect(self):
+		global connectionCount
+		super().connect()
+		with connectionLock:
+			connectionCount += 1
+
+class KeepAliveTransport(xmlrpc.client.Transport):
+	"""
+	HTTP/1.1 transport that keeps one socket open across requests,
+	reconnecting only when the server drops it.
+	"""
+	def make_connection(self, host):
+		if self._connection and host == self._connection[0]:
+			return self._connection[1]
+		chost, self._extra_headers, x509 = self.get_host_info(host)
+		self._connection = host, CountingHTTPConnection(chost)
+		return self._connection[1]
+
+	def withRetries(self, send):
+		"""
+		Send a call, backing off and retrying while the server rejects it as overloaded.
+		A rejected call was never run, so retrying it is always safe.
+		"""
+		delay = retryDelay
+		for attempt in range(overloadRetries + 1):
+			try:
+				return send()
+			except xmlrpc.client.ProtocolError as e:
+				if e.errcode != 503 or attempt == overloadRetries:
+					raise
+			time.sleep(delay * random.uniform(0.5, 1))
+			delay = min(2 * delay, maxRetryDelay)
+
+	def request(self, host, handler, request_body, verbose=False):
+		return self.withRetries(lambda: super(KeepAliveTransport, self).request(host, handler, request_body, verbose))
+
+	def frameRequest(self, host, frame):
+		"""
+		POST a binary protocol frame (see wire.py) on the kept-alive connection and return the reply frame.
+		"""
+		return self.withRetries(lambda: self.singleFrameRequest(host, frame))
+
+	def singleFrameRequest(self, host, frame):
+		# Like Transport.request, retry once if the server closed the kept-alive connection
+		for attempt in (0, 1):
+			conn = self.make_connection(host)
+			try:
+				conn.request('POST', wire.PATH, frame, dict(self._extra_headers, **{'Content-Type': wire.CONTENT_TYPE}))
+				resp = conn.getresponse()
+				reply = resp.read()
+			except (http.client.RemoteDisconnected, ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+				self.close()
+				if attempt:
+					raise
+				continue
+			except Exception:
+				self.close()
+				raise
+			if resp.status != 200:
+				self.close()
+				raise xmlrpc.client.ProtocolError(host + wire.PATH, resp.status, resp.reason, dict(resp.getheaders()))
+			return reply
+
+# What surfstore.protocols() returned for a server URL, learned on first use
+serverProtocols = {}
+
+class BlockProxy:
+	"""
+	ServerProxy stand-in that sends getblocks, putblocks and hasblocks in the binary
+	protocol when the server supports it, on the same connection as the other calls,
+	which go through XML-RPC. Replies have the same types as the XML-RPC ones.
+	Uploaded blocks are compressed with `compression` if the server accepts that codec.
+	"""
+	def __init__(self, url, transport):
+		self.url = url
+		self.host = urllib.parse.urlsplit(url).netloc
+		self.transport = transport
+		self.xmlrpc = xmlrpc.client.ServerProxy(url, transport=transport)
+
+	@property
+	def surfstore(self):
+		return self
+
+	def __getattr__(self, name):
+		return getattr(self.xmlrpc.surfstore, name)
+
+	def protocols(self):
+		if self.url not in serverProtocols:
+			try:
+				serverProtocols[self.url] = self.xmlrpc.surfstore.protocols()
+			except xmlrpc.client.Fault:
+				serverProtocols[self.url] = ['xmlrpc']
+		return serverProtocols[self.url]
+
+	def binary(self):
+		return 'binary' in self.protocols()
+
+	def hasblocks(self, hashlist):
+		if not self.binary():
+			return self.xmlrpc.surfstore.hasblocks(hashlist)
+		reply = self.transport.frameRequest(self.host, wire.HAS + wire.packDigests(hashlist))
+		return [h for h, present in zip(hashlist, reply) if present]
+
+	def getblocks(self, hashlist):
+		if not self.binary():
+			return self.xmlrpc.surfstore.getblocks(hashlist)
+		reply = self.transport.frameRequest(self.host, wire.GET + wire.packDigests(hashlist))
+		return [xmlrpc.client.Binary(codec.decode(b)) for b in wire.unpackBlocks(reply)]
+
+	def putblocks(self, blocks):
+		if not self.binary():
+			return self.xmlrpc.surfstore.putblocks(blocks)
+		use = compression if compression in self.protocols() else 'raw'
+		encoded = [codec.encode(b, use) for b in blocks]
+		with compressionLock:
+			compressionStats['blocks'] += len(blocks)
+			compressionStats['plainbytes'] += sum(map(len, blocks))
+			compressionStats['sentbytes'] += sum(map(len, encoded))
+		self.transport.frameRequest(self.host, wire.PUT + wire.packBlocks(encoded))
+		return True
+
+def connectServer(url):
+	if protocol == 'binary':
+		return BlockProxy(url, KeepAliveTransport())
+	return xmlrpc.client.ServerProxy(url, transport=KeepAliveTransport())
+
+# Ring of the block servers a metadata server URL sends its clients to (None if it
+# stores blocks itself), learned on first use
+blockRings = {}
+
+# Errors after which a block call is tried on the next replica
+ShardErrors = (OSError, http.client.HTTPException, xmlrpc.client.ProtocolError, xmlrpc.client.Fault)
+
+class ShardedProxy:
+	"""
+	Proxy for a metadata server whose blocks may be spread over block servers, as listed
+	by surfstore.getblockservers(). Block calls are split by server along a consistent
+	hashing ring (see ring.py) and sent to each server on its own connection; everything
+	else goes to the metadata server. Replies have the same types as the unsharded ones.
+	A replicated metadata server (see raft.py) that is not the leader names the leader
+	in its refusal, and the call is sent there instead.
+
+	Reads of the metadata (getfileinfomap, getchanges) stay on the server at `url`, which
+	may be a read replica (see replica.py) that sends writes on to its primary. Once this
+	client has written, its reads carry the primary's position after the writes as a
+	version token, so that a replica shows them; a read the replica is too stale for goes
+	to the primary.
+
+	With replication, a block is written to all of its servers (at least one must take
+	it), counts as stored only if all of them have it, and is read from the first one
+	that answers.
+	"""
+	def __init__(self, url):
+		self.url = url
+		self.metaUrl = url
+		self.meta = connectServer(url)
+		self.reader = self.meta  # None once the server at `url` turned out not to serve reads
+		self.token = None  # (epoch, seq) of the primary after this client's writes
+		self.shards = {}  # block server URL -> proxy
+
+	@property
+	def surfstore(self):
+		return self
+
+	def __getattr__(self, name):
+		return lambda *args: self.callMeta(name, *args)
+
+	def callMeta(self, name, *args):
+		"""
+		Call the metadata server, following redirections to the leader. While there is no
+		leader to follow, the call is retried with the same backoff as an overloaded server.
+		"""
+		delay = retryDelay
+		for attempt in range(overloadRetries + 1):
+			try:
+				return getattr(self.meta.surfstore, name)(*args)
+			except xmlrpc.client.Fault as e:
+				if e.faultCode not in (raft.NOT_LEADER, raft.CRASHED) or attempt == overloadRetries:
+					raise
+				if e.faultString and e.faultString != self.metaUrl:
+					self.metaUrl = e.faultString
+					self.meta = connectServer(self.metaUrl)
+					continue
+			time.sleep(delay * random.uniform(0.5, 1))
+			delay = min(2 * delay, maxRetryDelay)
+
+	def getfileinfomap(self):
+		return self.callReader('getfileinfomap')
+
+	def getchanges(self, since):
+		reply = self.callReader('getchanges', since)
+		if self.token is not None and reply['epoch'] != self.token[0]:
+			# The primary lost its history, and the position along with it
+			self.token = None
+		return reply
+
+	def callReader(self, name, *args):
+		if self.reader is not None:
+			if self.token is not None:
+				args += (self.token[1],)
+			try:
+				return getattr(self.reader.surfstore, name)(*args)
+			except xmlrpc.client.Fault as e:
+				if e.faultCode in (raft.NOT_LEADER, raft.CRASHED):
+					self.reader = None
+				elif e.faultCode != replica.STALE:
+					raise
+				elif self.metaUrl == self.url and e.faultString:
+					# The replica names its primary
+					self.metaUrl = e.faultString
+					self.meta = connectServer(self.metaUrl)
+				if self.token is not None:
+					args = args[:-1]
+		return self.callMeta(name, *args)
+
+	def updatefile(self, *args):
+		return self.write('updatefile', *args)
+
+	def updatefiles(self, entries):
+		return self.write('updatefiles', entries)
+
+	def write(self, name, *args):
+		result = self.callMeta(name, *args)
+		if self.reader is not None and self.metaUrl != self.url:
+			# Reads go to a replica of the server written to
+			position = self.callMeta('getseq')
+			self.token = (position['epoch'], position['seq'])
+		return result
+
+	def ring(self):
+		if self.url not in blockRings:
+			try:
+				layout = self.meta.surfstore.getblockservers()
+			except xmlrpc.client.Fault:
+				layout = {'servers': []}
+			blockRings[self.url] = layout['servers'] and ring.HashRing(layout['servers'], layout['vnodes'], layout['replicas'])
+		return blockRings[self.url] or None
+
+	def shard(self, url):
+		if url not in self.shards:
+			self.shards[url] = connectServer(url)
+		return self.shards[url]
+
+	def hasblocks(self, hashlist):
+		hashRing = self.ring()
+		if hashRing is None:
+			return self.meta.surfstore.hasblocks(hashlist)
+		byServer = collections.defaultdict(list)
+		for h in dict.fromkeys(hashlist):
+			for url in hashRing.lookup(h):
+				byServer[url].append(h)
+		missing = set()
+		for url, hashes in byServer.items():
+			try:
+				present = set(self.shard(url).surfstore.hasblocks(hashes))
+			except ShardErrors:
+				present = set()
+			missing.update(h for h in hashes if h not in present)
+		return [h for h in hashlist if h not in missing]
+
+	def putblocks(self, blocks):
+		hashRing = self.ring()
+		if hashRing is None:
+			return self.meta.surfstore.putblocks(blocks)
+		byServer = collections.defaultdict(list)
+		for b in blocks:
+			for url in hashRing.lookup(hashlib.sha256(b).hexdigest()):
+				byServer[url].append(b)
+		stored = set()
+		for url, serverBlocks in byServer.items():
+			try:
+				self.shard(url).surfstore.putblocks(serverBlocks)
+			except ShardErrors:
+				continue
+			stored.update(map(id, serverBlocks))
+		if len(stored) < len(set(map(id, blocks))):
+			raise RuntimeError('no block server could store some blocks')
+		return True
+
+	def getblocks(self, hashlist):
+		hashRing = self.ring()
+		if hashRing is None:
+			return self.meta.surfstore.getblocks(hashlist)
+		found = {}
+		candidates = {h: hashRing.lookup(h) for h in dict.fromkeys(hashlist)}
+		while len(found) < len(candidates):
+			byServer = collections.defaultdict(list)
+			for h, urls in candidates.items():
+				if h not in found:
+					if not urls:
+						raise RuntimeError('no block server has block {}'.format(h))
+					byServer[urls[0]].append(h)
+			for url, hashes in byServer.items():
+				try:
+					found.update(zip(hashes, fetchBlocks(self.shard(url), hashes)))
+				except ShardErrors:
+					for h in hashes:
+						candidates[h].pop(0)
+		return [xmlrpc.client.Binary(found[h]) for h in hashlist]
+
+def connect(url):
+	return ShardedProxy(url)
+
+def cdcSizes(blocksize):
+	"""
+	The (min, avg, max) chunk sizes used by content-defined chunking.
+	"""
+	return max(1, blocksize // 4), blocksize, blocksize * 4
+
+def chunkSpec(blocksize):
+	"""
+	Describes how a hashlist was cut, e.g. 'fixed-4096' or 'cdc-1024-4096-16384'.
+	"""
+	if chunking == 'cdc':
+		return 'cdc-' + '-'.join(map(str, cdcSizes(blocksize)))
+	return 'fixed-{}'.format(blocksize)
+
+def blockSpans(buf, blocksize):
+	"""
+	Yield (offset, length) of the blocks of `buf` under the current chunking mode.
+	"""
+	if chunking == 'cdc':
+		yield from cdc.chunks(buf, *cdcSizes(blocksize))
+	else:
+		for off in range(0, len(buf), blocksize):
+			yield off, min(blocksize, len(buf) - off)
+
+def statKey(st, blocksize):
+	"""
+	The part of a file's stat that tells whether its hashlist may have changed.
+	"""
+	return (st.st_size, st.st_mtime_ns, st.st_ino, chunkSpec(blocksize))
+
+def hashSegment(path, blocksize, offset, nblocks):
+	"""
+	Hash `nblocks` blocks of a file starting at `offset`, or every block up to
+	the end of the file if `nblocks` is None.
+	The file is memory-mapped and blocks are hashed through memoryview slices, without copying.
+	"""
+	with open(path, 'rb') as f:
+		size = os.fstat(f.fileno()).st_size
+		if offset >= size:
+			return []
+		end = size if nblocks is None else min(size, offset + nblocks * blocksize)
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+			return [hashlib.sha256(view[i:min(i + blocksize, end)]).hexdigest()
+				for i in range(offset, end, blocksize)]
+
+def rememberSpans(path, st, blocksize, hashlist, spans):
+	"""
+	Keep the (offset, length) `spans` of the blocks of `hashlist` in the file at `path`,
+	whose stat was `st`, for blockOffsets().
+	"""
+	where = {}
+	for h, span in zip(hashlist, spans):
+		where.setdefault(h, span)
+	with chunkSpansLock:
+		chunkSpans[os.path.abspath(path)] = (statKey(st, blocksize), where)
+
+def hashFile(path, blocksize):
+	"""
+	Hash a whole file block by block under the current chunking mode. The spans of
+	content-defined chunks are remembered (see chunkSpans).
+	"""
+	with open(path, 'rb') as f:
+		st = os.fstat(f.fileno())
+		if st.st_size == 0:
+			return []
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+			spans = list(blockSpans(mm, blocksize))
+			hashlist = [hashlib.sha256(view[off:off + n]).hexdigest() for off, n in spans]
+	if chunking == 'cdc':
+		rememberSpans(path, st, blocksize, hashlist, spans)
+	return hashlist
+
+def scandir(basedir: str, blocksize: int, localIndex=None, stats=None):
+	"""
+	Yield (fname, hashlist) for every file in the base directory, one file at a time.
+	Block contents are not kept; use readBlocks() to get them back by offset.
+
+	Files are cut into segments of about `segmentBytes` that are hashed on `hashWorkers`
+	threads, with a bounded number of segments in flight; files are still yielded in
+	directory order. With content-defined chunking a file is one segment, since its
+	block boundaries depend on everything before them, and the threads barely help:
+	chunking holds the GIL.
+
+	If `stats` (fname -> statKey) is given, a file whose stat still matches its entry
+	reuses its hashlist from `localIndex` instead of being rehashed, and `stats` is
+	updated with the keys of the scanned files. Files modified within the last second
+	are never cached, since a later write could keep the same mtime.
+	"""
+	racyAfter = time.time_ns() - 1000000000
+	segblocks = max(1, segmentBytes // blocksize)
+	window = 2 * hashWorkers
+	pending = collections.deque()  # (fname, [hashlist, or future of a segment's hashlist])
+	inflight = 0
+
+	def popHead():
+		nonlocal inflight
+		fname, parts = pending.popleft()
+		hashlist = []
+		for part in parts:
+			if isinstance(part, list):
+				hashlist.extend(part)
+			else:
+				hashlist.extend(part.result())
+				inflight -= 1
+		return fname, hashlist
 
 	basedir = Path(basedir)
-	for p in basedir.iterdir():
-		if p.is_dir():
-			print('[WARN] found dir: {}'.format(p.name))
-			continue
-
-		if p.name == 'index.txt':
-			continue
-
-		fname = p.name
-		with p.open('rb') as f:
-			tmp = f.read(blocksize)
-			while len(tmp) > 0:
-				h = hashlib.sha256(tmp).hexdigest()
-				lst = fname2hashlist.get(fname, [])
-				lst.append(h)
-				fname2hashlist[fname] = lst
-				hash2block[h] = tmp
-				tmp = f.read(blocksize)
-
-	return fname2hashlist, hash2block
-
-def parseIndexFile(basedir: str):
+	with ThreadPoolExecutor(max_workers=hashWorkers) as executor:
+		for p in basedir.iterdir():
+			if p.is_dir():
+				print('[WARN] found dir: {}'.format(p.name))
+				continue
+
+			if p.name in ('index.txt', 'index.txt.tmp') or p.name.endswith(partialSuffix):
+				continue
+
+			fname = p.name
+			st = p.stat()
+			if stats is not None:
+				key = statKey(st, blocksize)
+				if stats.get(fname) == key and fname in localIndex:
+					pending.append((fname, [localIndex[fname][1]]))
+					continue
+				stats.pop(fname, None)
+				if st.st_mtime_ns < racyAfter:
+					stats[fname] = key
+
+			if chunking == 'cdc':
+				parts = [executor.submit(hashFile, p, blocksize)]
+			else:
+				# The last segment runs to the end of the file, in case it grew since stat()
+				offsets = range(0, st.st_size, segblocks * blocksize)
+				parts = [executor.submit(hashSegment, p, blocksize, off, segblocks if off != offsets[-1] else None)
+					for off in offsets]
+			pending.append((fname, parts))
+			inflight += len(parts)
+
+			while inflight > window:
+				fname, hashlist = popHead()
+				if hashlist:
+					yield fname, hashlist
+
+		while pending:
+			fname, hashlist = popHead()
+			if hashlist:
+				yield fname, hashlist
+
+def blockOffsets(f, hashlist, blocksize):
+	"""
+	Where the blocks of `hashlist` are in an open file, as hash -> (offset, length).
+	With fixed blocks a block's offset follows from its position in the hashlist; with
+	content-defined chunks they are the spans remembered when the file was hashed or
+	downloaded, and the file is only chunked again if its stat changed since. Offsets
+	are only a guess if the file changed since it was hashed: check the hash of what is read.
+	"""
+	spans = {}
+	if chunking == 'cdc':
+		st = os.fstat(f.fileno())
+		with chunkSpansLock:
+			key, where = chunkSpans.get(os.path.abspath(f.name), (None, None))
+		if key == statKey(st, blocksize):
+			return where
+		if st.st_size == 0:
+			return spans
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+			for off, n in blockSpans(mm, blocksize):
+				spans.setdefault(hashlib.sha256(view[off:off + n]).hexdigest(), (off, n))
+		with chunkSpansLock:
+			chunkSpans[os.path.abspath(f.name)] = (statKey(st, blocksize), spans)
+	else:
+		for i, h in enumerate(hashlist):
+			spans.setdefault(h, (i * blocksize, blocksize))
+	return spans
+
+def readBlocks(basedir, fname, hashlist, blocksize, hashes):
+	"""
+	Lazily read back the blocks with the given hashes from a scanned file.
+	Raises RuntimeError if the file no longer matches its hashlist.
+	"""
+	with (Path(basedir) / fname).open('rb') as f:
+		spans = blockOffsets(f, hashlist, blocksize)
+		for h in hashes:
+			if h not in spans:
+				raise RuntimeError('{} changed during synchronization'.format(fname))
+			off, n = spans[h]
+			f.seek(off)
+			b = f.read(n)
+			if hashlib.sha256(b).hexdigest() != h:
+				raise RuntimeError('{} changed during synchronization'.format(fname))
+			yield b
+
+def parseIndexFile(basedir: str, stats=None, cursor=None):
+	"""
+	Read index.txt into a dict fname -> [version, hashlist].
+	A binary index is read by indexfile.IndexFile. In the text format,
+	each line is `fname version hash1 hash2 ...`, optionally followed by
+	`@size:mtime_ns:inode:chunkspec`, which is collected into `stats` if given.
+	A `/cursor epoch seq [token]` line holds the server change sequence position the
+	index is up to date with, and the position after this client's last writes if that
+	is further (see ShardedProxy), and is read into the `cursor` dict if given.
+	"""
 	basedir = Path(basedir)
 	fpath = basedir/'index.txt'
 
@@ -43,20 +593,264 @@ def parseIndexFile(basedir: str):
 		# 	pass
 		return {}
 
+	if indexfile.isBinary(fpath):
+		index = indexfile.IndexFile(str(fpath))
+		indexFiles[str(fpath)] = index
+		return index.load(stats, cursor)
+
 	with fpath.open() as f:
 		for line in f:
 			lst = line.strip().split()
+			if lst and lst[0] == '/cursor':
+				if cursor is not None:
+					cursor['epoch'], cursor['seq'] = lst[1], int(lst[2])
+					cursor['token'] = int(lst[3]) if len(lst) > 3 else 0
+				continue
 			if len(lst) < 2:
 				print('[ERROR] wrong index.txt format')
 				continue
 			fname, version, *hashlist = lst
+			if hashlist and hashlist[-1].startswith('@'):
+				key = hashlist.pop()
+				if stats is not None:
+					size, mtime, ino, spec = key[1:].split(':')
+					stats[fname] = (int(size), int(mtime), int(ino), spec)
+			if hashlist == ['0']:
+				hashlist = [0]
 			dct[fname] = [int(version), hashlist]
 
 	return dct
 
-def download(client, basedir, fname, hashlist):
+def batchBlocks(blocks, batchbytes):
+	"""
+	Split a list of blocks into consecutive batches of at most `batchbytes` bytes.
+	A block larger than the budget is put in a batch of its own.
+	"""
+	batch, nbytes = [], 0
+	for b in blocks:
+		if batch and nbytes + len(b) > batchbytes:
+			yield batch
+			batch, nbytes = [], 0
+		batch.append(b)
+		nbytes += len(b)
+	if batch:
+		yield batch
+
+class SerialPool:
+	"""
+	Runs transfer jobs one after another on a single connection.
+	Used when no TransferPool is given.
+	"""
+	def __init__(self, client):
+		self.client = client
+
+	def run(self, fn, jobs):
+		for job in jobs:
+			yield job, fn(self.client, job)
+
+class TransferPool:
+	"""
+	Runs transfer jobs on `parallelism` worker threads, each with its own keep-alive connection to the server.
+	At most `window` jobs are in flight at once, so lazily generated jobs are only materialized
+	as fast as the workers consume them.
+	"""
+	def __init__(self, url, parallelism, window=None):
+		self.url = url
+		self.window = window or 2 * parallelism
+		self.local = threading.local()
+		self.executor = ThreadPoolExecutor(max_workers=parallelism)
+
+	def proxy(self):
+		if not hasattr(self.local, 'proxy'):
+			self.local.proxy = connect(self.url)
+		return self.local.proxy
+
+	def call(self, fn, job):
+		return job, fn(self.proxy(), job)
+
+	def run(self, fn, jobs):
+		"""
+		Call fn(proxy, job) for every job and yield (job, result) pairs in completion order.
+		"""
+		pending = set()
+		for job in jobs:
+			if len(pending) >= self.window:
+				done, pending = wait(pending, return_when=FIRST_COMPLETED)
+				for fut in done:
+					yield fut.result()
+			pending.add(self.executor.submit(self.call, fn, job))
+		while pending:
+			done, pending = wait(pending, return_when=FIRST_COMPLETED)
+			for fut in done:
+				yield fut.result()
+
+	def shutdown(self):
+		self.executor.shutdown()
+
+def fetchBlocks(client, hashlist):
+	"""
+	Fetch the blocks of `hashlist` with `getblocks`, re-requesting whatever the server
+	left out of a reply because of its batch byte budget.
+	"""
+	data = []
+	while len(data) < len(hashlist):
+		data.extend(b.data for b in client.surfstore.getblocks(hashlist[len(data):]))
+	return data
+
+class LocalBlocks:
+	"""
+	Index of the blocks already present in local files, hash -> file, so a download can
+	copy them instead of fetching them. Files are described by their hashlist; where each
+	block sits in a file is worked out (see blockOffsets) the first time one is needed.
+	A block is only used if what is read back still has its hash, so a file modified
+	since it was indexed just costs a fetch.
+	"""
+	def __init__(self, basedir, blocksize):
+		self.basedir = Path(basedir)
+		self.blocksize = blocksize
+		self.files = {}  # fname -> hashlist
+		self.where = {}  # hash -> fname
+		self.spans = {}  # fname -> blockOffsets() of the file
+		self.lock = threading.Lock()
+
+	def add(self, fname, hashlist):
+		if hashlist == [0]:
+			return
+		with self.lock:
+			self.files[fname] = hashlist
+			self.spans.pop(fname, None)
+			for h in hashlist:
+				self.where[h] = fname
+
+	def remove(self, fname):
+		# Entries of `where` pointing at the file are dropped as they are looked up
+		with self.lock:
+			self.files.pop(fname, None)
+			self.spans.pop(fname, None)
+
+	def read(self, hashes):
+		"""
+		Returns hash -> block for those of `hashes` that could be read from local files.
+		"""
+		byFile = collections.defaultdict(list)
+		with self.lock:
+			for h in dict.fromkeys(hashes):
+				fname = self.where.get(h)
+				if fname in self.files:
+					byFile[fname].append(h)
+				elif fname is not None:
+					del self.where[h]
+		blocks = {}
+		for fname, fileHashes in byFile.items():
+			try:
+				with (self.basedir / fname).open('rb') as f:
+					spans = self.spans.get(fname)
+					if spans is None:
+						spans = blockOffsets(f, self.files.get(fname, []), self.blocksize)
+						with self.lock:
+							if fname in self.files:
+								self.spans[fname] = spans
+					for h in fileHashes:
+						if h not in spans:
+							continue
+						off, n = spans[h]
+						f.seek(off)
+						b = f.read(n)
+						if hashlib.sha256(b).hexdigest() == h:
+							blocks[h] = b
+			except OSError:
+				self.remove(fname)
+		return blocks
+
+# Blocks of downloads copied from local files, and fetched from the server
+downloadStats = dict(copied=0, fetched=0)
+downloadLock = threading.Lock()
+
+def gatherBlocks(client, hashes, local=None):
+	"""
+	The blocks of `hashes`: copied from local files where `local` (a LocalBlocks) has
+	them, fetched from the server otherwise. A block repeated in `hashes` is fetched once.
+	"""
+	found = local.read(hashes) if local is not None else {}
+	missing = [h for h in dict.fromkeys(hashes) if h not in found]
+	if missing:
+		found.update(zip(missing, fetchBlocks(client, missing)))
+	with downloadLock:
+		downloadStats['copied'] += len(found) - len(missing)
+		downloadStats['fetched'] += len(missing)
+	return [found[h] for h in hashes]
+
+def writeMapped(path, batches, nblocks, blocksize):
+	"""
+	Write (index, blocks) batches, arriving in any order, at their offsets into a memory
+	map of the preallocated file. Returns False, leaving the file incomplete, as soon as a
+	block other than the last is not `blocksize` long (the file was cut differently).
+	"""
+	def fits(j, b):
+		# Only the last block may be short
+		return len(b) == blocksize or j == nblocks - 1 and len(b) < blocksize
+
+	with path.open('w+b') as hd:
+		if nblocks == 0:
+			return True
+		# The first batch is checked before nblocks * blocksize bytes are reserved: with
+		# a block size larger than the file was cut with, they may not fit on the disk
+		batches = iter(batches)
+		i, data = first = next(batches)
+		if not all(fits(j, b) for j, b in enumerate(data, i)):
+			return False
+		reserve = nblocks * blocksize
+		if i + len(data) == nblocks:
+			reserve += len(data[-1]) - blocksize
+		# Reserve the space up front so a full disk fails here rather than as SIGBUS on the map
+		if hasattr(os, 'posix_fallocate'):
+			os.posix_fallocate(hd.fileno(), 0, reserve)
+		else:
+			hd.truncate(reserve)
+		size = 0
+		with mmap.mmap(hd.fileno(), 0) as mm:
+			for i, data in itertools.chain([first], batches):
+				for j, b in enumerate(data, i):
+					if not fits(j, b):
+						return False
+					mm[j * blocksize:j * blocksize + len(b)] = b
+					size = max(size, j * blocksize + len(b))
+		hd.truncate(size)
+	return True
+
+def writeInOrder(path, batches, step):
+	"""
+	Write (index, blocks) batches, arriving in any order, one after another as they
+	become contiguous. Used when block sizes are not known in advance. Returns the
+	(offset, length) of every block written.
+	"""
+	ready = {}
+	nxt = 0
+	spans = []
+	off = 0
+	with path.open('wb') as hd:
+		for i, data in batches:
+			ready[i] = data
+			while nxt in ready:
+				data = ready.pop(nxt)
+				hd.writelines(data)
+				for b in data:
+					spans.append((off, len(b)))
+					off += len(b)
+				nxt += step
+	return spans
+
+def download(client, basedir, fname, hashlist, blocksize, pool=None, local=None):
 	"""
 	Download the blocks associated with that file, and reconstitute that file in the base directory.
+	Blocks are gathered in batches of about `batchBytes` through `pool`; batches may complete
+	out of order. Blocks found in local files by `local` (a LocalBlocks), which may include
+	the previous version of this file, are copied from them, and only the others are
+	fetched from the server. The file is written beside the old one and renamed over it
+	when complete, so it is replaced atomically and the old blocks stay readable
+	meanwhile. Fixed-size blocks are copied at their offsets into a memory map of the
+	preallocated file; otherwise (content-defined chunks, or a file uploaded with another
+	block size) batches are written in order.
 	Corner case: the file on the server marked as 'deleted' (i.e. len(hashlist) == 1 and hashlist[0] == 0)
 	"""
 	basedir = Path(basedir)
@@ -68,19 +862,44 @@ def download(client, basedir, fname, hashlist):
 		if (basedir / fname).exists():
 			(basedir / fname).unlink() 
 	else:
-		with (basedir / fname).open('wb') as hd:
-			for h in hashlist:
-				b = client.surfstore.getblock(h)
-				hd.write(b.data)
+		pool = pool or SerialPool(client)
+		step = max(1, batchBytes // blocksize)
+		fetch = lambda proxy, i: gatherBlocks(proxy, hashlist[i:i+step], local)
+		batches = lambda: pool.run(fetch, range(0, len(hashlist), step))
+		path = basedir / fname
+		partial = basedir / ('.' + fname + partialSuffix)
+		try:
+			spans = None
+			if chunking != 'fixed' or not writeMapped(partial, batches(), len(hashlist), blocksize):
+				spans = writeInOrder(partial, batches(), step)
+			if path.exists():
+				shutil.copymode(path, partial)
+			os.replace(partial, path)
+			if chunking == 'cdc':
+				# Later downloads copying blocks from this file find them without chunking it
+				rememberSpans(path, os.stat(path), blocksize, hashlist, spans)
+		finally:
+			if partial.exists():
+				partial.unlink()
 
 
-def mergeCloudToLocal(client, localIndex, remoteIndex, basedir):
+def mergeCloudToLocal(client, localIndex, remoteIndex, basedir, blocksize, pool=None):
+	"""
+	Download the files that are newer in the cloud. Their blocks are copied from the
+	local files, including the ones just downloaded and the previous version of the
+	file itself, whenever they are already there: a changed file only fetches the
+	blocks that changed.
+	"""
+	local = LocalBlocks(basedir, blocksize)
+	for fname, (lcVersion, lcHashlist) in localIndex.items():
+		local.add(fname, lcHashlist)
 	for fname in remoteIndex:
 		rmVersion, rmHashlist = remoteIndex[fname]
 		lcVersion, lcHashlist = localIndex.get(fname, [0, []])
 		if rmVersion > lcVersion:
-			download(client, basedir, fname, rmHashlist)
+			download(client, basedir, fname, rmHashlist, blocksize, pool, local)
 			localIndex[fname] = [rmVersion, rmHashlist]
+			local.add(fname, rmHashlist)
 
 def isSame(hashlist1, hashlist2) -> bool:
 	"""
@@ -93,60 +912,172 @@ def isSame(hashlist1, hashlist2) -> bool:
 			return False
 	return True
 
-def upload(client, fname, version, hashlist, hash2block, localIndex, basedir):
+def upload(client, fname, version, hashlist, localIndex, basedir, blocksize, since, pool=None):
+	"""
+	Upload one file, see uploadFiles().
+	"""
+	uploadFiles(client, [(fname, version, hashlist)], localIndex, basedir, blocksize, since, pool)
+
+def uploadFiles(client, entries, localIndex, basedir, blocksize, since, pool=None):
 	"""
-	Upload the blocks corresponding to this file to the server, then update the server with the new FileInfo.
-	- If that update is successful, then the client should update its local index.
-	- If fails with a version error, download the cloud version and update the localIndex
+	Upload the blocks of a batch of (fname, version, hashlist) entries to the server, then
+	update the server with their new FileInfos in a single `updatefiles` call.
+	One `hasblocks` call covers the blocks of every file; each missing block is read back
+	from the first file holding it and sent once with `putblocks`, in batches of at most
+	`batchBytes` bytes, through `pool`. If the server collected some of the blocks while
+	the upload ran (see collector.py), it refuses the whole batch and the missing blocks
+	are uploaded again.
+	- For each update that is successful, the client updates its local index.
+	- Each update rejected with a version error lost to a newer cloud version, which is
+	  downloaded into the localIndex instead. Those versions were committed after change
+	  sequence number `since`, so only the changes after it are fetched.
 
-	* Corner Case: hashlist == [0] * 
+	* Corner Case: hashlist == [0] (deletion) has no blocks *
 	"""
-	if not (len(hashlist) == 1 and hashlist[0] == 0):
-		inHashlist = set(client.surfstore.hasblocks(hashlist))
-		for h in hashlist:
-			if h not in inHashlist:
-				b = hash2block[h]
-				client.surfstore.putblock(b)
-	
-	isUpdated = client.surfstore.updatefile(fname, version, hashlist)
-	if isUpdated:
-		localIndex[fname] = [version, hashlist]
-	else:
-		newRemoteIndex = client.surfstore.getfileinfomap()
+	hashes = list(dict.fromkeys(h for _, _, hashlist in entries if hashlist != [0] for h in hashlist))
+	for attempt in range(overloadRetries + 1):
+		if hashes:
+			need = set(hashes) - set(client.surfstore.hasblocks(hashes))
+			blocks = []
+			for fname, _, hashlist in entries:
+				missing = [h for h in dict.fromkeys(hashlist) if h in need]
+				if missing:
+					need.difference_update(missing)
+					blocks.append(readBlocks(basedir, fname, hashlist, blocksize, missing))
+			pool = pool or SerialPool(client)
+			batches = batchBlocks(itertools.chain.from_iterable(blocks), batchBytes)
+			for _ in pool.run(lambda proxy, batch: proxy.surfstore.putblocks(batch), batches):
+				pass
+
+		try:
+			results = client.surfstore.updatefiles([[fname, version, hashlist] for fname, version, hashlist in entries])
+			break
+		except xmlrpc.client.Fault as e:
+			if e.faultCode != collector.MISSING_BLOCKS or attempt == overloadRetries:
+				raise
+	rejected = []
+	for (fname, version, hashlist), isUpdated in zip(entries, results):
+		if isUpdated:
+			localIndex[fname] = [version, hashlist]
+		else:
+			rejected.append((fname, hashlist))
+	if not rejected:
+		return
+
+	# A version that won while its log record was being synced shows up once it is on disk
+	newRemoteIndex = {}
+	delay = retryDelay
+	for attempt in range(overloadRetries + 1):
+		newRemoteIndex.update(client.surfstore.getchanges(since)['changes'])
+		missing = [fname for fname, _ in rejected if fname not in newRemoteIndex]
+		if not missing:
+			break
+		if attempt == overloadRetries:
+			raise RuntimeError('versions of {} that won a conflict are not visible'.format(', '.join(missing)))
+		time.sleep(delay * random.uniform(0.5, 1))
+		delay = min(2 * delay, maxRetryDelay)
+	# Blocks the local edits share with the cloud versions are reused
+	local = LocalBlocks(basedir, blocksize)
+	for fname, hashlist in rejected:
+		local.add(fname, hashlist)
+	for fname, hashlist in rejected:
 		newVersion, newHashlist = newRemoteIndex[fname]
-		download(client, basedir, fname, newHashlist)
+		download(client, basedir, fname, newHashlist, blocksize, pool, local)
 		localIndex[fname] = [newVersion, newHashlist]
+		local.add(fname, newHashlist)
+
+def mergeLocalToCloud(client, localIndex, basedir, blocksize, since, pool=None, stats=None):
+	"""
+	Upload the files created, modified or deleted locally, in batches of `commitFiles` files.
+	"""
+	batch = []
+
+	def commit():
+		uploadFiles(client, batch, localIndex, basedir, blocksize, since, pool)
+		for fname, _, hashlist in batch:
+			if stats is not None and localIndex[fname][1] is not hashlist:
+				# Lost a version conflict: the file was replaced by the cloud version
+				stats.pop(fname, None)
+		batch.clear()
 
-def mergeLocalToCloud(client, localIndex, basedir, blocksize, remoteIndex):
-	fname2hashlist, hash2block = scandir(basedir, blocksize)
 	# Handle files that are modified or created
-	for fname in fname2hashlist:
+	seen = set()
+	for fname, hashlist in scandir(basedir, blocksize, localIndex, stats):
+		seen.add(fname)
 		lcVersion, lcHashlist = localIndex.get(fname, [0, []])
-		hashlist = fname2hashlist[fname]
 		if not isSame(hashlist, lcHashlist):
-			upload(client, fname, lcVersion+1, hashlist, hash2block, localIndex, basedir)
+			batch.append((fname, lcVersion+1, hashlist))
+			if len(batch) >= commitFiles:
+				commit()
 
 	# Handle files that are deleted
-	deletedFnames = set(localIndex.keys()) - set(fname2hashlist.keys())
+	# (after mergeCloudToLocal, localIndex matches the cloud for files this client knows)
+	deletedFnames = set(localIndex.keys()) - seen
 	for fname in deletedFnames:
-		if remoteIndex[fname][1] != [0]:
-			lcVersion, lcHashlist = localIndex[fname]
-			upload(client, fname, lcVersion+1, [0], hash2block, localIndex, basedir)
+		if stats is not None:
+			stats.pop(fname, None)
+		lcVersion, lcHashlist = localIndex[fname]
+		if lcHashlist != [0]:
+			batch.append((fname, lcVersion+1, [0]))
+			if len(batch) >= commitFiles:
+				commit()
+	if batch:
+		commit()
 
-def dumpLocalIndex(localIndex, basedir):
+def dumpLocalIndex(localIndex, basedir, stats=None, cursor=None):
+	"""
+	Save the local index to index.txt, in `indexFormat`. A binary index read or saved
+	before by this process only gets the records of the files that changed appended.
+	"""
 	basedir = Path(basedir)
+	stats = stats or {}
+	if indexFormat == 'binary':
+		fpath = str(basedir/'index.txt')
+		if fpath not in indexFiles:
+			indexFiles[fpath] = indexfile.IndexFile(fpath)
+		indexFiles[fpath].save(localIndex, stats, cursor)
+		return
+	indexFiles.pop(str(basedir/'index.txt'), None)
 	with (basedir/'index.txt').open('w') as hd:
+		if cursor is not None:
+			if cursor.get('token'):
+				hd.write('/cursor {} {} {}\n'.format(cursor['epoch'], cursor['seq'], cursor['token']))
+			else:
+				hd.write('/cursor {} {}\n'.format(cursor['epoch'], cursor['seq']))
 		for fname in localIndex:
 			lcVersion, lcHashlist = localIndex[fname]
-			hd.write(' '.join(map(str, [fname, lcVersion] + lcHashlist)) + '\n')
+			line = [fname, lcVersion] + lcHashlist
+			if fname in stats:
+				line.append('@' + ':'.join(map(str, stats[fname])))
+			hd.write(' '.join(map(str, line)) + '\n')
+
+def getRemoteChanges(client, cursor):
+	"""
+	Get the cloud entries changed since `cursor` ({'epoch', 'seq'}), or all of them if
+	the server's change sequence is not the one the cursor points into.
+	"""
+	reply = client.surfstore.getchanges(cursor['seq'])
+	if reply['epoch'] != cursor['epoch'] and cursor['seq'] != 0:
+		reply = client.surfstore.getchanges(0)
+	return reply
 
-def synchronize(client, basedir: str, blocksize: int):
-	localIndex = parseIndexFile(basedir)
-	remoteIndex = client.surfstore.getfileinfomap()
+def synchronize(client, basedir: str, blocksize: int, pool=None):
+	stats = {}
+	cursor = {'epoch': '', 'seq': 0, 'token': 0}
+	localIndex = parseIndexFile(basedir, stats, cursor)
+	sharded = isinstance(client, ShardedProxy)
+	if sharded and cursor['token'] and client.token is None:
+		# Read this client's writes of the last run, even from a replica
+		client.token = (cursor['epoch'], cursor['token'])
+	reply = getRemoteChanges(client, cursor)
+	remoteIndex = reply['changes']
+	cursor = {'epoch': reply['epoch'], 'seq': reply['seq'], 'token': 0}
 
-	mergeCloudToLocal(client, localIndex, remoteIndex, basedir)
-	mergeLocalToCloud(client, localIndex, basedir, blocksize, remoteIndex)
-	dumpLocalIndex(localIndex, basedir)
+	mergeCloudToLocal(client, localIndex, remoteIndex, basedir, blocksize, pool)
+	mergeLocalToCloud(client, localIndex, basedir, blocksize, cursor['seq'], pool, stats)
+	if sharded and client.token is not None and client.token[0] == cursor['epoch'] and client.token[1] > cursor['seq']:
+		cursor['token'] = client.token[1]
+	dumpLocalIndex(localIndex, basedir, stats, cursor)
 
 if __name__ == "__main__":
 
@@ -154,16 +1085,41 @@ if __name__ == "__main__":
 	parser.add_argument('hostport', help='host:port of the server')
 	parser.add_argument('basedir', help='The base directory')
 	parser.add_argument('blocksize', type=int, help='Block size')
+	parser.add_argument('--batchbytes', type=int, default=batchBytes, help='Byte budget of a single block transfer call')
+	parser.add_argument('--parallelism', type=int, default=4, help='Number of concurrent block transfers')
+	parser.add_argument('--hashworkers', type=int, default=hashWorkers, help='Number of threads hashing files')
+	parser.add_argument('--chunking', choices=['fixed', 'cdc'], default=chunking,
+		help='Cut files every `blocksize` bytes, or into content-defined chunks averaging `blocksize` bytes')
+	parser.add_argument('--protocol', choices=['binary', 'xmlrpc'], default=protocol,
+		help='Send blocks as raw bytes when the server supports it, or always as XML-RPC')
+	parser.add_argument('--indexformat', choices=['binary', 'text'], default=indexFormat,
+		help='Format index.txt is saved in')
+	parser.add_argument('--compression', choices=codec.CODECS, default=compression,
+		help='Compress uploaded blocks with this codec (binary protocol only)')
 	args = parser.parse_args()
+	batchBytes = args.batchbytes
+	hashWorkers = args.hashworkers
+	chunking = args.chunking
+	protocol = args.protocol
+	compression = args.compression
+	indexFormat = args.indexformat
 
 	try:
-		client  = xmlrpc.client.ServerProxy('http://{}'.format(args.hostport))
+		url = 'http://{}'.format(args.hostport)
+		client  = connect(url)
 		# Test ping
 		client.surfstore.ping()
 		print("Ping() successful")
 
 		print('Start Synchronization...')
-		synchronize(client, args.basedir, args.blocksize)
+		pool = TransferPool(url, args.parallelism)
+		synchronize(client, args.basedir, args.blocksize, pool)
+		pool.shutdown()
+		print('Opened {} connection(s)'.format(connectionCount))
+		if downloadStats['copied']:
+			print('Copied {copied} downloaded block(s) from local files, fetched {fetched}'.format(**downloadStats))
+		if compressionStats['blocks']:
+			print('Uploaded {blocks} block(s): {plainbytes} bytes sent as {sentbytes}'.format(**compressionStats))
 
 	except Exception as e:
 		print("Client: " + str(e))
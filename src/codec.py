@@ -0,0 +1,75 @@
+"""
+Per-block compression.
+
+Blocks are sent in the binary protocol and kept in the block store as encoded blocks:
+one byte naming the codec followed by the (possibly compressed) bytes. Each block picks
+its own codec, and is left raw when a sample of it looks incompressible or compressing
+it does not make it smaller. Blocks are still named by the hash of their plain bytes.
+"""
+import collections
+import lzma
+import math
+import zlib
+
+CODECS = ('raw', 'zlib', 'lzma')  # index = id byte
+
+# Blocks shorter than this, or whose sampled entropy is above MAX_ENTROPY bits per
+# byte, are not worth compressing
+MIN_SIZE = 64
+MAX_ENTROPY = 7.2
+SAMPLE_SIZE = 1024
+
+# Largest plain block decode() decompresses, so that a small compressed block cannot
+# expand into gigabytes; raw blocks, as long as the frame holding them, are not
+# limited, and larger blocks are left raw by encode()
+MAX_SIZE = 16 * 1024 * 1024
+
+def entropy(data):
+    """Shannon entropy, in bits per byte, of about SAMPLE_SIZE bytes spread over the data"""
+    sample = memoryview(data)[::max(1, len(data) // SAMPLE_SIZE)]
+    n = len(sample)
+    if n == 0:
+        return 0.0
+    return -sum(c / n * math.log2(c / n) for c in collections.Counter(sample).values())
+
+def encode(data, codec='raw'):
+    """Encoded form of a block, compressed with `codec` if that is worth it"""
+    if codec != 'raw' and MIN_SIZE <= len(data) <= MAX_SIZE and entropy(data) <= MAX_ENTROPY:
+        if codec == 'zlib':
+            packed = zlib.compress(data)
+        elif codec == 'lzma':
+            packed = lzma.compress(data, preset=1)
+        else:
+            raise ValueError('unknown codec: {}'.format(codec))
+        if len(packed) + 1 < len(data):
+            return bytes([CODECS.index(codec)]) + packed
+    return b'\0' + data
+
+def decode(encoded, maxSize=MAX_SIZE):
+    """
+    Plain bytes of an encoded block. Raises ValueError if it is malformed or it is
+    compressed and its plain bytes would be longer than `maxSize`.
+    """
+    if not encoded:
+        raise ValueError('empty encoded block')
+    codec, payload = encoded[0], memoryview(encoded)[1:]
+    try:
+        if codec == 0:
+            data = bytes(payload)
+        elif codec == 1:
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(payload, maxSize + 1)
+            if not decompressor.eof and len(data) <= maxSize:
+                raise ValueError('truncated block')
+        elif codec == 2:
+            decompressor = lzma.LZMADecompressor()
+            data = decompressor.decompress(payload, maxSize + 1)
+            if not decompressor.eof and len(data) <= maxSize:
+                raise ValueError('truncated block')
+        else:
+            raise ValueError('unknown codec id: {}'.format(codec))
+    except (zlib.error, lzma.LZMAError) as e:
+        raise ValueError('corrupt block: {}'.format(e))
+    if codec != 0 and len(data) > maxSize:
+        raise ValueError('block larger than {} bytes'.format(maxSize))
+    return data
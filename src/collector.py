@@ -0,0 +1,98 @@
+"""
+Garbage collection of the blocks no file version refers to any more.
+
+The MetaStore counts, for every block, the entries whose hashlist holds it, and tells
+the collector when a count drops to zero. Those blocks, and blocks stored or checked
+for while unreferenced, are candidates, oldest first. A background thread wakes every
+`interval` seconds and deletes at most `batch` candidates that have stayed unreferenced
+for `grace` seconds, taking the lock for one block at a time, so requests are never
+held up behind a sweep.
+
+The grace period covers a client's upload: its blocks are stored (or found by
+hasblocks) before the updatefile that refers to them. The server hold()s blocks
+before it checks for or stores them, under the same lock a sweep deletes under, so a
+block reported as stored is kept for at least `grace` seconds. An upload can still
+take longer than that, so updatefile holds and checks the blocks of the new version
+too, and refuses it with a MISSING_BLOCKS fault if some are gone; the client then
+uploads them again.
+"""
+import threading
+import time
+import xmlrpc.client
+from collections import OrderedDict
+
+# Fault code of an updatefile referring to blocks the server does not have
+MISSING_BLOCKS = 13
+
+class BlockCollector:
+    def __init__(self, store, meta, grace=60.0, interval=1.0, batch=1000):
+        self.store = store
+        self.meta = meta
+        self.grace = grace
+        self.interval = interval
+        self.batch = batch
+        self.lock = threading.Lock()
+        self.candidates = OrderedDict()  # hashvalue -> when it was last seen unreferenced, oldest first
+        self.reclaimedBlocks = 0
+        self.reclaimedBytes = 0
+        now = time.monotonic()
+        for h in store.keys():
+            if not meta.referenced(h):
+                self.candidates[h] = now
+        meta.onRelease = self.touch
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def touch(self, h):
+        """Note that a block was just released by the metadata"""
+        self.hold([h])
+
+    def hold(self, hashes):
+        """
+        Restart the grace period of the unreferenced blocks among `hashes`, which a
+        client is about to check for, store or commit. Call before looking at the store.
+        """
+        now = time.monotonic()
+        with self.lock:
+            for h in hashes:
+                if h in self.candidates or not self.meta.referenced(h):
+                    self.candidates[h] = now
+                    self.candidates.move_to_end(h)
+
+    def checkBlocks(self, hashes):
+        """Hold `hashes` and raise MISSING_BLOCKS unless all of them are stored"""
+        hashes = set(hashes)
+        self.hold(hashes)
+        missing = [h for h in hashes if not self.store.has(h)]
+        if missing:
+            raise xmlrpc.client.Fault(MISSING_BLOCKS, ' '.join(sorted(missing)))
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.sweep()
+
+    def sweep(self):
+        """Delete up to `batch` blocks unreferenced for `grace` seconds. Returns how many."""
+        deleted = 0
+        for _ in range(self.batch):
+            with self.lock:
+                if not self.candidates:
+                    break
+                h, since = next(iter(self.candidates.items()))
+                if time.monotonic() - since < self.grace:
+                    break
+                del self.candidates[h]
+                if self.meta.referenced(h):
+                    continue
+                size = self.store.delete(h)
+            if size is not None:
+                deleted += 1
+                with self.lock:
+                    self.reclaimedBlocks += 1
+                    self.reclaimedBytes += size
+        return deleted
+
+    def stats(self):
+        with self.lock:
+            return dict(gcreclaimedblocks=self.reclaimedBlocks, gcreclaimedbytes=self.reclaimedBytes,
+                        gccandidates=len(self.candidates))
@@ -0,0 +1,222 @@
+"""
+Binary format of the local index.
+
+The text index spells every hash value in 64 hex characters and is rewritten whole
+on every sync. This format stores raw 32-byte digests in one record per file, and a
+sync only appends the records of the files that changed:
+
+    header:  MAGIC, cursor epoch (32 bytes, ascii, zero padded), seq, token (8 bytes each)
+    record:  kind, name length, stat length, version, digest count (RECORD), then the
+             name (utf-8), the stat key (ascii `size:mtime_ns:inode:chunkspec`, may be
+             empty) and the digests
+
+A later record of a file replaces the earlier ones, and a REMOVED record drops it.
+The hashlist [0] of a deleted file is stored as DELETED digests. The header is
+rewritten in place once the appended records are fsynced, so a crash in between
+leaves an older cursor, and a record torn by a crash at the end of the file is ignored. Once
+replaced records take up more than half of the file, it is compacted: written out
+whole to a temporary file, which is then renamed over it.
+
+All integers are big-endian. Files without MAGIC are text indexes (see
+client.parseIndexFile), read once and replaced by this format on the next save.
+"""
+import contextlib
+import mmap
+import os
+import struct
+
+MAGIC = b'SURFIDX1'
+HEADER = struct.Struct('>8s32sQQ')
+RECORD = struct.Struct('>BHHQI')
+ENTRY = 1
+REMOVED = 2
+DELETED = 0xFFFFFFFF
+DIGEST_SIZE = 32
+
+def isBinary(path):
+	try:
+		with open(path, 'rb') as f:
+			return f.read(len(MAGIC)) == MAGIC
+	except FileNotFoundError:
+		return False
+
+def packHeader(cursor):
+	cursor = cursor or {}
+	return HEADER.pack(MAGIC, cursor.get('epoch', '').encode('ascii'), cursor.get('seq', 0), cursor.get('token', 0))
+
+def packRecord(fname, version, hashlist, statKey=None):
+	name = fname.encode()
+	stat = ':'.join(map(str, statKey)).encode('ascii') if statKey else b''
+	if hashlist == [0]:
+		return RECORD.pack(ENTRY, len(name), len(stat), version, DELETED) + name + stat
+	return RECORD.pack(ENTRY, len(name), len(stat), version, len(hashlist)) + name + stat + bytes.fromhex(''.join(hashlist))
+
+def packRemoved(fname):
+	name = fname.encode()
+	return RECORD.pack(REMOVED, len(name), 0, 0, 0) + name
+
+def scan(view):
+	"""
+	Yield (offset, end, kind, fname, version, stat, digests) for each whole record after
+	the header, where `digests` is a slice of `view` (None for a deleted file).
+	"""
+	off = HEADER.size
+	while off + RECORD.size <= len(view):
+		kind, nameLen, statLen, version, count = RECORD.unpack_from(view, off)
+		start = off + RECORD.size
+		digestsAt = start + nameLen + statLen
+		end = digestsAt + (0 if count == DELETED else count * DIGEST_SIZE)
+		if kind not in (ENTRY, REMOVED) or end > len(view):
+			return
+		fname = bytes(view[start:start + nameLen]).decode()
+		stat = bytes(view[start + nameLen:digestsAt]).decode('ascii')
+		digests = None if count == DELETED else view[digestsAt:end]
+		yield off, end, kind, fname, version, stat, digests
+		off = end
+
+def hexList(digests):
+	if digests is None:
+		return [0]
+	if not digests:
+		return []
+	# One hex string with a space between digests, split in C
+	return digests.hex(' ', DIGEST_SIZE).split(' ')
+
+def parseStat(stat):
+	size, mtime, ino, spec = stat.split(':', 3)
+	return int(size), int(mtime), int(ino), spec
+
+class IndexFile:
+	"""
+	A binary index at `path`. load() reads it, save() writes it back; the records on
+	disk are remembered between the two, so that save() appends only what changed.
+	"""
+	def __init__(self, path, useMmap=True):
+		self.path = path
+		self.useMmap = useMmap
+		self.saved = None  # fname -> (version, hashlist, stat key) as on disk, None if not loaded
+		self.sizes = {}  # fname -> size of its current record
+		self.end = 0  # offset after the last whole record
+
+	def live(self):
+		"""Bytes of the file still in use"""
+		return HEADER.size + sum(self.sizes.values())
+
+	@contextlib.contextmanager
+	def contents(self):
+		"""A memoryview of the file, mapped if useMmap. Slices of it must not outlive the block."""
+		with open(self.path, 'rb') as f:
+			if self.useMmap and os.fstat(f.fileno()).st_size > 0:
+				buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			else:
+				buf = f.read()
+		try:
+			with memoryview(buf) as view:
+				if len(view) < HEADER.size or bytes(view[:len(MAGIC)]) != MAGIC:
+					raise ValueError('not a binary index: {}'.format(self.path))
+				yield view
+		finally:
+			if isinstance(buf, mmap.mmap):
+				buf.close()
+
+	def load(self, stats=None, cursor=None):
+		"""
+		Read the index into a dict fname -> [version, hashlist], with the stat keys into
+		`stats` and the header into `cursor` if given.
+		"""
+		entries = {}
+		saved = {}
+		sizes = {}
+		end = HEADER.size
+		with self.contents() as view:
+			_, epoch, seq, token = HEADER.unpack_from(view, 0)
+			for off, end, kind, fname, version, stat, digests in scan(view):
+				if kind == REMOVED:
+					entries.pop(fname, None)
+					saved.pop(fname, None)
+					sizes.pop(fname, None)
+					continue
+				hashlist = hexList(digests)
+				statKey = parseStat(stat) if stat else None
+				entries[fname] = [version, hashlist]
+				saved[fname] = (version, hashlist, statKey)
+				sizes[fname] = end - off
+			digests = None
+		if cursor is not None:
+			cursor['epoch'], cursor['seq'], cursor['token'] = epoch.rstrip(b'\0').decode('ascii'), seq, token
+		if stats is not None:
+			stats.update((fname, statKey) for fname, (_, _, statKey) in saved.items() if statKey)
+		self.saved = saved
+		self.sizes = sizes
+		self.end = end
+		return entries
+
+	def lookup(self, fname):
+		"""
+		[version, hashlist] of one file (or None), read straight from the mapped file
+		without loading the rest of the index.
+		"""
+		found = None
+		with self.contents() as view:
+			for _, _, kind, name, version, _, digests in scan(view):
+				if name == fname:
+					found = None if kind == REMOVED else [version, hexList(digests)]
+			digests = None
+		return found
+
+	def save(self, entries, stats=None, cursor=None):
+		"""
+		Write `entries` (fname -> [version, hashlist]) with their stat keys and the cursor.
+		Appends the records of the changed files if the file on disk is the one loaded
+		or saved last, and rewrites it whole otherwise or once it is mostly stale records.
+		"""
+		stats = stats or {}
+		if self.saved is None or not isBinary(self.path):
+			return self.rewrite(entries, stats, cursor)
+		records = []
+		for fname, (version, hashlist) in entries.items():
+			state = (version, hashlist, stats.get(fname))
+			if self.saved.get(fname) != state:
+				record = packRecord(fname, version, hashlist, state[2])
+				records.append(record)
+				self.saved[fname] = state
+				self.sizes[fname] = len(record)
+		for fname in [fname for fname in self.saved if fname not in entries]:
+			records.append(packRemoved(fname))
+			del self.saved[fname]
+			del self.sizes[fname]
+		appended = b''.join(records)
+		if self.end + len(appended) > 2 * self.live() + 4096:
+			return self.rewrite(entries, stats, cursor)
+		with open(self.path, 'r+b') as f:
+			f.seek(self.end)
+			f.write(appended)
+			f.truncate()
+			f.flush()
+			# The records must be on disk before a header whose cursor counts on them
+			os.fsync(f.fileno())
+			f.seek(0)
+			f.write(packHeader(cursor))
+			f.flush()
+			os.fsync(f.fileno())
+		self.end += len(appended)
+
+	def rewrite(self, entries, stats, cursor):
+		parts = [packHeader(cursor)]
+		saved = {}
+		sizes = {}
+		for fname, (version, hashlist) in entries.items():
+			statKey = stats.get(fname)
+			parts.append(packRecord(fname, version, hashlist, statKey))
+			saved[fname] = (version, hashlist, statKey)
+			sizes[fname] = len(parts[-1])
+		data = b''.join(parts)
+		tmp = self.path + '.tmp'
+		with open(tmp, 'wb') as f:
+			f.write(data)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp, self.path)
+		self.saved = saved
+		self.sizes = sizes
+		self.end = len(data)
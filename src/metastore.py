@@ -0,0 +1,345 @@
+import collections
+import json
+import os
+import threading
+import uuid
+
+class MetaStore:
+    """
+    The FileInfoMap: filename -> [version, hashlist].
+
+    Without a directory it lives in memory only. With `metadir`, every accepted update
+    is appended to a write-ahead log and fsynced before update() returns; updates that
+    arrive while an fsync is running are written and synced together by the next one
+    (group commit), so concurrent request threads share fsyncs instead of queueing on them.
+
+    The log is split into segments (wal.<n>.log). Every `snapshotEvery` updates the map
+    is written to snapshot.json and a new segment is started; segments the snapshot
+    covers are deleted. Recovery loads the snapshot and replays the later segments.
+    Replay keeps the highest version of each file, so a record present in both the
+    snapshot and a segment is harmless.
+
+    Every accepted update gets the next number of a store-wide change sequence, which
+    lets clients ask for just the entries changed since they last looked (changes()).
+    Sequence numbers are only comparable within one `epoch`: a store that loses its
+    history (in-memory, or a wiped metadir) starts a new epoch.
+
+    Readers (getmap(), changes()) only see the changes up to `visible()`, the last
+    sequence number whose log record is on disk: a sequence number handed out is never
+    lost, and so never reused, by a crash. While a file's newer records are being
+    synced, readers get its last durable entry, kept in `pending`.
+
+    Concurrency: the version check of update() holds one of `stripes` locks picked by
+    filename, so updates to different files do not wait on each other there; `cond`
+    is only held briefly to number the change and queue its log record. Entries are
+    replaced, never mutated, and `meta` and `pending` are only written under `cond`,
+    so get() and getmap() read without taking any lock.
+
+    `refs` counts the entries whose hashlist holds each block. When a block's count
+    drops to zero, `onRelease` (if set) is called with its hash value, with `cond` held;
+    see collector.py.
+    """
+
+    STRIPES = 64
+
+    def __init__(self, metadir=None, snapshotEvery=10000):
+        self.meta = dict()  # filename -> [version, [hashval1, hashval2, hashval3]]
+        self.seqs = dict()  # filename -> sequence number of its last change, in increasing order
+        self.seq = 0
+        self.pending = dict()  # filename -> (last durable entry or None, its sequence number), while a newer one is synced
+        self.epoch = uuid.uuid4().hex
+        self.refs = collections.Counter()  # hashvalue -> number of entries holding it
+        self.onRelease = None
+        self.cond = threading.Condition()
+        self.stripes = [threading.Lock() for _ in range(self.STRIPES)]
+        self.metadir = metadir
+        self.snapshotEvery = snapshotEvery
+        self.log = None
+        if metadir is None:
+            return
+
+        self.buffer = []  # log lines not written yet
+        self.appended = 0  # number of records appended to the log
+        self.durable = 0  # number of records known to be on disk
+        self.flushing = False
+        self.compacting = False
+        self.sinceSnapshot = 0
+        os.makedirs(metadir, exist_ok=True)
+        self.epoch = self.loadEpoch()
+        self.segment = self.recover()
+        self.baseSeq = self.seq  # record n appended from now on is change baseSeq + n
+        self.log = open(self.segmentPath(self.segment), 'a')
+
+    def segmentPath(self, n):
+        return os.path.join(self.metadir, 'wal.{}.log'.format(n))
+
+    def segments(self):
+        """Numbers of the log segments on disk, in order"""
+        nums = []
+        for name in os.listdir(self.metadir):
+            if name.startswith('wal.') and name.endswith('.log'):
+                nums.append(int(name[4:-4]))
+        return sorted(nums)
+
+    def loadEpoch(self):
+        path = os.path.join(self.metadir, 'epoch')
+        if not os.path.exists(path):
+            with open(path + '.tmp', 'w') as f:
+                f.write(self.epoch)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+        with open(path) as f:
+            return f.read().strip()
+
+    def reference(self, old, new):
+        """Move the references of an entry from hashlist `old` to `new`. Called with self.cond held."""
+        old, new = set(old) - {0}, set(new) - {0}
+        for h in new - old:
+            self.refs[h] += 1
+        for h in old - new:
+            self.refs[h] -= 1
+            if self.refs[h] <= 0:
+                del self.refs[h]
+                if self.onRelease is not None:
+                    self.onRelease(h)
+
+    def referenced(self, h):
+        return self.refs.get(h, 0) > 0
+
+    def apply(self, filename, version, blocklist, seq):
+        finfo = self.meta.get(filename, [0, []])
+        if version > finfo[0]:
+            self.reference(finfo[1], blocklist)
+            self.meta[filename] = [version, blocklist]
+            self.seqs.pop(filename, None)
+            self.seqs[filename] = seq
+            self.seq = max(self.seq, seq)
+
+    def recover(self):
+        """
+        Rebuild the map from the snapshot and the log, and return the number of the
+        segment to append to. A new segment is always started, so a record torn by a
+        crash at the end of the last segment is never appended to.
+        """
+        first = 0
+        path = os.path.join(self.metadir, 'snapshot.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                snapshot = json.load(f)
+            first = snapshot['segment']
+            entries = sorted(snapshot['meta'].items(), key=lambda item: item[1][2])
+            for filename, (version, blocklist, seq) in entries:
+                self.apply(filename, version, blocklist, seq)
+
+        nums = [n for n in self.segments() if n >= first]
+        for n in nums:
+            with open(self.segmentPath(n)) as f:
+                for line in f:
+                    try:
+                        filename, version, blocklist, seq = json.loads(line)
+                    except ValueError:
+                        # Torn write at the end of the log
+                        break
+                    self.apply(filename, version, blocklist, seq)
+                    self.sinceSnapshot += 1
+        return max(nums + [first]) + 1
+
+    def visible(self):
+        """The last sequence number readers may see. Called with self.cond held."""
+        if self.log is None:
+            return self.seq
+        return self.baseSeq + self.durable
+
+    def state(self):
+        """The map as filename -> [version, hashlist, sequence number], for a snapshot"""
+        with self.cond:
+            return {fname: [finfo[0], finfo[1], self.seqs[fname]] for fname, finfo in self.meta.items()}
+
+    def loadState(self, epoch, seq, state):
+        """Replace the whole map with a state() of epoch `epoch` ending at sequence number `seq`"""
+        with self.cond:
+            for finfo in self.meta.values():
+                self.reference(finfo[1], [])
+            self.meta = dict()
+            self.seqs = dict()
+            for filename, (version, blocklist, fseq) in sorted(state.items(), key=lambda item: item[1][2]):
+                self.apply(filename, version, blocklist, fseq)
+            self.seq = seq
+            self.epoch = epoch
+            self.cond.notify_all()
+
+    def getmap(self):
+        # `meta` is copied first: an entry that is newer than the copy of `pending`
+        # says was put in `pending` before it was put in `meta`
+        meta = self.meta.copy()
+        for fname, (finfo, _) in self.pending.copy().items():
+            if finfo is None:
+                meta.pop(fname, None)
+            else:
+                meta[fname] = finfo
+        return meta
+
+    def get(self, filename):
+        return self.meta.get(filename)
+
+    def changes(self, since, wait=0):
+        """
+        Returns (epoch, seq, changes): the end of the visible change sequence, and the
+        entries changed after sequence number `since` as filename -> [version, hashlist].
+        If there are none, waits up to `wait` seconds for one.
+        """
+        with self.cond:
+            if wait > 0:
+                self.cond.wait_for(lambda: self.visible() > since, wait)
+            visible = self.visible()
+            changes = {}
+            for filename in reversed(self.seqs):
+                if self.seqs[filename] > visible:
+                    # `since` is at most `visible`, so every pending file is met before the loop stops
+                    finfo, seq = self.pending[filename]
+                    if finfo is not None and seq > since:
+                        changes[filename] = [finfo[0], finfo[1]]
+                    continue
+                if self.seqs[filename] <= since:
+                    break
+                finfo = self.meta[filename]
+                changes[filename] = [finfo[0], finfo[1]]
+            return self.epoch, visible, changes
+
+    def mirror(self, epoch, seq, changes):
+        """
+        Apply a changes() reply of another store, to follow it. A reply from another
+        epoch than this store's must cover every entry (since 0): it replaces them all.
+        Every entry is numbered `seq`, the end of the reply, since the sequence numbers
+        of single entries are not in it; a later changes() may return one needlessly.
+        """
+        with self.cond:
+            if epoch != self.epoch:
+                for finfo in self.meta.values():
+                    self.reference(finfo[1], [])
+                self.meta = dict()
+                self.seqs = dict()
+                self.seq = 0
+                self.epoch = epoch
+            for filename, (version, blocklist) in changes.items():
+                self.apply(filename, version, blocklist, seq)
+            self.seq = max(self.seq, seq)
+            self.cond.notify_all()
+
+    def update(self, filename, version, blocklist):
+        """
+        Set a file's entry if `version` is exactly one more than the current version.
+        Returns whether the update was applied; an applied update is durable once this returns.
+        """
+        return self.updateMany([(filename, version, blocklist)])[0]
+
+    def updateMany(self, entries):
+        """
+        update() a list of (filename, version, blocklist) entries, each on its own.
+        Returns whether each was applied; the applied ones are logged and synced together.
+        """
+        results = []
+        record = 0
+        for filename, version, blocklist in entries:
+            with self.stripes[hash(filename) % self.STRIPES]:
+                finfo = self.meta.get(filename, [0, []])  # Check if the initiation of a new file is correct!
+                if finfo[0] + 1 != version:
+                    results.append(False)
+                    continue
+                with self.cond:
+                    self.reference(finfo[1], blocklist)
+                    if self.log is not None and filename not in self.pending:
+                        self.pending[filename] = (self.meta.get(filename), self.seqs.get(filename, 0))
+                    self.meta[filename] = [version, blocklist]
+                    self.seq += 1
+                    self.seqs.pop(filename, None)
+                    self.seqs[filename] = self.seq
+                    self.cond.notify_all()
+                    if self.log is not None:
+                        self.buffer.append(json.dumps([filename, version, blocklist, self.seq]) + '\n')
+                        self.appended += 1
+                        record = self.appended
+            results.append(True)
+        if self.log is None or not record:
+            return results
+
+        # The next update of a file may be checked while this one is being synced:
+        # its record is queued after this one, so it can never be durable before it
+        with self.cond:
+            self.sync(record)
+            self.sinceSnapshot += results.count(True)
+            compact = self.sinceSnapshot >= self.snapshotEvery and not self.compacting
+            if compact:
+                self.compacting = True
+        if compact:
+            self.snapshot()
+        return results
+
+    def sync(self, seq):
+        """
+        Wait until the first `seq` records are on disk, writing and fsyncing every
+        buffered record if no other thread is doing so. Called with self.cond held.
+        """
+        while self.durable < seq:
+            if self.flushing:
+                self.cond.wait()
+                continue
+            self.flushing = True
+            batch, self.buffer = self.buffer, []
+            target = self.appended
+            log = self.log
+            self.cond.release()
+            try:
+                log.write(''.join(batch))
+                log.flush()
+                os.fsync(log.fileno())
+            finally:
+                self.cond.acquire()
+                self.flushing = False
+                self.cond.notify_all()
+            self.durable = max(self.durable, target)
+            visible = self.visible()
+            for filename in [f for f in self.pending if self.seqs[f] <= visible]:
+                del self.pending[filename]
+
+    def snapshot(self):
+        """
+        Write the current map to snapshot.json and drop the log segments it covers.
+        """
+        with self.cond:
+            while self.flushing:
+                self.cond.wait()
+            # Records buffered now are in the copy; they will also be written to the
+            # new segment, which replay tolerates
+            meta = {fname: [finfo[0], finfo[1], self.seqs[fname]] for fname, finfo in self.meta.items()}
+            self.log.close()
+            self.segment += 1
+            self.log = open(self.segmentPath(self.segment), 'a')
+            self.sinceSnapshot = 0
+            segment = self.segment
+
+        try:
+            path = os.path.join(self.metadir, 'snapshot.json')
+            with open(path + '.tmp', 'w') as f:
+                json.dump({'segment': segment, 'meta': meta}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+            dirfd = os.open(self.metadir, os.O_RDONLY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+            for n in self.segments():
+                if n < segment:
+                    os.unlink(self.segmentPath(n))
+        finally:
+            with self.cond:
+                self.compacting = False
+
+    def close(self):
+        if self.log is not None:
+            with self.cond:
+                self.sync(self.appended)
+                self.log.close()
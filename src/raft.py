@@ -0,0 +1,614 @@
+"""
+Raft replication of the metadata store across several server processes.
+
+Every metadata change is a log entry [term, updates], where updates is a list of
+[filename, version, blocklist] as taken by MetaStore.updateMany(). The leader appends
+entries, replicates them to the other nodes with AppendEntries, and once a majority
+holds an entry it is committed and applied, in log order, to each node's MetaStore.
+Version checks happen when an entry is applied, so every node reaches the same answer.
+
+Replication runs on one thread per peer that streams whatever the peer is missing:
+all entries appended while an AppendEntries call is in flight go out together in the
+next one (up to `maxBatch`), so concurrent updates share round trips the way the
+write-ahead log shares fsyncs, and a slow peer does not hold back the others.
+
+With `raftdir`, the term and vote are written to raft.state, and log entries are
+appended to a log split into segments (raft.<n>.log), before a node answers a call
+that counts on them. As in the MetaStore's log, records queued while an fsync is
+running are written and synced together by the next one, and a leader only counts
+itself towards a majority for the entries it has synced. Without `raftdir` all of it
+is kept in memory.
+
+Every `snapshotEvery` applied entries, the MetaStore's state() becomes the snapshot
+(also written to raft.snapshot.json with `raftdir`), and the entries it covers are
+dropped from the log; a peer that still needs them is sent the snapshot instead
+(InstallSnapshot). A restarted node loads the snapshot and replays the later segments.
+
+The epoch of the change sequence (see MetaStore.changes()) is the cluster's: a leader
+puts its store's epoch in the entry starting its term until one has been applied, and
+every node takes the epoch of the first such entry it applies. Since every node
+applies the same entries in the same order, a client's cursor is as good on the next
+leader.
+
+crash() and restore() simulate failures: a crashed node answers every call but
+isleader/iscrashed/crash/restore with a Fault and sends nothing.
+"""
+import json
+import os
+import random
+import threading
+import time
+import xmlrpc.client
+
+# Fault codes of the calls a node cannot serve (the dispatcher reports other errors
+# as 1); the fault string is the URL of the node believed to be the leader, or empty
+NOT_LEADER = 10
+CRASHED = 11
+
+class PeerTransport(xmlrpc.client.Transport):
+    """Keep-alive transport giving up on an unresponsive peer after `timeout` seconds"""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        conn = super().make_connection(host)
+        conn.timeout = self.timeout
+        return conn
+
+def peerProxy(url, timeout):
+    return xmlrpc.client.ServerProxy(url, transport=PeerTransport(timeout))
+
+class RaftNode:
+    heartbeat = 0.05  # seconds between AppendEntries to an idle peer
+    electionTimeout = (0.3, 0.6)  # range of the random wait for a leader before calling an election
+    rpcTimeout = 2.0
+    maxBatch = 1000  # entries per AppendEntries call
+
+    def __init__(self, url, peers, meta, raftdir=None, snapshotEvery=10000):
+        self.url = url
+        self.peers = list(peers)
+        self.meta = meta
+        self.raftdir = raftdir
+        self.snapshotEvery = snapshotEvery
+        self.cond = threading.Condition()
+        # Held while the MetaStore changes, and while a snapshot is saved; both are taken before `cond`
+        self.applyLock = threading.Lock()
+        self.snapshotLock = threading.Lock()
+        self.term = 0
+        self.votedFor = None
+        # self.log[i] is entry logStart + i: entry logStart is the last one in the
+        # snapshot, or a sentinel at 0, so entries are numbered from 1
+        self.log = [[0, []]]
+        self.logStart = 0
+        self.snapshot = None  # {'index', 'term', 'epoch', 'seq', 'meta'} of the entries up to logStart
+        self.epoch = None  # the cluster's epoch, once an entry carrying one is applied
+        self.commitIndex = 0
+        self.lastApplied = 0
+        self.role = 'follower'
+        self.leader = ''
+        self.crashed = False
+        self.deadline = self.newDeadline()
+        self.leaderStart = 0  # index of the first entry of this node's term as leader
+        self.durableIndex = 0  # the last entry of this node's term as leader on disk here
+        self.nextIndex = {}
+        self.matchIndex = {}
+        self.lastContact = {}  # peer -> time of its last reply to this leader
+        self.results = {}  # index -> (term, updateMany() results), for the calls waiting on them
+        self.compacting = False
+
+        self.logFile = None
+        self.buffer = []  # log records not written yet
+        self.appended = 0  # number of log records queued
+        self.durable = 0  # number of log records known to be on disk
+        self.flushing = False
+        if raftdir is not None:
+            os.makedirs(raftdir, exist_ok=True)
+            self.recover()
+
+        threading.Thread(target=self.tick, daemon=True).start()
+        threading.Thread(target=self.apply, daemon=True).start()
+        for peer in self.peers:
+            threading.Thread(target=self.replicate, args=(peer,), daemon=True).start()
+
+    def newDeadline(self):
+        return time.monotonic() + random.uniform(*self.electionTimeout)
+
+    def majority(self, count):
+        return count > (len(self.peers) + 1) // 2
+
+    def lastIndex(self):
+        return self.logStart + len(self.log) - 1
+
+    def termAt(self, index):
+        return self.log[index - self.logStart][0]
+
+    def checkAlive(self):
+        if self.crashed:
+            raise xmlrpc.client.Fault(CRASHED, self.leader)
+
+    def becomeFollower(self, term):
+        """Called with self.cond held"""
+        if term > self.term:
+            self.term = term
+            self.votedFor = None
+            self.saveState()
+        self.role = 'follower'
+        self.cond.notify_all()
+
+    # Persistence
+
+    def path(self, name):
+        return os.path.join(self.raftdir, name)
+
+    def segmentPath(self, n):
+        return self.path('raft.{}.log'.format(n))
+
+    def segments(self):
+        """Numbers of the log segments on disk, in order"""
+        nums = []
+        for name in os.listdir(self.raftdir):
+            if name.startswith('raft.') and name.endswith('.log'):
+                nums.append(int(name[5:-4]))
+        return sorted(nums)
+
+    def writeFile(self, name, data):
+        """Replace a file of `raftdir` with `data` as JSON, durably"""
+        path = self.path(name)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        dirfd = os.open(self.raftdir, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+    def saveState(self):
+        """Write the term and vote to disk. Called with self.cond held."""
+        if self.raftdir is not None:
+            self.writeFile('raft.state', {'term': self.term, 'votedFor': self.votedFor})
+
+    def recover(self):
+        """
+        Load the term, vote and snapshot, and replay the log segments after it. A new
+        segment is always started, so a record torn by a crash is never appended to.
+        """
+        if os.path.exists(self.path('raft.state')):
+            with open(self.path('raft.state')) as f:
+                state = json.load(f)
+            self.term, self.votedFor = state['term'], state['votedFor']
+        first = 0
+        if os.path.exists(self.path('raft.snapshot.json')):
+            with open(self.path('raft.snapshot.json')) as f:
+                snapshot = json.load(f)
+            first = snapshot.pop('segment')
+            self.installState(snapshot)
+
+        nums = [n for n in self.segments() if n >= first]
+        for n in nums:
+            with open(self.segmentPath(n)) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Torn write at the end of the segment
+                        break
+                    # A record replaces the entry at its index and every entry after it
+                    index = record[0]
+                    if index > self.logStart:
+                        del self.log[index - self.logStart:]
+                        self.log.append(record[1:])
+        self.segment = max(nums + [first]) + 1
+        self.logFile = open(self.segmentPath(self.segment), 'a')
+
+    def record(self, index):
+        """Queue the log record of entry `index`. Called with self.cond held."""
+        self.appended += 1
+        if self.logFile is None:
+            self.durable = self.appended
+            self.durableIndex = index
+        else:
+            self.buffer.append(json.dumps([index] + self.log[index - self.logStart]) + '\n')
+
+    def sync(self, count):
+        """
+        Wait until the first `count` queued records are on disk, writing and fsyncing
+        every queued record if no other thread is doing so. Called with self.cond held.
+        """
+        while self.durable < count:
+            if self.flushing:
+                self.cond.wait()
+                continue
+            self.flushing = True
+            batch, self.buffer = self.buffer, []
+            target = self.appended
+            # A leader's log only grows during its term, so every entry up to here is in the batch or before it
+            term = self.term
+            upto = self.lastIndex() if self.role == 'leader' else 0
+            logFile = self.logFile
+            self.cond.release()
+            try:
+                logFile.write(''.join(batch))
+                logFile.flush()
+                os.fsync(logFile.fileno())
+            finally:
+                self.cond.acquire()
+                self.flushing = False
+                self.cond.notify_all()
+            self.durable = max(self.durable, target)
+            if self.role == 'leader' and self.term == term:
+                self.durableIndex = max(self.durableIndex, upto)
+        if self.role == 'leader':
+            self.advanceCommit()
+
+    def flush(self):
+        with self.cond:
+            self.sync(self.appended)
+
+    def startSegment(self):
+        """
+        Continue the log in a new segment, which the entries after logStart are queued
+        to again, so that the older segments can be deleted once a snapshot up to
+        logStart is on disk. Returns its number. Called with self.cond held.
+        """
+        if self.logFile is None:
+            return None
+        while self.flushing:
+            self.cond.wait()
+        self.logFile.close()
+        self.segment += 1
+        self.logFile = open(self.segmentPath(self.segment), 'a')
+        # Records still buffered are of entries queued here again, or since replaced
+        self.buffer = []
+        for index in range(self.logStart + 1, self.lastIndex() + 1):
+            self.buffer.append(json.dumps([index] + self.log[index - self.logStart]) + '\n')
+        # So that the next sync() writes them
+        self.appended += 1
+        return self.segment
+
+    def writeSnapshot(self, snapshot, segment):
+        """Write `snapshot`, which log segment `segment` follows, and delete the segments before it"""
+        if self.raftdir is None:
+            return
+        self.writeFile('raft.snapshot.json', dict(snapshot, segment=segment))
+        with self.cond:
+            # The entries queued to the new segment must be on disk before the old ones go
+            self.sync(self.appended)
+        for n in self.segments():
+            if n < segment:
+                os.unlink(self.segmentPath(n))
+
+    # Snapshots
+
+    def installState(self, snapshot):
+        """
+        Make `snapshot` the state of the MetaStore and the start of the log, keeping the
+        entries after it if the log holds its last entry. Called with self.applyLock and
+        self.cond held (or before the threads start).
+        """
+        index = snapshot['index']
+        if self.logStart <= index <= self.lastIndex() and self.termAt(index) == snapshot['term']:
+            self.log = self.log[index - self.logStart:]
+        else:
+            self.log = [None]
+        self.log[0] = [snapshot['term'], []]
+        self.logStart = index
+        self.commitIndex = max(self.commitIndex, index)
+        self.lastApplied = index
+        self.snapshot = snapshot
+        self.epoch = snapshot['epoch']
+        self.meta.loadState(snapshot['epoch'] or self.meta.epoch, snapshot['seq'], snapshot['meta'])
+
+    def compact(self, snapshot):
+        """Drop the entries `snapshot` covers from the log, and save it"""
+        try:
+            with self.snapshotLock:
+                with self.cond:
+                    index = snapshot['index']
+                    if index <= self.logStart:
+                        # A newer snapshot was installed meanwhile
+                        return
+                    self.log = self.log[index - self.logStart:]
+                    self.log[0] = [snapshot['term'], []]
+                    self.logStart = index
+                    self.snapshot = snapshot
+                    segment = self.startSegment()
+                self.writeSnapshot(snapshot, segment)
+        finally:
+            with self.cond:
+                self.compacting = False
+
+    def installSnapshot(self, term, leader, snapshot):
+        with self.applyLock, self.snapshotLock:
+            with self.cond:
+                self.checkAlive()
+                if term < self.term:
+                    return {'term': self.term, 'success': False, 'next': 0}
+                self.becomeFollower(term)
+                self.leader = leader
+                self.deadline = self.newDeadline()
+                if snapshot['index'] <= self.lastApplied:
+                    return {'term': self.term, 'success': True, 'next': snapshot['index'] + 1}
+                self.installState(snapshot)
+                self.cond.notify_all()
+                segment = self.startSegment()
+            self.writeSnapshot(snapshot, segment)
+            with self.cond:
+                return {'term': self.term, 'success': self.term == term, 'next': snapshot['index'] + 1}
+
+    # Elections
+
+    def tick(self):
+        while True:
+            with self.cond:
+                wait = self.heartbeat
+                if self.role != 'leader' and not self.crashed:
+                    wait = self.deadline - time.monotonic()
+                    if wait <= 0:
+                        self.startElection()
+                        continue
+            time.sleep(min(wait, self.heartbeat))
+
+    def startElection(self):
+        """Called with self.cond held"""
+        self.role = 'candidate'
+        self.term += 1
+        self.votedFor = self.url
+        self.saveState()
+        self.deadline = self.newDeadline()
+        votes = [self.url]
+        term = self.term
+        lastIndex = self.lastIndex()
+        lastTerm = self.log[-1][0]
+        if self.majority(len(votes)):
+            self.becomeLeader()
+            return
+
+        def ask(peer):
+            try:
+                reply = peerProxy(peer, self.electionTimeout[0]).surfstore.requestvote(term, self.url, lastIndex, lastTerm)
+            except (OSError, xmlrpc.client.Error):
+                return
+            with self.cond:
+                if reply['term'] > self.term:
+                    self.becomeFollower(reply['term'])
+                elif reply['granted'] and self.role == 'candidate' and self.term == term and not self.crashed:
+                    votes.append(peer)
+                    if self.majority(len(votes)):
+                        self.becomeLeader()
+
+        for peer in self.peers:
+            threading.Thread(target=ask, args=(peer,), daemon=True).start()
+
+    def becomeLeader(self):
+        """Called with self.cond held"""
+        self.role = 'leader'
+        self.leader = self.url
+        now = time.monotonic()
+        for peer in self.peers:
+            self.nextIndex[peer] = self.lastIndex() + 1
+            self.matchIndex[peer] = 0
+            self.lastContact[peer] = now
+        # An entry of its own term lets the leader commit, and then serve, everything before it
+        entry = [self.term, []]
+        if self.epoch is None:
+            entry.append(self.meta.epoch)
+        self.log.append(entry)
+        self.leaderStart = self.lastIndex()
+        self.durableIndex = self.leaderStart - 1
+        self.record(self.leaderStart)
+        self.advanceCommit()
+        self.cond.notify_all()
+        if self.logFile is not None:
+            threading.Thread(target=self.flush, daemon=True).start()
+
+    def requestVote(self, term, candidate, lastIndex, lastTerm):
+        with self.cond:
+            self.checkAlive()
+            if term > self.term:
+                self.becomeFollower(term)
+            upToDate = (lastTerm, lastIndex) >= (self.log[-1][0], self.lastIndex())
+            granted = term == self.term and self.votedFor in (None, candidate) and upToDate
+            if granted:
+                if self.votedFor != candidate:
+                    self.votedFor = candidate
+                    self.saveState()
+                self.deadline = self.newDeadline()
+            return {'term': self.term, 'granted': granted}
+
+    # Log replication
+
+    def replicate(self, peer):
+        proxy = peerProxy(peer, self.rpcTimeout)
+        lastSent = 0
+        while True:
+            with self.cond:
+                while True:
+                    if self.role == 'leader' and not self.crashed:
+                        wait = lastSent + self.heartbeat - time.monotonic()
+                        if self.nextIndex[peer] <= self.lastIndex() or wait <= 0:
+                            break
+                    else:
+                        wait = None
+                    self.cond.wait(wait)
+                term = self.term
+                prevIndex = self.nextIndex[peer] - 1
+                # The entries the peer needs next may have been compacted into the snapshot
+                snapshot = self.snapshot if prevIndex < self.logStart else None
+                if snapshot is None:
+                    prevTerm = self.termAt(prevIndex)
+                    start = prevIndex + 1 - self.logStart
+                    entries = self.log[start:start + self.maxBatch]
+                commitIndex = self.commitIndex
+                lastSent = time.monotonic()
+            try:
+                if snapshot is None:
+                    reply = proxy.surfstore.appendentries(term, self.url, prevIndex, prevTerm, entries, commitIndex)
+                else:
+                    reply = proxy.surfstore.installsnapshot(term, self.url, snapshot)
+                    prevIndex, entries = snapshot['index'], []
+            except (OSError, xmlrpc.client.Error):
+                proxy = peerProxy(peer, self.rpcTimeout)
+                time.sleep(self.heartbeat)
+                continue
+            with self.cond:
+                if reply['term'] > self.term:
+                    self.becomeFollower(reply['term'])
+                    continue
+                if self.role != 'leader' or self.term != term:
+                    continue
+                self.lastContact[peer] = time.monotonic()
+                if reply['success']:
+                    self.matchIndex[peer] = max(self.matchIndex[peer], prevIndex + len(entries))
+                    self.nextIndex[peer] = max(self.nextIndex[peer], self.matchIndex[peer] + 1)
+                    self.advanceCommit()
+                else:
+                    self.nextIndex[peer] = max(1, min(self.nextIndex[peer] - 1, reply['next']))
+
+    def advanceCommit(self):
+        """Commit the newest entry of this term held by a majority. Called with self.cond held."""
+        for index in range(self.lastIndex(), self.commitIndex, -1):
+            if self.termAt(index) != self.term:
+                break
+            held = (self.durableIndex >= index) + sum(match >= index for match in self.matchIndex.values())
+            if self.majority(held):
+                self.commitIndex = index
+                self.cond.notify_all()
+                break
+
+    def appendEntries(self, term, leader, prevIndex, prevTerm, entries, leaderCommit):
+        with self.cond:
+            self.checkAlive()
+            if term < self.term:
+                return {'term': self.term, 'success': False, 'next': 0}
+            self.becomeFollower(term)
+            self.leader = leader
+            self.deadline = self.newDeadline()
+            end = prevIndex + len(entries)
+            if prevIndex < self.logStart:
+                # Entries in the snapshot are committed, so they match the leader's
+                entries = entries[self.logStart - prevIndex:]
+                prevIndex, prevTerm = self.logStart, self.termAt(self.logStart)
+            if prevIndex > self.lastIndex():
+                return {'term': self.term, 'success': False, 'next': self.lastIndex() + 1}
+            if self.termAt(prevIndex) != prevTerm:
+                # Skip back over the whole conflicting term at once
+                index = prevIndex
+                while index > self.logStart + 1 and self.termAt(index - 1) == self.termAt(prevIndex):
+                    index -= 1
+                return {'term': self.term, 'success': False, 'next': index}
+            for index, entry in enumerate(entries, prevIndex + 1):
+                if index <= self.lastIndex():
+                    if self.termAt(index) == entry[0]:
+                        continue
+                    del self.log[index - self.logStart:]
+                self.log.append(entry)
+                self.record(index)
+            # Entries past the ones just matched may be stale leftovers of an older term
+            commitIndex = min(leaderCommit, end)
+            if commitIndex > self.commitIndex:
+                self.commitIndex = commitIndex
+                self.cond.notify_all()
+            # The leader counts on the entries once this returns
+            self.sync(self.appended)
+            return {'term': self.term, 'success': self.term == term, 'next': end + 1}
+
+    def apply(self):
+        while True:
+            with self.cond:
+                while self.lastApplied >= self.commitIndex:
+                    self.cond.wait()
+            compact = False
+            with self.applyLock:
+                with self.cond:
+                    if self.lastApplied >= self.commitIndex:
+                        # A snapshot was installed meanwhile
+                        continue
+                    index = self.lastApplied + 1
+                    entry = self.log[index - self.logStart]
+                    if len(entry) > 2 and self.epoch is None:
+                        # The first entry carrying an epoch sets the cluster's
+                        self.epoch = self.meta.epoch = entry[2]
+                results = self.meta.updateMany(entry[1])
+                with self.cond:
+                    self.lastApplied = index
+                    if index in self.results:
+                        self.results[index] = (entry[0], results)
+                    self.cond.notify_all()
+                    if index - self.logStart >= self.snapshotEvery and not self.compacting:
+                        self.compacting = compact = True
+                if compact:
+                    snapshot = {'index': index, 'term': entry[0], 'epoch': self.epoch,
+                                'seq': self.meta.seq, 'meta': self.meta.state()}
+            if compact:
+                threading.Thread(target=self.compact, args=(snapshot,), daemon=True).start()
+
+    # Calls from clients
+
+    def checkLeader(self):
+        """Called with self.cond held"""
+        self.checkAlive()
+        if self.role != 'leader':
+            raise xmlrpc.client.Fault(NOT_LEADER, self.leader)
+
+    def submit(self, updates):
+        """
+        Replicate a list of [filename, version, blocklist] updates and return updateMany()'s
+        answer once a majority has them and they are applied here.
+        """
+        with self.cond:
+            self.checkLeader()
+            self.log.append([self.term, updates])
+            index = self.lastIndex()
+            term = self.term
+            self.record(index)
+            self.results[index] = None
+            self.cond.notify_all()
+            # Entries appended while this one is synced share the next fsync
+            self.sync(self.appended)
+            while self.lastApplied < index and not self.crashed and self.term == term:
+                self.cond.wait(self.heartbeat)
+            result = self.results.pop(index)
+            # Whatever was applied at `index` with this term is this entry
+            if result is None or result[0] != term:
+                # It may or may not survive under the next leader
+                raise xmlrpc.client.Fault(NOT_LEADER, self.leader)
+            return result[1]
+
+    def checkRead(self):
+        """
+        Raise unless this node can serve reads: it is the leader, has applied every entry
+        committed before its term, and heard from a majority within the shortest election
+        timeout, so no other leader can have been elected meanwhile.
+        """
+        with self.cond:
+            self.checkLeader()
+            now = time.monotonic()
+            recent = sum(now - t < self.electionTimeout[0] for t in self.lastContact.values())
+            if self.lastApplied < self.leaderStart or not self.majority(1 + recent):
+                raise xmlrpc.client.Fault(NOT_LEADER, '')
+
+    def isLeader(self):
+        with self.cond:
+            return self.role == 'leader'
+
+    def crash(self):
+        with self.cond:
+            self.crashed = True
+            self.role = 'follower'
+            self.leader = ''
+            self.cond.notify_all()
+
+    def restore(self):
+        with self.cond:
+            self.crashed = False
+            self.deadline = self.newDeadline()
+            self.cond.notify_all()
+
+    def isCrashed(self):
+        with self.cond:
+            return self.crashed
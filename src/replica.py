@@ -0,0 +1,87 @@
+"""
+Read replicas of the metadata server.
+
+A replica follows the primary by long-polling its getchanges() with its own position
+in the change sequence, and mirrors the entries into a local MetaStore (which adopts
+the primary's epoch, so client cursors stay valid on either). It serves reads of the
+metadata, as long as it heard from the primary less than `maxStaleness` seconds ago,
+and sends writes to the primary.
+
+A client that needs its own writes in what it reads passes a version token: the
+primary's sequence number after those writes (see surfstore.getseq()). A read with a
+token waits, up to `maxStaleness` seconds, for the replica to catch up with it.
+Refused reads are answered with a STALE fault naming the primary.
+"""
+import threading
+import time
+import xmlrpc.client
+
+import raft
+
+# Fault code of a read the replica is too far behind to serve (raft.py has the others)
+STALE = 12
+
+class ReadReplica:
+    def __init__(self, primary, meta, maxStaleness=1.0):
+        self.primary = primary
+        self.meta = meta
+        self.maxStaleness = maxStaleness
+        self.freshAt = None  # when the replica last asked for changes and got them all
+        threading.Thread(target=self.follow, daemon=True).start()
+
+    def follow(self):
+        proxy = raft.peerProxy(self.primary, self.maxStaleness + raft.RaftNode.rpcTimeout)
+        synced = False
+        while True:
+            since = self.meta.seq if synced else 0
+            sent = time.monotonic()
+            try:
+                reply = proxy.surfstore.getchanges(since, 0, self.maxStaleness / 2)
+            except xmlrpc.client.Fault as e:
+                if e.faultCode == raft.NOT_LEADER and e.faultString:
+                    # A replicated primary moved: follow its leader
+                    self.primary = e.faultString
+                    proxy = raft.peerProxy(self.primary, self.maxStaleness + raft.RaftNode.rpcTimeout)
+                    continue
+                time.sleep(self.maxStaleness / 10)
+                continue
+            except (OSError, xmlrpc.client.Error):
+                proxy = raft.peerProxy(self.primary, self.maxStaleness + raft.RaftNode.rpcTimeout)
+                time.sleep(self.maxStaleness / 10)
+                continue
+            if reply['epoch'] != self.meta.epoch and since != 0:
+                # The primary lost its history: start over
+                synced = False
+                continue
+            self.meta.mirror(reply['epoch'], reply['seq'], reply['changes'])
+            synced = True
+            with self.meta.cond:
+                self.freshAt = sent
+                self.meta.cond.notify_all()
+
+    def checkRead(self, token=0):
+        """
+        Wait until the replica is fresh and has caught up with `token`, or raise STALE.
+        """
+        deadline = time.monotonic() + self.maxStaleness
+        with self.meta.cond:
+            while True:
+                now = time.monotonic()
+                fresh = self.freshAt is not None and now - self.freshAt <= self.maxStaleness
+                if fresh and self.meta.seq >= token:
+                    return
+                if now >= deadline:
+                    raise xmlrpc.client.Fault(STALE, self.primary)
+                self.meta.cond.wait(deadline - now)
+
+    def refuseWrite(self):
+        raise xmlrpc.client.Fault(raft.NOT_LEADER, self.primary)
+
+    def blockServers(self):
+        """
+        The primary's block servers; if it keeps blocks itself, clients are sent to it for them.
+        """
+        layout = raft.peerProxy(self.primary, raft.RaftNode.rpcTimeout).surfstore.getblockservers()
+        if not layout['servers']:
+            layout = {'servers': [self.primary], 'replicas': 1, 'vnodes': 1}
+        return layout
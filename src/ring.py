@@ -0,0 +1,34 @@
+"""
+Consistent hashing of blocks onto block servers.
+
+Every server is placed at `vnodes` pseudo-random points of a 64-bit ring, and a block
+belongs to the first `replicas` distinct servers met walking clockwise from its own
+hash. Adding or removing a server only moves the blocks next to its points, about
+1/N of them, and the many points per server even out the share each one gets.
+"""
+import bisect
+import hashlib
+
+def position(key):
+	return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], 'big')
+
+class HashRing:
+	def __init__(self, nodes, vnodes=64, replicas=1):
+		points = sorted((position('{}#{}'.format(node, i)), node) for node in nodes for i in range(vnodes))
+		self.points = [p for p, _ in points]
+		self.owners = [node for _, node in points]
+		self.replicas = min(replicas, len(set(nodes)))
+
+	def lookup(self, h):
+		"""
+		The servers holding the block with hash value `h` (hex), primary first.
+		"""
+		found = []
+		start = bisect.bisect(self.points, int(h[:16], 16))
+		for i in range(len(self.owners)):
+			node = self.owners[(start + i) % len(self.owners)]
+			if node not in found:
+				found.append(node)
+				if len(found) == self.replicas:
+					break
+		return found
@@ -1,50 +1,385 @@
 from xmlrpc.server import SimpleXMLRPCServer
 from xmlrpc.server import SimpleXMLRPCRequestHandler
+from xmlrpc.server import SimpleXMLRPCDispatcher
 from socketserver import ThreadingMixIn
+from concurrent.futures import ThreadPoolExecutor
 
+import argparse
+import asyncio
 import hashlib
+import http
+import queue
+import select
+import threading
+import time
+import xmlrpc.client
+
+import codec
+import wire
+from blockstore import MemoryBlockStore, DiskBlockStore, CachedBlockStore
+from collector import BlockCollector
+from metastore import MetaStore
+from raft import RaftNode
+from replica import ReadReplica
 
 class RequestHandler(SimpleXMLRPCRequestHandler):
     rpc_paths = ('/RPC2',)
+    # Keep the connection open between requests; idle connections are dropped after `timeout` seconds
+    protocol_version = 'HTTP/1.1'
+    timeout = 60
+
+    def setup(self):
+        super().setup()
+        countStat('connections')
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.waitForRequest():
+            self.handle_one_request()
+
+    def waitForRequest(self):
+        """
+        Wait for the next request on a kept-alive connection. Returns False if the
+        connection idled for `timeout` seconds, or if it sits on a pool worker that
+        another connection is waiting for.
+        """
+        interval = self.server.pollInterval or self.timeout
+        deadline = time.monotonic() + self.timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if select.select([self.connection], [], [], min(interval, remaining))[0]:
+                return True
+            if not self.server.idle():
+                return False
+
+    def do_POST(self):
+        countStat('requests')
+        if self.path == wire.PATH:
+            self.doFrame()
+        else:
+            super().do_POST()
+        # Give up the worker if other connections are waiting for one
+        if not self.server.idle():
+            self.close_connection = True
+
+    def doFrame(self):
+        """Answers a request of the binary block protocol"""
+        frame = self.rfile.read(int(self.headers.get('content-length', 0)))
+        status, response = serveFrame(frame)
+        self.send_response(status)
+        self.send_header('Content-type', wire.CONTENT_TYPE)
+        self.send_header('Content-length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+class OverloadHandler(SimpleXMLRPCRequestHandler):
+    """Reads a request and answers 503 without running it, then closes the connection"""
+    protocol_version = 'HTTP/1.1'
+    timeout = 1
+
+    def do_POST(self):
+        countStat('rejected')
+        self.rfile.read(int(self.headers.get('content-length', 0)))
+        self.send_response(503)
+        self.send_header('Retry-After', '1')
+        self.send_header('Content-length', '0')
+        self.end_headers()
+        self.close_connection = True
 
 class threadedXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
-    pass
+    daemon_threads = True
+    pollInterval = None
+
+    def idle(self):
+        return True
+
+class pooledXMLRPCServer(SimpleXMLRPCServer):
+    """
+    Serves connections on a fixed pool of `workers` threads. Accepted connections wait
+    in a queue of at most `queueSize` for a worker; when it is full, new connections
+    are handed to a single thread that answers their request with 503 (the client
+    backs off and retries) instead of piling up more threads.
+
+    A worker serving a kept-alive connection gives it up, between requests, as soon
+    as another connection is waiting; idle connections notice within `pollInterval`.
+    """
+    pollInterval = 0.05
+
+    def __init__(self, addr, workers, queueSize, **kwargs):
+        super().__init__(addr, **kwargs)
+        self.waiting = queue.Queue(queueSize)
+        self.rejected = queue.Queue(queueSize)
+        for _ in range(workers):
+            threading.Thread(target=self.work, args=(self.waiting, self.RequestHandlerClass), daemon=True).start()
+        threading.Thread(target=self.work, args=(self.rejected, OverloadHandler), daemon=True).start()
+
+    def idle(self):
+        return self.waiting.empty()
+
+    def process_request(self, request, client_address):
+        try:
+            self.waiting.put_nowait((request, client_address))
+        except queue.Full:
+            try:
+                self.rejected.put_nowait((request, client_address))
+            except queue.Full:
+                countStat('rejected')
+                self.shutdown_request(request)
+
+    def work(self, connections, handlerClass):
+        while True:
+            request, client_address = connections.get()
+            try:
+                handlerClass(request, client_address, self)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+class asyncXMLRPCServer(SimpleXMLRPCDispatcher):
+    """
+    XML-RPC over HTTP/1.1 on an asyncio event loop. A connection costs a coroutine
+    rather than a thread, so one process can hold tens of thousands of idle clients.
+    Calls run on `executor`, since the surfstore functions may block on disk.
+    """
+    rpc_paths = RequestHandler.rpc_paths
+    timeout = RequestHandler.timeout
+
+    def __init__(self, addr, executor=None):
+        super().__init__(allow_none=False, encoding=None)
+        self.addr = addr
+        self.executor = executor
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, *self.addr, backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+    async def readRequest(self, reader):
+        """Returns (method, path, version, headers, body), or None once the client is gone or idle"""
+        try:
+            line = await asyncio.wait_for(reader.readline(), self.timeout)
+        except asyncio.TimeoutError:
+            return None
+        if not line.strip():
+            return None
+        method, path, version = line.decode('latin-1').split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+        return method, path, version, headers, body
+
+    async def handle(self, reader, writer):
+        countStat('connections')
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                request = await self.readRequest(reader)
+                if request is None:
+                    break
+                method, path, version, headers, body = request
+                if method != 'POST' or path not in self.rpc_paths + (wire.PATH,):
+                    writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                    await writer.drain()
+                    break
+                countStat('requests')
+                if path == wire.PATH:
+                    status, response = await loop.run_in_executor(self.executor, serveFrame, body)
+                    contentType = wire.CONTENT_TYPE
+                else:
+                    status = 200
+                    response = await loop.run_in_executor(self.executor, self._marshaled_dispatch, body)
+                    contentType = 'text/xml'
+                keepAlive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n%s\r\n'
+                             % (status, http.HTTPStatus(status).phrase.encode(), contentType.encode(),
+                                len(response), b'' if keepAlive else b'Connection: close\r\n'))
+                writer.write(response)
+                await writer.drain()
+                if not keepAlive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+store = MemoryBlockStore()  # hashvalue -> encoded block (see codec.py), see blockstore.py
+meta = MetaStore()  # filename -> [version, [hashval1, hashval2, hashval3]], see metastore.py
+
+# Upper bound on the payload of a single getblocks() reply, in bytes
+batchBytes = 4 * 1024 * 1024
+
+# Replicates metadata changes to the other metadata servers, if there are any (see raft.py)
+raftNode = None
+
+# Follows the primary metadata server if this is a read replica (see replica.py)
+readReplica = None
+
+# Deletes the blocks no file refers to any more, if enabled (see collector.py)
+collector = None
 
-store = dict()  # hashvalue -> binary
-meta = dict()  # filename -> [version, [hashval1, hashval2, hashval3]]
+# Block servers the clients of this metadata server keep their blocks on (none: on
+# this server), and how the clients spread blocks over them (see ring.py)
+blockServers = []
+replicas = 1
+vnodes = 64
+
+# counter name -> value; plainbytes/storedbytes: size of the blocks stored, before and after compression
+stats = dict(connections=0, requests=0, rejected=0, plainbytes=0, storedbytes=0)
+statsLock = threading.Lock()
+
+def countStat(name, n=1):
+    with statsLock:
+        stats[name] += n
+
+# A "crashed" metadata server (see raft.py) answers every call but isleader, iscrashed,
+# crash and restore with a Fault
+def checkAlive():
+    if raftNode is not None:
+        raftNode.checkAlive()
 
 # A simple ping, returns true
 def ping():
     """A simple ping method"""
     print("Ping()")
+    checkAlive()
     return True
 
 # Gets a block, given a specific hash value
 def getblock(h):
     """Gets a block"""
     print("GetBlock(" + h + ")")
+    checkAlive()
 
-    blockData = store[h]
-    return blockData
+    blockData = codec.decode(store.get(h))
+    return xmlrpc.client.Binary(blockData)
 
 # Puts a block
 def putblock(b):
     """Puts a block"""
     print("PutBlock()")
+    checkAlive()
     # b is a 'xml.client.Binary' object, not a bytes object
-    h = hashlib.sha256(b.data).hexdigest()
-    store[h] = b
+    storeBlock(codec.encode(b.data))
+    return True
+
+# Stores an encoded block under the hash of its plain bytes. Raises ValueError for a
+# malformed block, or a compressed one whose plain bytes are over codec.MAX_SIZE
+# (answered with 400)
+def storeBlock(encoded):
+    data = codec.decode(encoded)
+    h = hashlib.sha256(data).hexdigest()
+    if collector is not None:
+        collector.hold([h])
+    if not store.has(h):
+        store.put(h, encoded)
+        countStat('plainbytes', len(data))
+        countStat('storedbytes', len(encoded))
+
+# The encoded blocks of a list of hash values, in order, up to the batch byte budget
+def encodedBlocks(hashlist):
+    blocks = []
+    nbytes = 0
+    for h in hashlist:
+        encoded = store.get(h)
+        if blocks and nbytes + len(encoded) > batchBytes:
+            break
+        blocks.append(encoded)
+        nbytes += len(encoded)
+    return blocks
+
+# Gets a batch of blocks, given a list of hash values.
+# Blocks are returned in order until the batch byte budget is reached, so the
+# reply may hold only a prefix of the list; at least one block is always returned.
+def getblocks(hashlist):
+    """Gets a batch of blocks"""
+    print("GetBlocks({})".format(len(hashlist)))
+    checkAlive()
+
+    return [xmlrpc.client.Binary(codec.decode(encoded)) for encoded in encodedBlocks(hashlist)]
+
+# Puts a batch of blocks
+def putblocks(blocklist):
+    """Puts a batch of blocks"""
+    print("PutBlocks({})".format(len(blocklist)))
+    checkAlive()
+    for b in blocklist:
+        storeBlock(codec.encode(b.data))
     return True
 
 # Given a list of blocks, return the subset that are on this server
 def hasblocks(blocklist):
     """Determines which blocks are on this server"""
     print("HasBlocks()")
+    checkAlive()
+
+    if collector is not None:
+        # The client may commit a file made of the blocks found without uploading them
+        collector.hold(blocklist)
+    return [h for h in blocklist if store.has(h)]
+
+# Runs a block call sent in the binary protocol (see wire.py) instead of XML-RPC.
+# Blocks travel encoded, as they are stored, so they are neither decompressed for
+# a download nor recompressed for an upload (only decompressed to check their hash).
+# Returns (HTTP status, reply frame); 503 while this node is crashed.
+def serveFrame(frame):
+    op, payload = frame[:1], memoryview(frame)[1:]
+    if raftNode is not None and raftNode.isCrashed():
+        # Unavailable until restored, like the calls answered with a Fault
+        return 503, b''
+    try:
+        if op == wire.HAS:
+            hashes = wire.unpackDigests(payload)
+            present = set(hasblocks(hashes))
+            return 200, bytes(h in present for h in hashes)
+        if op == wire.GET:
+            hashes = wire.unpackDigests(payload)
+            print("GetBlocks({})".format(len(hashes)))
+            return 200, wire.packBlocks(encodedBlocks(hashes))
+        if op == wire.PUT:
+            blocks = wire.unpackBlocks(payload)
+            print("PutBlocks({})".format(len(blocks)))
+            for encoded in blocks:
+                storeBlock(bytes(encoded))
+            return 200, b''
+    except KeyError:
+        return 404, b''
+    except ValueError:
+        return 400, b''
+    return 400, b''
+
+# Lists the encodings the block calls can be sent in, then the block codecs accepted
+def protocols():
+    """Lists the supported wire protocols"""
+    print("Protocols()")
+    checkAlive()
+    return ['xmlrpc', 'binary'] + list(codec.CODECS)
 
-    return [h for h in blocklist if h in store]
+# Tells clients where to keep blocks: {'servers': [url, ...], 'replicas': n, 'vnodes': n}.
+# An empty list means on this server.
+def getblockservers():
+    """Gets the block servers"""
+    print("GetBlockServers()")
+    checkAlive()
+    if readReplica is not None:
+        return readReplica.blockServers()
+    return {'servers': blockServers, 'replicas': replicas, 'vnodes': vnodes}
 
-# Retrieves the server's FileInfoMap
-def getfileinfomap():
+# Retrieves the server's FileInfoMap.
+# `token` (see getseq) is only used by read replicas, which wait until they are that
+# far along the primary's change sequence.
+def getfileinfomap(token=0):
     """Gets the fileinfo map"""
     print("GetFileInfoMap()")
 
@@ -63,24 +398,99 @@ def getfileinfomap():
     
     # result["file1.dat"] = file1info
 
-    return meta
+    if raftNode is not None:
+        raftNode.checkRead()
+    if readReplica is not None:
+        readReplica.checkRead(token)
+    return meta.getmap()
 
-# Update a file's fileinfo entry
+# Retrieves the FileInfoMap entries changed since a point in the change sequence.
+# Returns {'epoch': .., 'seq': .., 'changes': {filename: [version, hashlist]}};
+# `seq` is the cursor to pass next time. A cursor from a different epoch is
+# meaningless, and the client should ask again from 0.
+# `token` is as for getfileinfomap; if nothing changed, the reply waits up to `wait`
+# seconds for a change (read replicas follow the primary this way).
+def getchanges(since, token=0, wait=0):
+    """Gets the fileinfo entries changed since a sequence number"""
+    print("GetChanges({})".format(since))
+
+    if raftNode is not None:
+        raftNode.checkRead()
+    if readReplica is not None:
+        readReplica.checkRead(token)
+    epoch, seq, changes = meta.changes(since, min(wait, RequestHandler.timeout / 2))
+    return {'epoch': epoch, 'seq': seq, 'changes': changes}
+
+# Returns {'epoch': .., 'seq': ..}, the current end of the change sequence: once a
+# client's updates are in, a version token covering them for reads from replicas
+def getseq():
+    """Gets the change sequence position"""
+    print("GetSeq()")
+
+    if raftNode is not None:
+        raftNode.checkRead()
+    if readReplica is not None:
+        readReplica.refuseWrite()
+    epoch, seq, _ = meta.changes(meta.seq)
+    return {'epoch': epoch, 'seq': seq}
+
+# Update a file's fileinfo entry. With --gc, a version referring to blocks that are
+# not stored (any more) is refused with a MISSING_BLOCKS fault (see collector.py).
 def updatefile(filename, version, blocklist):
     """Updates a file's fileinfo entry"""
     print("UpdateFile()")
 
-    finfo = meta.get(filename, [0, []]) # Check if the initiation of a new file is correct!
+    if readReplica is not None:
+        readReplica.refuseWrite()
+    if raftNode is not None:
+        return raftNode.submit([[filename, version, blocklist]])[0]
+    if collector is not None:
+        collector.checkBlocks(h for h in blocklist if h != 0)
+    return meta.update(filename, version, blocklist)
 
-    if finfo[0]+1 != version:
-        return False
-    
-    finfo[0] = version
-    finfo[1] = blocklist
+# Update several files' fileinfo entries, given as [filename, version, blocklist]
+# lists. Each entry is accepted or rejected on its own, as by updatefile; the
+# accepted ones are made durable together.
+def updatefiles(entries):
+    """Updates several files' fileinfo entries"""
+    print("UpdateFiles({})".format(len(entries)))
 
-    meta[filename] = finfo
+    if readReplica is not None:
+        readReplica.refuseWrite()
+    if raftNode is not None:
+        return raftNode.submit(entries)
+    if collector is not None:
+        # Blocks collected during a long upload fail the whole call, before any entry is applied
+        collector.checkBlocks(h for _, _, blocklist in entries for h in blocklist if h != 0)
+    return meta.updateMany(entries)
 
-    return True
+# Raft calls between metadata servers
+def requestvote(term, candidate, lastIndex, lastTerm):
+    """Asks for this node's vote"""
+    return raftNode.requestVote(term, candidate, lastIndex, lastTerm)
+
+def appendentries(term, leader, prevIndex, prevTerm, entries, leaderCommit):
+    """Appends entries to this node's log"""
+    return raftNode.appendEntries(term, leader, prevIndex, prevTerm, entries, leaderCommit)
+
+def installsnapshot(term, leader, snapshot):
+    """Replaces the start of this node's log with the leader's snapshot"""
+    return raftNode.installSnapshot(term, leader, snapshot)
+
+# Returns the server's counters (connections accepted, requests served, ...),
+# and those of the block cache and the block collector if there are any
+def getstats():
+    """Gets the server counters"""
+    print("GetStats()")
+    checkAlive()
+    with statsLock:
+        counters = dict(stats)
+    if isinstance(store, CachedBlockStore):
+        counters.update(store.stats())
+    if collector is not None:
+        counters.update(collector.stats())
+    # XML-RPC integers are 32-bit
+    return {name: value if value <= xmlrpc.client.MAXINT else float(value) for name, value in counters.items()}
 
 # PROJECT 3 APIs below
 
@@ -89,7 +499,9 @@ def updatefile(filename, version, blocklist):
 def isLeader():
     """Is this metadata store a leader?"""
     print("IsLeader()")
-    return True
+    if raftNode is not None:
+        return raftNode.isLeader()
+    return readReplica is None
 
 # "Crashes" this metadata store
 # Until Restore() is called, the server should reply to all RPCs
@@ -98,6 +510,8 @@ def isLeader():
 def crash():
     """Crashes this metadata store"""
     print("Crash()")
+    if raftNode is not None:
+        raftNode.crash()
     return True
 
 # "Restores" this metadata store, allowing it to start responding
@@ -105,6 +519,8 @@ def crash():
 def restore():
     """Restores this metadata store"""
     print("Restore()")
+    if raftNode is not None:
+        raftNode.restore()
     return True
 
 
@@ -113,19 +529,102 @@ def restore():
 def isCrashed():
     """Returns whether this node is crashed or not"""
     print("IsCrashed()")
-    return True
+    if raftNode is not None:
+        return raftNode.isCrashed()
+    return False
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SurfStore server")
+    parser.add_argument('--host', default='localhost', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Serve connections on this many threads (0: one thread per connection); '
+                             'with --asyncio, the number of threads running calls')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='Serve connections on an asyncio event loop')
+    parser.add_argument('--queuesize', type=int, default=128,
+                        help='Connections waiting for a worker before new ones are rejected')
+    parser.add_argument('--batchbytes', type=int, default=batchBytes,
+                        help='Max bytes returned by a single getblocks call')
+    parser.add_argument('--blockstore', choices=['memory', 'disk'], default='memory',
+                        help='Keep blocks in memory, or in files under --blockdir')
+    parser.add_argument('--blockdir', default='blocks',
+                        help='Directory of the disk block store')
+    parser.add_argument('--fsync', choices=DiskBlockStore.FSYNC_POLICIES, default='always',
+                        help='Durability of a put in the disk block store')
+    parser.add_argument('--cachebytes', type=int, default=64 * 1024 * 1024,
+                        help='Memory for the most requested blocks of the disk block store (0: no cache)')
+    parser.add_argument('--blockservers', nargs='+', default=[], metavar='URL',
+                        help='Block servers (e.g. http://localhost:8091) clients keep blocks on instead of this server')
+    parser.add_argument('--replicas', type=int, default=replicas,
+                        help='Number of block servers each block is kept on')
+    parser.add_argument('--vnodes', type=int, default=vnodes,
+                        help='Points per block server on the consistent hashing ring')
+    parser.add_argument('--peers', nargs='+', default=[], metavar='URL',
+                        help='The other metadata servers to replicate metadata with (requires --blockservers)')
+    parser.add_argument('--follow', default=None, metavar='URL',
+                        help='Run as a read replica of the metadata server at URL')
+    parser.add_argument('--maxstaleness', type=float, default=1.0,
+                        help='Seconds a read replica may lag behind the primary before it refuses reads')
+    parser.add_argument('--gc', action='store_true',
+                        help='Delete the blocks no file version refers to (not for block servers of another metadata server)')
+    parser.add_argument('--gcgrace', type=float, default=60.0,
+                        help='Seconds a block stays after it was last uploaded, checked for or released')
+    parser.add_argument('--metadir', default=None,
+                        help='Directory of the metadata log and snapshots, or of the Raft log and snapshots with --peers (metadata is kept in memory only if not given)')
+    parser.add_argument('--snapshotevery', type=int, default=10000,
+                        help='Number of metadata updates (Raft log entries with --peers) between snapshots')
+    args = parser.parse_args()
+    if args.peers and not args.blockservers:
+        parser.error('--peers needs --blockservers, so that blocks outlive a metadata server')
+    if args.follow and (args.peers or args.metadir):
+        parser.error('a read replica (--follow) takes its metadata from the primary')
+    if args.gc and (args.blockservers or args.follow):
+        parser.error('--gc collects the blocks kept on this server, which has none with --blockservers or --follow')
+    batchBytes = args.batchbytes
+    blockServers, replicas, vnodes = args.blockservers, args.replicas, args.vnodes
+    if args.peers:
+        # The Raft log is the write-ahead log of the replicated metadata
+        meta = MetaStore()
+        raftNode = RaftNode('http://{}:{}'.format(args.host, args.port), args.peers, meta, args.metadir, args.snapshotevery)
+    else:
+        meta = MetaStore(args.metadir, args.snapshotevery)
+    if args.follow:
+        readReplica = ReadReplica(args.follow, meta, args.maxstaleness)
+    if args.blockstore == 'disk':
+        store = DiskBlockStore(args.blockdir, args.fsync)
+        if args.cachebytes > 0:
+            store = CachedBlockStore(store, args.cachebytes)
+    if args.gc:
+        collector = BlockCollector(store, meta, args.gcgrace)
+
     try:
         print("Attempting to start XML-RPC Server...")
-        server = threadedXMLRPCServer(('localhost', 8080), requestHandler=RequestHandler)
+        if args.asyncio:
+            server = asyncXMLRPCServer((args.host, args.port), ThreadPoolExecutor(args.workers or None))
+        elif args.workers > 0:
+            server = pooledXMLRPCServer((args.host, args.port), args.workers, args.queuesize,
+                                        requestHandler=RequestHandler)
+        else:
+            server = threadedXMLRPCServer((args.host, args.port), requestHandler=RequestHandler)
         server.register_introspection_functions()
         server.register_function(ping,"surfstore.ping")
         server.register_function(getblock,"surfstore.getblock")
         server.register_function(putblock,"surfstore.putblock")
+        server.register_function(getblocks,"surfstore.getblocks")
+        server.register_function(putblocks,"surfstore.putblocks")
         server.register_function(hasblocks,"surfstore.hasblocks")
+        server.register_function(protocols,"surfstore.protocols")
+        server.register_function(getblockservers,"surfstore.getblockservers")
         server.register_function(getfileinfomap,"surfstore.getfileinfomap")
+        server.register_function(getchanges,"surfstore.getchanges")
+        server.register_function(getseq,"surfstore.getseq")
         server.register_function(updatefile,"surfstore.updatefile")
+        server.register_function(updatefiles,"surfstore.updatefiles")
+        server.register_function(getstats,"surfstore.getstats")
+        server.register_function(requestvote,"surfstore.requestvote")
+        server.register_function(appendentries,"surfstore.appendentries")
+        server.register_function(installsnapshot,"surfstore.installsnapshot")
 
         server.register_function(isLeader,"surfstore.isleader")
         server.register_function(crash,"surfstore.crash")
@@ -3,8 +3,52 @@ import unittest
 import shutil
 import hashlib
 import shutil
+import threading
+import xmlrpc.client
+import xmlrpc.server
 
 import client
+import collector
+import indexfile
+
+class FakeSurfstore:
+    """In-process stand-in for the server's block and metadata RPCs"""
+    def __init__(self, blocks, replylimit, meta=None):
+        self.store = {hashlib.sha256(b).hexdigest(): xmlrpc.client.Binary(b) for b in blocks}
+        self.replylimit = replylimit
+        self.meta = meta or {}
+        self.fetched = []
+        self.calls = []
+
+    def getblocks(self, hashlist):
+        self.fetched.extend(hashlist[:self.replylimit])
+        return [self.store[h] for h in hashlist[:self.replylimit]]
+
+    def hasblocks(self, hashlist):
+        self.calls.append('hasblocks')
+        return [h for h in hashlist if h in self.store]
+
+    def putblocks(self, blocks):
+        self.calls.append('putblocks')
+        for b in blocks:
+            self.store[hashlib.sha256(b).hexdigest()] = xmlrpc.client.Binary(b)
+        return True
+
+    def updatefiles(self, entries):
+        self.calls.append('updatefiles')
+        results = []
+        for fname, version, hashlist in entries:
+            results.append(self.meta.get(fname, [0, []])[0] + 1 == version)
+            if results[-1]:
+                self.meta[fname] = [version, hashlist]
+        return results
+
+    def getchanges(self, since):
+        return {'epoch': '', 'seq': 0, 'changes': dict(self.meta)}
+
+class FakeProxy:
+    def __init__(self, *args):
+        self.surfstore = FakeSurfstore(*args)
 
 class TestClient(unittest.TestCase):
     def setUp(self):
@@ -46,9 +90,31 @@ class TestClient(unittest.TestCase):
             h_list.append(h)
         true_fname2hashlist[fname2] = h_list
         # check scan
-        fname2hashlist, hash2block = client.scandir(self.basedir, blocksize)
+        fname2hashlist = dict(client.scandir(self.basedir, blocksize))
         self.assertEqual(fname2hashlist, true_fname2hashlist)
-        self.assertEqual(hash2block, true_hash2block)
+        # blocks are read back lazily by offset
+        for fname, hashlist in fname2hashlist.items():
+            blocks = client.readBlocks(self.basedir, fname, hashlist, blocksize, hashlist[::-1])
+            self.assertEqual([true_hash2block[h] for h in hashlist[::-1]], list(blocks))
+
+    def test_1_scandirParallel(self):
+        blocksize = 1000
+        contents = {"a.dat": os.urandom(25500), "b.dat": os.urandom(300), "c.dat": b""}
+        for fname, content in contents.items():
+            with open(self.basedir+fname, 'wb') as f:
+                f.write(content)
+        saved = client.hashWorkers, client.segmentBytes
+        client.hashWorkers, client.segmentBytes = 4, 3 * blocksize
+        try:
+            fname2hashlist = dict(client.scandir(self.basedir, blocksize))
+        finally:
+            client.hashWorkers, client.segmentBytes = saved
+        # identical to hashing block by block; empty files are skipped
+        self.assertEqual(set(fname2hashlist), {"a.dat", "b.dat"})
+        for fname in fname2hashlist:
+            content = contents[fname]
+            h_list = [hashlib.sha256(content[i:i+blocksize]).hexdigest() for i in range(0, len(content), blocksize)]
+            self.assertEqual(fname2hashlist[fname], h_list)
 
     def test_2_parseIndexFile(self):
         blocksize = 2048
@@ -70,11 +136,129 @@ class TestClient(unittest.TestCase):
         rst = client.parseIndexFile(self.basedir)
         self.assertEqual(rst, {fname1:[1, h_list]})
 
+    def test_2_statCache(self):
+        blocksize = 2048
+        fname = "file1.txt"
+        with open(self.basedir+fname, 'wb') as f:
+            f.write(b"a"*5000)
+        old = 1000000000 * 1000000000
+        os.utime(self.basedir+fname, ns=(old, old))
+        stats = {}
+        localIndex = {}
+        hashlist = dict(client.scandir(self.basedir, blocksize, localIndex, stats))[fname]
+        self.assertIn(fname, stats)
+        localIndex[fname] = [1, hashlist]
+        # same size and mtime: the stored hashlist is reused without reading the file
+        with open(self.basedir+fname, 'r+b') as f:
+            f.write(b"b"*5000)
+        os.utime(self.basedir+fname, ns=(old, old))
+        self.assertEqual(dict(client.scandir(self.basedir, blocksize, localIndex, stats))[fname], hashlist)
+        # a new mtime forces a rehash
+        os.utime(self.basedir+fname, ns=(old+1, old+1))
+        rehashed = dict(client.scandir(self.basedir, blocksize, localIndex, stats))[fname]
+        self.assertEqual(rehashed[0], hashlib.sha256(b"b"*blocksize).hexdigest())
+        # stats survive a round trip through index.txt
+        client.dumpLocalIndex(localIndex, self.basedir, stats)
+        parsed = {}
+        self.assertEqual(client.parseIndexFile(self.basedir, parsed), localIndex)
+        self.assertEqual(parsed, stats)
+
     def test_3_download(self):
-        pass
+        blocksize = 1000
+        content = os.urandom(5500)
+        blocks = [content[i:i+blocksize] for i in range(0, len(content), blocksize)]
+        hashlist = [hashlib.sha256(b).hexdigest() for b in blocks]
+        # the server returns at most 2 blocks per reply
+        client.download(FakeProxy(blocks, 2), self.basedir, "file1.dat", hashlist, blocksize)
+        with open(self.basedir+"file1.dat", 'rb') as f:
+            self.assertEqual(f.read(), content)
+        # deleted on the server
+        client.download(FakeProxy(blocks, 2), self.basedir, "file1.dat", [0], blocksize)
+        self.assertFalse(os.path.exists(self.basedir+"file1.dat"))
+
+    def test_3_downloadDelta(self):
+        blocksize = 1000
+        A, B, C, X, Y = (os.urandom(blocksize) for _ in range(5))
+        hA, hB, hC, hX, hY = (hashlib.sha256(b).hexdigest() for b in (A, B, C, X, Y))
+        with open(self.basedir+"file1.dat", 'wb') as f:
+            f.write(A + B + C)
+        os.chmod(self.basedir+"file1.dat", 0o640)
+        local = client.LocalBlocks(self.basedir, blocksize)
+        local.add("file1.dat", [hA, hB, hC])
+        # only the changed blocks are fetched, the others come from the old version
+        proxy = FakeProxy([A, B, C, X, Y], 10)
+        client.download(proxy, self.basedir, "file1.dat", [hA, hX, hC, hY, hB], blocksize, None, local)
+        with open(self.basedir+"file1.dat", 'rb') as f:
+            self.assertEqual(f.read(), A + X + C + Y + B)
+        self.assertEqual(proxy.surfstore.fetched, [hX, hY])
+        self.assertEqual(os.stat(self.basedir+"file1.dat").st_mode & 0o777, 0o640)
+        self.assertEqual(os.listdir(self.basedir), ["file1.dat"])
+
+    def test_3_downloadOtherBlocksize(self):
+        # uploaded by a client using 700-byte blocks, downloaded with 1000-byte blocks
+        content = os.urandom(5500)
+        blocks = [content[i:i+700] for i in range(0, len(content), 700)]
+        hashlist = [hashlib.sha256(b).hexdigest() for b in blocks]
+        client.download(FakeProxy(blocks, 3), self.basedir, "file1.dat", hashlist, 1000)
+        with open(self.basedir+"file1.dat", 'rb') as f:
+            self.assertEqual(f.read(), content)
+        # with a local block size far larger than the file, nothing near it is reserved
+        for content in (content, content[:700]):
+            blocks = [content[i:i+700] for i in range(0, len(content), 700)]
+            hashlist = [hashlib.sha256(b).hexdigest() for b in blocks]
+            client.download(FakeProxy(blocks, 3), self.basedir, "file1.dat", hashlist, 1 << 40)
+            with open(self.basedir+"file1.dat", 'rb') as f:
+                self.assertEqual(f.read(), content)
+
+    def test_3_cdc(self):
+        blocksize = 1024
+        content = os.urandom(100000)
+        with open(self.basedir+"file1.dat", 'wb') as f:
+            f.write(content)
+        saved = client.chunking
+        client.chunking = 'cdc'
+        try:
+            hashlist = dict(client.scandir(self.basedir, blocksize))["file1.dat"]
+            blocks = list(client.readBlocks(self.basedir, "file1.dat", hashlist, blocksize, hashlist))
+            self.assertEqual(b''.join(blocks), content)
+            minsize, avgsize, maxsize = client.cdcSizes(blocksize)
+            self.assertTrue(all(minsize <= len(b) <= maxsize for b in blocks[:-1]))
+            # inserting a byte at the front only changes the first chunk
+            with open(self.basedir+"file1.dat", 'wb') as f:
+                f.write(b'x' + content)
+            newHashlist = dict(client.scandir(self.basedir, blocksize))["file1.dat"]
+            self.assertEqual(len(set(newHashlist) - set(hashlist)), 1)
+            # variable-size chunks are downloaded in order
+            client.download(FakeProxy(blocks, 3), self.basedir, "file2.dat", hashlist, blocksize)
+            with open(self.basedir+"file2.dat", 'rb') as f:
+                self.assertEqual(f.read(), content)
+                # the spans of the downloaded chunks are reused instead of chunking the file again
+                spans = client.chunkSpans[os.path.abspath(self.basedir+"file2.dat")][1]
+                self.assertIs(client.blockOffsets(f, hashlist, blocksize), spans)
+            self.assertEqual(sorted(spans.values())[-1], (len(content) - len(blocks[-1]), len(blocks[-1])))
+        finally:
+            client.chunking = saved
 
     def test_4_mergeCloudToLocal(self):
-        pass
+        blocksize = 1000
+        A, B, C, D = (os.urandom(blocksize) for _ in range(4))
+        hA, hB, hC, hD = (hashlib.sha256(b).hexdigest() for b in (A, B, C, D))
+        with open(self.basedir+"a.dat", 'wb') as f:
+            f.write(A + B + C)
+        localIndex = {"a.dat": [1, [hA, hB, hC]]}
+        # A was modified locally since the last sync
+        with open(self.basedir+"a.dat", 'r+b') as f:
+            f.write(b'x')
+        remoteIndex = {"b.dat": [1, [hB, hD, hA]], "c.dat": [1, [hD, hD, hC]]}
+        proxy = FakeProxy([A, B, C, D], 10)
+        client.mergeCloudToLocal(proxy, localIndex, remoteIndex, self.basedir, blocksize)
+        with open(self.basedir+"b.dat", 'rb') as f:
+            self.assertEqual(f.read(), B + D + A)
+        with open(self.basedir+"c.dat", 'rb') as f:
+            self.assertEqual(f.read(), D + D + C)
+        # B and C were copied from a.dat, and D from b.dat once downloaded
+        self.assertEqual(sorted(proxy.surfstore.fetched), sorted([hD, hA]))
+        self.assertEqual(localIndex["c.dat"], [1, [hD, hD, hC]])
 
     def test_5_isSame(self):
         h1 = hashlib.sha256(b"haha").hexdigest()
@@ -86,14 +270,113 @@ class TestClient(unittest.TestCase):
         self.assertFalse(client.isSame([h1], [h1, h2]))
         self.assertFalse(client.isSame([h1, h2], [h2, h1]))
 
+    def test_5_batchBlocks(self):
+        blocks = [b'a'*3, b'b'*3, b'c'*5, b'd'*1]
+        batches = list(client.batchBlocks(blocks, 6))
+        self.assertEqual(batches, [[b'a'*3, b'b'*3], [b'c'*5, b'd'*1]])
+        # a block larger than the budget goes alone
+        batches = list(client.batchBlocks(blocks, 2))
+        self.assertEqual(batches, [[b] for b in blocks])
+        self.assertEqual(list(client.batchBlocks([], 6)), [])
+
+    def test_5_transferPool(self):
+        pool = client.TransferPool('http://localhost:8080', 3, window=2)
+        results = dict(pool.run(lambda proxy, job: job * 2, range(10)))
+        pool.shutdown()
+        self.assertEqual(results, {i: i * 2 for i in range(10)})
+
+    def test_5_protocolFallback(self):
+        # a server without the binary protocol gets XML-RPC calls
+        server = xmlrpc.server.SimpleXMLRPCServer(('localhost', 8089), logRequests=False)
+        server.register_function(lambda hashlist: hashlist[:1], 'surfstore.hasblocks')
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            url = 'http://localhost:8089'
+            proxy = client.connect(url)
+            self.assertEqual(proxy.surfstore.hasblocks(['ab', 'cd']), ['ab'])
+            self.assertEqual(client.serverProtocols[url], ['xmlrpc'])
+        finally:
+            server.shutdown()
+            server.server_close()
+            client.serverProtocols.clear()
+            client.blockRings.clear()
+
     def test_6_upload(self):
-        pass
+        blocksize = 1000
+        A, B = os.urandom(blocksize), os.urandom(blocksize)
+        hA, hB = (hashlib.sha256(b).hexdigest() for b in (A, B))
+        with open(self.basedir+"a.dat", 'wb') as f:
+            f.write(A + B)
+        proxy = FakeProxy([A], 10)
+        commit = proxy.surfstore.updatefiles
+
+        def collectFirst(entries):
+            # the server collected A, found by hasblocks, before the commit came in
+            proxy.surfstore.updatefiles = commit
+            del proxy.surfstore.store[hA]
+            raise xmlrpc.client.Fault(collector.MISSING_BLOCKS, hA)
+        proxy.surfstore.updatefiles = collectFirst
+        localIndex = {}
+        client.upload(proxy, "a.dat", 1, [hA, hB], localIndex, self.basedir, blocksize, 0)
+        # the missing block was uploaded again and the file committed
+        self.assertEqual(proxy.surfstore.calls, ['hasblocks', 'putblocks', 'hasblocks', 'putblocks', 'updatefiles'])
+        self.assertEqual(sorted(proxy.surfstore.store), sorted([hA, hB]))
+        self.assertEqual(localIndex["a.dat"], [1, [hA, hB]])
 
     def test_7_mergeLocalToCloud(self):
-        pass
+        blocksize = 1000
+        A, B, C = (os.urandom(blocksize) for _ in range(3))
+        hA, hB, hC = (hashlib.sha256(b).hexdigest() for b in (A, B, C))
+        for fname, content in (("a.dat", A + B), ("b.dat", B + C), ("c.dat", A + A)):
+            with open(self.basedir+fname, 'wb') as f:
+                f.write(content)
+        # gone.dat was deleted locally; c.dat was also changed by another client
+        localIndex = {"gone.dat": [1, [hC]]}
+        proxy = FakeProxy([A], 10, {"gone.dat": [1, [hC]], "c.dat": [1, [hB]]})
+        # the winning version of c.dat is still being synced when changes are first asked for
+        changes = proxy.surfstore.getchanges
+        early = [{'epoch': '', 'seq': 0, 'changes': {}}]
+        proxy.surfstore.getchanges = lambda since: early.pop() if early else changes(since)
+        client.mergeLocalToCloud(proxy, localIndex, self.basedir, blocksize, 0)
+        # one hasblocks and one updatefiles for every file, each missing block sent once
+        self.assertEqual(proxy.surfstore.calls, ['hasblocks', 'putblocks', 'updatefiles'])
+        self.assertEqual(sorted(proxy.surfstore.store), sorted([hA, hB, hC]))
+        self.assertEqual(proxy.surfstore.meta["a.dat"], [1, [hA, hB]])
+        self.assertEqual(proxy.surfstore.meta["gone.dat"], [2, [0]])
+        # the rejected file was replaced by the cloud version
+        self.assertEqual(localIndex["c.dat"], [1, [hB]])
+        with open(self.basedir+"c.dat", 'rb') as f:
+            self.assertEqual(f.read(), B)
+        self.assertEqual(len(localIndex), 4)
 
     def test_8_dumpLocalIndex(self):
-        pass
+        h1, h2 = (hashlib.sha256(b).hexdigest() for b in (b"1", b"2"))
+        with open(self.basedir+'index.txt', 'w') as f:
+            f.write('/cursor e1 5\n')
+            f.write('a.txt 1 {} {} @10:20:30:fixed-4096\n'.format(h1, h2))
+            f.write('b.txt 2 0\n')
+        # a text index is migrated to the binary format on the first save
+        stats, cursor = {}, {}
+        localIndex = client.parseIndexFile(self.basedir, stats, cursor)
+        self.assertEqual(localIndex, {"a.txt": [1, [h1, h2]], "b.txt": [2, [0]]})
+        cursor['token'] = 6
+        client.dumpLocalIndex(localIndex, self.basedir, stats, cursor)
+        with open(self.basedir+'index.txt', 'rb') as f:
+            self.assertTrue(f.read().startswith(indexfile.MAGIC))
+        parsedStats, parsedCursor = {}, {}
+        self.assertEqual(client.parseIndexFile(self.basedir, parsedStats, parsedCursor), localIndex)
+        self.assertEqual(parsedStats, {"a.txt": (10, 20, 30, 'fixed-4096')})
+        self.assertEqual(parsedCursor, {'epoch': 'e1', 'seq': 5, 'token': 6})
+        # and can still be saved as text
+        saved = client.indexFormat
+        client.indexFormat = 'text'
+        try:
+            client.dumpLocalIndex(localIndex, self.basedir, stats, cursor)
+            with open(self.basedir+'index.txt') as f:
+                self.assertEqual(f.readline(), '/cursor e1 5 6\n')
+            self.assertEqual(client.parseIndexFile(self.basedir), localIndex)
+        finally:
+            client.indexFormat = saved
 
     def test_9_synchronize(self):
         pass
@@ -0,0 +1,50 @@
+import lzma
+import os
+import unittest
+import zlib
+
+import codec
+
+class TestCodec(unittest.TestCase):
+    def setUp(self):
+        self.text = b'the quick brown fox jumps over the lazy dog\n' * 100
+        self.noise = os.urandom(4096)
+
+    def test_0_roundtrip(self):
+        for name in codec.CODECS:
+            for data in (self.text, self.noise, b'', b'x'):
+                self.assertEqual(codec.decode(codec.encode(data, name)), data)
+
+    def test_1_compresses_text(self):
+        for name in ('zlib', 'lzma'):
+            encoded = codec.encode(self.text, name)
+            self.assertEqual(encoded[0], codec.CODECS.index(name))
+            self.assertLess(len(encoded), len(self.text) // 10)
+
+    def test_2_skips_incompressible(self):
+        self.assertGreater(codec.entropy(self.noise), codec.MAX_ENTROPY)
+        self.assertLess(codec.entropy(self.text), codec.MAX_ENTROPY)
+        self.assertEqual(codec.encode(self.noise, 'zlib'), b'\0' + self.noise)
+        self.assertEqual(codec.encode(b'short', 'zlib'), b'\0short')
+
+    def test_3_corrupt(self):
+        for encoded in (b'', b'\x01garbage', b'\x09abc'):
+            with self.assertRaises(ValueError):
+                codec.decode(encoded)
+
+    def test_4_bomb(self):
+        # a few kilobytes that would decompress to 64 MiB are refused
+        zeros = bytes(64 * 1024 * 1024)
+        for codecId, packed in ((1, zlib.compress(zeros, 9)), (2, lzma.compress(zeros))):
+            with self.assertRaises(ValueError):
+                codec.decode(bytes([codecId]) + packed)
+        self.assertEqual(codec.decode(codec.encode(self.text, 'zlib'), len(self.text)), self.text)
+        with self.assertRaises(ValueError):
+            codec.decode(codec.encode(self.text, 'zlib'), len(self.text) - 1)
+        # raw blocks are as long as their frame: neither limited nor compressed past the limit
+        self.assertEqual(codec.decode(b'\0' + self.noise, 100), self.noise)
+        self.assertEqual(codec.encode(zeros, 'zlib'), b'\0' + zeros)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+import time
+import xmlrpc.client
+
+import collector
+from blockstore import MemoryBlockStore, CachedBlockStore
+from collector import BlockCollector
+from metastore import MetaStore
+
+class TestCollector(unittest.TestCase):
+    def setUp(self):
+        self.store = MemoryBlockStore()
+        self.meta = MetaStore()
+        for h in ('h1', 'h2', 'h3'):
+            self.store.put(h, b'block ' + h.encode())
+
+    def collector(self, grace):
+        # sweeps are run by hand
+        return BlockCollector(self.store, self.meta, grace, interval=3600)
+
+    def test_1_sweep(self):
+        self.meta.update("a.txt", 1, ["h1", "h2", "h1"])
+        gc = self.collector(0)
+        # h3 was never referenced
+        self.assertEqual(gc.sweep(), 1)
+        self.assertEqual(sorted(self.store.keys()), ["h1", "h2"])
+        # blocks only the old version refers to are released
+        self.meta.update("a.txt", 2, ["h2"])
+        self.assertEqual(gc.sweep(), 1)
+        self.assertEqual(self.store.keys(), ["h2"])
+        self.meta.update("a.txt", 3, [0])
+        self.assertEqual(gc.sweep(), 1)
+        self.assertEqual(len(self.store), 0)
+        self.assertEqual(gc.stats(), dict(gcreclaimedblocks=3, gcreclaimedbytes=24, gccandidates=0))
+
+    def test_2_grace(self):
+        self.meta.update("a.txt", 1, ["h1"])
+        self.meta.update("b.txt", 1, ["h1"])
+        gc = self.collector(0.2)
+        self.assertEqual(gc.sweep(), 0)
+        time.sleep(0.1)
+        # a client uploading h2 has the grace period to commit it
+        gc.touch("h2")
+        self.meta.update("a.txt", 2, [0])
+        time.sleep(0.15)
+        self.assertEqual(gc.sweep(), 1)
+        self.assertEqual(sorted(self.store.keys()), ["h1", "h2"])
+        self.meta.update("c.txt", 1, ["h2"])
+        time.sleep(0.2)
+        # h1 is still held by b.txt, h2 is now committed
+        self.assertEqual(gc.sweep(), 0)
+        self.assertEqual(sorted(self.store.keys()), ["h1", "h2"])
+
+    def test_3_checkBlocks(self):
+        gc = self.collector(0)
+        self.assertEqual(gc.sweep(), 3)
+        self.store.put("h1", b'block h1')
+        # holding a block before it is checked keeps the sweep away from it
+        gc.hold(["h1"])
+        gc.grace = 60
+        self.assertEqual(gc.sweep(), 0)
+        gc.checkBlocks(["h1"])
+        with self.assertRaises(xmlrpc.client.Fault) as cm:
+            gc.checkBlocks(["h1", "h2"])
+        self.assertEqual((cm.exception.faultCode, cm.exception.faultString), (collector.MISSING_BLOCKS, "h2"))
+
+    def test_4_cachedDelete(self):
+        # a read racing with a delete does not put the block back in the cache
+        store = CachedBlockStore(MemoryBlockStore(), 1024)
+        store.backend.put("h1", b'block h1')
+        deletes = store.deletes  # as get() notes it before reading the backend
+        store.delete("h1")
+        store.admit("h1", b'block h1', deletes)
+        self.assertFalse(store.has("h1"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import unittest
+import hashlib
+import shutil
+
+import indexfile
+
+def digests(*names):
+    return [hashlib.sha256(name.encode()).hexdigest() for name in names]
+
+class TestIndexFile(unittest.TestCase):
+    def setUp(self):
+        self.basedir = './test_index/'
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.mkdir(self.basedir)
+        self.path = self.basedir + 'index.txt'
+        self.entries = {"a.txt": [1, digests("a1", "a2")], "b.txt": [3, [0]], "c.txt": [2, []]}
+        self.stats = {"a.txt": (8192, 1600000000123456789, 42, 'fixed-4096')}
+        self.cursor = {'epoch': hashlib.md5(b'epoch').hexdigest(), 'seq': 7, 'token': 9}
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def test_1_roundtrip(self):
+        indexfile.IndexFile(self.path).save(self.entries, self.stats, self.cursor)
+        self.assertTrue(indexfile.isBinary(self.path))
+        for useMmap in (True, False):
+            stats, cursor = {}, {}
+            self.assertEqual(indexfile.IndexFile(self.path, useMmap).load(stats, cursor), self.entries)
+            self.assertEqual(stats, self.stats)
+            self.assertEqual(cursor, self.cursor)
+            self.assertEqual(indexfile.IndexFile(self.path, useMmap).lookup("a.txt"), self.entries["a.txt"])
+        # raw digests: about half the size of the hex text
+        self.assertLess(os.path.getsize(self.path), 64 * 2 + 200)
+
+    def test_2_incremental(self):
+        index = indexfile.IndexFile(self.path)
+        index.save(self.entries, self.stats, self.cursor)
+        size = os.path.getsize(self.path)
+        index = indexfile.IndexFile(self.path)
+        entries = index.load()
+        entries["a.txt"] = [2, digests("a3")]
+        del entries["c.txt"]
+        self.cursor['seq'] = 8
+        index.save(entries, self.stats, self.cursor)
+        # only the new record of a.txt and the removal of c.txt are appended
+        grown = os.path.getsize(self.path) - size
+        self.assertEqual(grown, indexfile.RECORD.size * 2 + len("a.txt") + len("c.txt") + 32 + len("8192:1600000000123456789:42:fixed-4096"))
+        cursor = {}
+        self.assertEqual(indexfile.IndexFile(self.path).load(cursor=cursor), entries)
+        self.assertEqual(cursor['seq'], 8)
+        self.assertIsNone(indexfile.IndexFile(self.path).lookup("c.txt"))
+        # nothing changed: nothing appended
+        size = os.path.getsize(self.path)
+        index.save(entries, self.stats, self.cursor)
+        self.assertEqual(os.path.getsize(self.path), size)
+
+    def test_3_tornRecord(self):
+        index = indexfile.IndexFile(self.path)
+        index.save(self.entries, self.stats, self.cursor)
+        with open(self.path, 'ab') as f:
+            f.write(indexfile.packRecord("d.txt", 1, digests("d1"))[:-5])
+        index = indexfile.IndexFile(self.path)
+        self.assertEqual(index.load(), self.entries)
+        # the torn record is overwritten by the next save
+        entries = dict(self.entries, **{"e.txt": [1, digests("e1")]})
+        index.save(entries, self.stats, self.cursor)
+        self.assertEqual(indexfile.IndexFile(self.path).load(), entries)
+
+    def test_4_compaction(self):
+        index = indexfile.IndexFile(self.path)
+        entries = {"f{}.txt".format(i): [1, digests(str(i))] for i in range(10)}
+        index.save(entries)
+        size = os.path.getsize(self.path)
+        for version in range(2, 20):
+            entries = {fname: [version, digests(str(version))] for fname in entries}
+            index.save(entries)
+            # replaced records never take up more than about half of the file
+            self.assertLess(os.path.getsize(self.path), 2 * size + 4096 + 1)
+        self.assertEqual(indexfile.IndexFile(self.path).load(), entries)
+
+
+if __name__ == '__main__':
+    unittest.main()
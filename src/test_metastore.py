@@ -0,0 +1,204 @@
+import os
+import unittest
+import shutil
+import sys
+import threading
+
+from metastore import MetaStore
+
+class TestMetaStore(unittest.TestCase):
+    def setUp(self):
+        self.metadir = './test_meta/'
+        if os.path.exists(self.metadir):
+            shutil.rmtree(self.metadir)
+
+    def tearDown(self):
+        if os.path.exists(self.metadir):
+            shutil.rmtree(self.metadir)
+
+    def test_1_update(self):
+        meta = MetaStore()
+        self.assertTrue(meta.update("test.txt", 1, ["h1"]))
+        self.assertFalse(meta.update("test.txt", 1, ["h2"]))
+        self.assertFalse(meta.update("test.txt", 3, ["h2"]))
+        self.assertTrue(meta.update("test.txt", 2, [0]))
+        self.assertEqual(meta.getmap(), {"test.txt": [2, [0]]})
+
+    def test_1_updateMany(self):
+        meta = MetaStore(self.metadir)
+        meta.update("a.txt", 1, ["h1"])
+        results = meta.updateMany([("a.txt", 1, ["h2"]), ("b.txt", 1, ["h3"]), ("b.txt", 2, ["h4"]), ("c.txt", 2, ["h5"])])
+        self.assertEqual(results, [False, True, True, False])
+        self.assertEqual(meta.updateMany([("a.txt", 3, ["h6"])]), [False])
+        meta.close()
+        self.assertEqual(MetaStore(self.metadir).getmap(), {"a.txt": [1, ["h1"]], "b.txt": [2, ["h4"]]})
+
+    def test_2_recover(self):
+        meta = MetaStore(self.metadir)
+        meta.update("a.txt", 1, ["h1"])
+        meta.update("a.txt", 2, ["h2"])
+        meta.update("b.txt", 1, ["h3"])
+        meta.close()
+        # a record torn by a crash is ignored
+        with open(os.path.join(self.metadir, 'wal.{}.log'.format(meta.segment)), 'a') as f:
+            f.write('["b.txt", 2, ["h')
+        meta = MetaStore(self.metadir)
+        self.assertEqual(meta.getmap(), {"a.txt": [2, ["h2"]], "b.txt": [1, ["h3"]]})
+        self.assertTrue(meta.update("b.txt", 2, ["h4"]))
+        meta.close()
+        self.assertEqual(MetaStore(self.metadir).getmap(), {"a.txt": [2, ["h2"]], "b.txt": [2, ["h4"]]})
+
+    def test_3_snapshot(self):
+        meta = MetaStore(self.metadir, snapshotEvery=10)
+        for version in range(1, 26):
+            meta.update("a.txt", version, ["h{}".format(version)])
+        meta.close()
+        self.assertTrue(os.path.exists(os.path.join(self.metadir, 'snapshot.json')))
+        # segments covered by the snapshot are gone
+        self.assertEqual(len(meta.segments()), 1)
+        self.assertEqual(MetaStore(self.metadir).getmap(), {"a.txt": [25, ["h25"]]})
+
+    def test_4_changes(self):
+        meta = MetaStore(self.metadir)
+        meta.update("a.txt", 1, ["h1"])
+        meta.update("b.txt", 1, ["h2"])
+        epoch, seq, changes = meta.changes(0)
+        self.assertEqual((seq, changes), (2, {"a.txt": [1, ["h1"]], "b.txt": [1, ["h2"]]}))
+        meta.update("a.txt", 2, ["h3"])
+        self.assertEqual(meta.changes(seq)[1:], (3, {"a.txt": [2, ["h3"]]}))
+        self.assertEqual(meta.changes(3)[1:], (3, {}))
+        meta.close()
+        # the sequence and epoch survive a restart
+        meta = MetaStore(self.metadir)
+        self.assertEqual(meta.changes(2), (epoch, 3, {"a.txt": [2, ["h3"]]}))
+        self.assertNotEqual(MetaStore().epoch, epoch)
+
+    def test_4_durableChanges(self):
+        meta = MetaStore(self.metadir)
+        meta.update("a.txt", 1, ["h1"])
+        # hold up the next fsync, as if another thread's flush were running
+        with meta.cond:
+            meta.flushing = True
+        writer = threading.Thread(target=meta.update, args=("b.txt", 1, ["h2"]))
+        writer.start()
+        with meta.cond:
+            meta.cond.wait_for(lambda: meta.seq == 2, 5)
+        # the update is applied but not on disk: readers do not see it yet
+        self.assertEqual(meta.changes(0)[1:], (1, {"a.txt": [1, ["h1"]]}))
+        self.assertEqual(meta.getmap(), {"a.txt": [1, ["h1"]]})
+        with meta.cond:
+            meta.flushing = False
+            meta.cond.notify_all()
+        self.assertEqual(meta.changes(1, wait=5)[1:], (2, {"b.txt": [1, ["h2"]]}))
+        writer.join()
+        meta.close()
+        # the sequence is not reused after a restart
+        self.assertEqual(MetaStore(self.metadir).changes(0)[1], 2)
+
+    def test_4_pendingEntry(self):
+        meta = MetaStore(self.metadir)
+        meta.update("a.txt", 1, ["h1"])
+        with meta.cond:
+            meta.flushing = True
+        writer = threading.Thread(target=meta.update, args=("a.txt", 2, ["h2"]))
+        writer.start()
+        with meta.cond:
+            meta.cond.wait_for(lambda: meta.seq == 2, 5)
+        # while version 2 is synced, readers get version 1, and a competing update loses to it
+        self.assertEqual(meta.getmap(), {"a.txt": [1, ["h1"]]})
+        self.assertEqual(meta.changes(0)[1:], (1, {"a.txt": [1, ["h1"]]}))
+        self.assertEqual(meta.changes(1)[1:], (1, {}))
+        self.assertFalse(meta.updateMany([("a.txt", 2, ["h3"])])[0])
+        with meta.cond:
+            meta.flushing = False
+            meta.cond.notify_all()
+        writer.join()
+        self.assertEqual(meta.getmap(), {"a.txt": [2, ["h2"]]})
+        self.assertEqual(meta.changes(1)[1:], (2, {"a.txt": [2, ["h2"]]}))
+        self.assertEqual(meta.pending, {})
+        # full-map reads do not wait for the lock writers number their changes under
+        reads = []
+        with meta.cond:
+            reader = threading.Thread(target=lambda: reads.append(meta.getmap()))
+            reader.start()
+            reader.join(5)
+        self.assertEqual(reads, [{"a.txt": [2, ["h2"]]}])
+        meta.close()
+
+    def test_4_mirror(self):
+        primary, replica = MetaStore(), MetaStore()
+        primary.update("a.txt", 1, ["h1"])
+        replica.mirror(*primary.changes(0))
+        self.assertEqual((replica.epoch, replica.seq), (primary.epoch, 1))
+        # a change wakes a waiting reader
+        threading.Timer(0.1, primary.update, ("b.txt", 1, ["h2"])).start()
+        replica.mirror(*primary.changes(1, wait=5))
+        self.assertEqual(replica.getmap(), primary.getmap())
+        self.assertEqual(replica.changes(1)[1:], (2, {"b.txt": [1, ["h2"]]}))
+        # following a store of another epoch starts over
+        other = MetaStore()
+        other.update("c.txt", 1, ["h3"])
+        replica.mirror(*other.changes(0))
+        self.assertEqual(replica.getmap(), {"c.txt": [1, ["h3"]]})
+
+    def test_4_refs(self):
+        meta = MetaStore(self.metadir)
+        released = []
+        meta.onRelease = released.append
+        meta.updateMany([("a.txt", 1, ["h1", "h2"]), ("b.txt", 1, ["h2"])])
+        meta.update("a.txt", 2, ["h2", "h3"])
+        meta.update("b.txt", 2, [0])
+        self.assertEqual(released, ["h1"])
+        self.assertEqual(dict(meta.refs), {"h2": 1, "h3": 1})
+        meta.close()
+        # the counts are rebuilt on recovery
+        self.assertEqual(dict(MetaStore(self.metadir).refs), {"h2": 1, "h3": 1})
+
+    def test_5_concurrent(self):
+        meta = MetaStore(self.metadir, snapshotEvery=50)
+        def work(i):
+            for version in range(1, 21):
+                self.assertTrue(meta.update("f{}".format(i), version, [str(version)]))
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        meta.close()
+        expected = {"f{}".format(i): [20, ["20"]] for i in range(8)}
+        self.assertEqual(MetaStore(self.metadir).getmap(), expected)
+
+    def test_6_stress(self):
+        # Many threads racing read-check-write on a few files: every accepted update
+        # must be counted in the final version, none may be lost or accepted twice
+        meta = MetaStore(self.metadir, snapshotEvery=500)
+        fnames = ["f{}".format(i) for i in range(4)]
+        accepted = {fname: 0 for fname in fnames}
+        countLock = threading.Lock()
+        def work(i):
+            for n in range(300):
+                fname = fnames[(i + n) % len(fnames)]
+                version = (meta.get(fname) or [0, []])[0] + 1
+                if meta.update(fname, version, [str(i)]):
+                    with countLock:
+                        accepted[fname] += 1
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=work, args=(i,)) for i in range(16)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            sys.setswitchinterval(interval)
+        meta.close()
+        versions = {fname: finfo[0] for fname, finfo in meta.getmap().items()}
+        self.assertEqual(versions, accepted)
+        self.assertEqual(meta.changes(0)[1], sum(accepted.values()))
+        recovered = {fname: finfo[0] for fname, finfo in MetaStore(self.metadir).getmap().items()}
+        self.assertEqual(recovered, accepted)
+
+
+if __name__ == '__main__':
+    unittest.main()
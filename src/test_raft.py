@@ -0,0 +1,65 @@
+import os
+import unittest
+import shutil
+import time
+
+from metastore import MetaStore
+from raft import RaftNode
+
+class TestRaftNode(unittest.TestCase):
+    def setUp(self):
+        self.raftdir = './test_raft/'
+        if os.path.exists(self.raftdir):
+            shutil.rmtree(self.raftdir)
+
+    def tearDown(self):
+        if os.path.exists(self.raftdir):
+            shutil.rmtree(self.raftdir)
+
+    def start(self, snapshotEvery):
+        # a single node elects itself, then serves reads once the entry starting its term is applied
+        node = RaftNode('http://localhost:1', [], MetaStore(), self.raftdir, snapshotEvery)
+        for _ in range(50):
+            if node.isLeader() and node.lastApplied >= node.leaderStart:
+                return node
+            time.sleep(0.05)
+        self.fail('no leader elected')
+
+    def test_1_restart(self):
+        node = self.start(snapshotEvery=1000)
+        self.assertEqual(node.submit([["a.txt", 1, ["h1"]], ["b.txt", 1, ["h2"]]]), [True, True])
+        self.assertEqual(node.submit([["a.txt", 1, ["h3"]]]), [False])
+        epoch, seq, _ = node.meta.changes(0)
+        term = node.term
+        node.crash()
+        # the term, vote and entries are on disk before they are counted on
+        node = self.start(snapshotEvery=1000)
+        self.assertGreater(node.term, term)
+        node.checkRead()
+        self.assertEqual(node.meta.getmap(), {"a.txt": [1, ["h1"]], "b.txt": [1, ["h2"]]})
+        # the change sequence goes on in the same epoch
+        self.assertEqual(node.meta.changes(0)[:2], (epoch, seq))
+
+    def test_2_compaction(self):
+        node = self.start(snapshotEvery=5)
+        for version in range(1, 21):
+            self.assertEqual(node.submit([["a.txt", version, ["h{}".format(version)]]]), [True])
+        for _ in range(50):
+            if node.logStart >= 15 and len(node.segments()) == 1:
+                break
+            time.sleep(0.05)
+        # applied entries are dropped from the log once they are in a snapshot
+        self.assertGreaterEqual(node.logStart, 15)
+        self.assertLess(len(node.log), 10)
+        self.assertEqual(len(node.segments()), 1)
+        epoch, seq, _ = node.meta.changes(0)
+        node.crash()
+        node = self.start(snapshotEvery=5)
+        self.assertEqual(node.meta.getmap(), {"a.txt": [20, ["h20"]]})
+        self.assertEqual(node.meta.changes(0)[:2], (epoch, seq))
+        self.assertTrue(node.meta.referenced("h20"))
+        self.assertFalse(node.meta.referenced("h19"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import collections
+import hashlib
+import unittest
+
+from ring import HashRing
+
+class TestRing(unittest.TestCase):
+    def setUp(self):
+        self.hashes = [hashlib.sha256(str(i).encode()).hexdigest() for i in range(10000)]
+        self.nodes = ['http://localhost:{}'.format(port) for port in range(8091, 8095)]
+
+    def test_0_balance(self):
+        ring = HashRing(self.nodes, vnodes=64)
+        counts = collections.Counter(ring.lookup(h)[0] for h in self.hashes)
+        self.assertEqual(set(counts), set(self.nodes))
+        self.assertLess(max(counts.values()), 1.3 * len(self.hashes) / len(self.nodes))
+
+    def test_1_replicas(self):
+        ring = HashRing(self.nodes, replicas=3)
+        for h in self.hashes[:100]:
+            owners = ring.lookup(h)
+            self.assertEqual(len(set(owners)), 3)
+        # no more replicas than servers
+        self.assertEqual(len(HashRing(self.nodes[:2], replicas=3).lookup(self.hashes[0])), 2)
+
+    def test_2_minimal_movement(self):
+        before = HashRing(self.nodes)
+        after = HashRing(self.nodes + ['http://localhost:8095'])
+        moved = [h for h in self.hashes if before.lookup(h) != after.lookup(h)]
+        # only blocks taken over by the new server move
+        self.assertTrue(all(after.lookup(h) == ['http://localhost:8095'] for h in moved))
+        self.assertLess(len(moved), 0.3 * len(self.hashes))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,23 +1,35 @@
+import os
 import unittest
 import hashlib
+import http.client
+import shutil
+import socket
+import tempfile
 import xmlrpc.client
 import subprocess
+import threading
 import time
+import zlib
 
+import client
+import codec
+import wire
 import server
 
 SLEEPTIME = 1
 
 class TestServer(unittest.TestCase):
+    bashCommand = "python server.py"
+    url = 'http://localhost:8080'
+
     def setUp(self):
         # setup server on subprocess
-        bashCommand = "python server.py"
-        self.server = subprocess.Popen(bashCommand.split())
+        self.server = subprocess.Popen(self.bashCommand.split())
         # wait to set up remote server
         time.sleep(SLEEPTIME)
         # setup client
         try:
-            self.client  = xmlrpc.client.ServerProxy('http://localhost:8080')
+            self.client  = xmlrpc.client.ServerProxy(self.url)
         except Exception as e:
             print("Client: " + str(e))
 
@@ -33,6 +45,8 @@ class TestServer(unittest.TestCase):
 
     def test_0_ping(self):
         self.assertTrue(self.client.surfstore.ping())
+        # a server without Raft is never crashed
+        self.assertFalse(self.client.surfstore.iscrashed())
 
     def test_1_putblock(self):
         status = self.client.surfstore.putblock(self.data1)
@@ -57,11 +71,372 @@ class TestServer(unittest.TestCase):
         status = self.client.surfstore.updatefile("test.txt", 5, [self.h2, self.h1])
         self.assertFalse(status)
 
+    def test_4_updatefiles(self):
+        self.client.surfstore.updatefile("a.txt", 1, [self.h1])
+        results = self.client.surfstore.updatefiles([["a.txt", 1, [self.h2]], ["b.txt", 1, [self.h2]], ["a.txt", 2, [0]]])
+        self.assertEqual(results, [False, True, True])
+        infomap = self.client.surfstore.getfileinfomap()
+        self.assertEqual(infomap, {"a.txt": [2, [0]], "b.txt": [1, [self.h2]]})
+
     def test_5_getfileinfomap(self):
         status = self.client.surfstore.updatefile("test.txt", 1, [self.h1, self.h2])
         infomap = self.client.surfstore.getfileinfomap()
         self.assertEqual(infomap, {"test.txt":[1, [self.h1, self.h2]]})
 
+    def test_5_getchanges(self):
+        self.client.surfstore.updatefile("a.txt", 1, [self.h1])
+        reply = self.client.surfstore.getchanges(0)
+        self.assertEqual(reply['changes'], {"a.txt": [1, [self.h1]]})
+        self.client.surfstore.updatefile("b.txt", 1, [self.h2])
+        newReply = self.client.surfstore.getchanges(reply['seq'])
+        self.assertEqual(newReply['epoch'], reply['epoch'])
+        self.assertEqual(newReply['changes'], {"b.txt": [1, [self.h2]]})
+
+    def test_6_putblocks(self):
+        status = self.client.surfstore.putblocks([self.data1, self.data2])
+        self.assertTrue(status)
+        out_list = self.client.surfstore.hasblocks([self.h1, self.h2])
+        self.assertEqual(out_list, [self.h1, self.h2])
+
+    def test_7_getblocks(self):
+        self.client.surfstore.putblocks([self.data1, self.data2])
+        blocks = self.client.surfstore.getblocks([self.h2, self.h1, self.h2])
+        self.assertEqual([b.data for b in blocks], [self.data2, self.data1, self.data2])
+
+    def test_8_keepalive(self):
+        for _ in range(3):
+            self.client.surfstore.ping()
+        stats = self.client.surfstore.getstats()
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['requests'], 4)
+
+    def test_9_concurrent_updatefile(self):
+        accepted = []
+        def work():
+            proxy = xmlrpc.client.ServerProxy(self.url)
+            for _ in range(25):
+                version = proxy.surfstore.getfileinfomap().get("test.txt", [0, []])[0] + 1
+                if proxy.surfstore.updatefile("test.txt", version, [self.h1]):
+                    accepted.append(version)
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # each version was handed out exactly once
+        infomap = self.client.surfstore.getfileinfomap()
+        self.assertEqual(sorted(accepted), list(range(1, infomap["test.txt"][0] + 1)))
+
+    def test_9_binaryProtocol(self):
+        proxy = client.connect(self.url)
+        self.assertTrue(proxy.surfstore.putblocks([self.data1, b'']))
+        h0 = hashlib.sha256(b'').hexdigest()
+        self.assertEqual(proxy.surfstore.hasblocks([self.h2, self.h1, h0]), [self.h1, h0])
+        blocks = proxy.surfstore.getblocks([self.h1, h0, self.h1])
+        self.assertEqual([b.data for b in blocks], [self.data1, b'', self.data1])
+        # blocks sent as frames are the ones XML-RPC sees
+        self.assertEqual(self.client.surfstore.getblock(self.h1).data, self.data1)
+        with self.assertRaises(xmlrpc.client.ProtocolError) as cm:
+            proxy.surfstore.getblocks([self.h2])
+        self.assertEqual(cm.exception.errcode, 404)
+        # the connection is usable again after the error, and carries both encodings
+        self.assertTrue(proxy.surfstore.ping())
+        self.assertEqual(proxy.surfstore.hasblocks([self.h1]), [self.h1])
+
+    def test_9_compressedBlocks(self):
+        text = b'a line of text that compresses well\n' * 100
+        h = hashlib.sha256(text).hexdigest()
+        proxy = client.connect(self.url)
+        proxy.surfstore.putblocks([text])
+        # still named and deduplicated by the plain bytes, and plain over XML-RPC
+        self.assertEqual(self.client.surfstore.hasblocks([h]), [h])
+        self.assertEqual(self.client.surfstore.getblock(h).data, text)
+        self.assertEqual(proxy.surfstore.getblocks([h])[0].data, text)
+        stats = self.client.surfstore.getstats()
+        self.assertEqual(stats['plainbytes'], len(text))
+        self.assertLess(stats['storedbytes'], len(text) // 10)
+        # a block that would decompress past the size limit is refused
+        bomb = b'\x01' + zlib.compress(bytes(codec.MAX_SIZE + 1), 9)
+        conn = http.client.HTTPConnection('localhost', int(self.url.rsplit(':', 1)[1]))
+        conn.request('POST', wire.PATH, wire.PUT + wire.packBlocks([bomb]), {'Content-Type': wire.CONTENT_TYPE})
+        self.assertEqual(conn.getresponse().status, 400)
+        conn.close()
+        # a raw block larger than the limit is stored, in both protocols
+        big = os.urandom(codec.MAX_SIZE + 1024)
+        proxy.surfstore.putblocks([big])
+        self.assertEqual(proxy.surfstore.getblocks([hashlib.sha256(big).hexdigest()])[0].data, big)
+        big = big[1:]
+        self.assertTrue(self.client.surfstore.putblock(xmlrpc.client.Binary(big)))
+        self.assertEqual(self.client.surfstore.getblock(hashlib.sha256(big).hexdigest()).data, big)
+
+
+class TestAsyncServer(TestServer):
+    # same operations and semantics on the asyncio engine
+    bashCommand = "python server.py --asyncio --port 8082"
+    url = 'http://localhost:8082'
+
+
+class TestCachedServer(unittest.TestCase):
+    def setUp(self):
+        self.blockdir = tempfile.mkdtemp()
+        bashCommand = "python server.py --port 8083 --blockstore disk --fsync never --blockdir " + self.blockdir
+        self.server = subprocess.Popen(bashCommand.split())
+        time.sleep(SLEEPTIME)
+        self.client = xmlrpc.client.ServerProxy('http://localhost:8083')
+
+    def tearDown(self):
+        self.server.terminate()
+        self.server.wait()
+        shutil.rmtree(self.blockdir)
+
+    def test_0_cachestats(self):
+        data = b'a popular block\n'
+        h = hashlib.sha256(data).hexdigest()
+        self.client.surfstore.putblocks([data])
+        for _ in range(3):
+            self.assertEqual(self.client.surfstore.getblock(h).data, data)
+        stats = self.client.surfstore.getstats()
+        self.assertEqual(stats['cachehits'], 3)
+        self.assertEqual(stats['cachemisses'], 0)
+        self.assertEqual(stats['cachebytes'], len(data) + 1)
+
+
+class TestCollectedServer(unittest.TestCase):
+    def setUp(self):
+        self.server = subprocess.Popen("python server.py --port 8084 --gc --gcgrace 0.2".split())
+        time.sleep(SLEEPTIME)
+        self.client = xmlrpc.client.ServerProxy('http://localhost:8084')
+
+    def tearDown(self):
+        self.server.terminate()
+        self.server.wait()
+
+    def test_0_gc(self):
+        blocks = [b'old block\n' * 10, b'new block\n' * 10]
+        h1, h2 = (hashlib.sha256(b).hexdigest() for b in blocks)
+        self.client.surfstore.putblocks(blocks)
+        self.client.surfstore.updatefile("a.txt", 1, [h1, h2])
+        self.client.surfstore.updatefile("a.txt", 2, [h2])
+        time.sleep(1.5)
+        # only the block of the current version is left
+        self.assertEqual(self.client.surfstore.hasblocks([h1, h2]), [h2])
+        stats = self.client.surfstore.getstats()
+        self.assertEqual(stats['gcreclaimedblocks'], 1)
+        self.assertGreater(stats['gcreclaimedbytes'], 0)
+
+
+class TestShardedServer(unittest.TestCase):
+    def setUp(self):
+        # a metadata server and three block servers, each block kept on two of them
+        self.shardUrls = ['http://localhost:{}'.format(port) for port in (8091, 8092, 8093)]
+        self.shards = [subprocess.Popen("python server.py --port {}".format(url[-4:]).split()) for url in self.shardUrls]
+        bashCommand = "python server.py --port 8090 --replicas 2 --blockservers " + " ".join(self.shardUrls)
+        self.server = subprocess.Popen(bashCommand.split())
+        time.sleep(SLEEPTIME)
+        self.url = 'http://localhost:8090'
+
+    def tearDown(self):
+        for proc in self.shards + [self.server]:
+            proc.terminate()
+            proc.wait()
+        client.blockRings.clear()
+
+    def test_0_sharded(self):
+        blocks = [str(i).encode() * 100 for i in range(30)]
+        hashes = [hashlib.sha256(b).hexdigest() for b in blocks]
+        proxy = client.connect(self.url)
+        self.assertEqual(proxy.surfstore.hasblocks(hashes), [])
+        self.assertTrue(proxy.surfstore.putblocks(blocks))
+        self.assertEqual(proxy.surfstore.hasblocks(hashes), hashes)
+        # every block is on two block servers and none on the metadata server
+        stored = [len(xmlrpc.client.ServerProxy(url).surfstore.hasblocks(hashes)) for url in self.shardUrls]
+        self.assertEqual(sum(stored), 2 * len(blocks))
+        self.assertTrue(all(stored))
+        self.assertEqual(xmlrpc.client.ServerProxy(self.url).surfstore.hasblocks(hashes), [])
+        # blocks are still read with one block server down
+        self.shards[0].terminate()
+        self.shards[0].wait()
+        fresh = client.connect(self.url)
+        self.assertEqual([b.data for b in fresh.surfstore.getblocks(hashes)], blocks)
+
+
+class TestRaftServer(unittest.TestCase):
+    def setUp(self):
+        # a block server and three replicated metadata servers
+        self.urls = ['http://localhost:{}'.format(port) for port in (8101, 8102, 8103)]
+        self.metadir = tempfile.mkdtemp()
+        self.procs = [subprocess.Popen("python server.py --port 8100".split())]
+        self.procs += [self.startNode(url) for url in self.urls]
+        time.sleep(SLEEPTIME)
+        self.nodes = {url: xmlrpc.client.ServerProxy(url) for url in self.urls}
+
+    def startNode(self, url):
+        peers = [peer for peer in self.urls if peer != url]
+        bashCommand = "python server.py --port {} --blockservers http://localhost:8100 --metadir {}/{} --snapshotevery 5 --peers {}".format(
+            url[-4:], self.metadir, url[-4:], " ".join(peers))
+        return subprocess.Popen(bashCommand.split())
+
+    def tearDown(self):
+        for proc in self.procs:
+            proc.terminate()
+            proc.wait()
+        shutil.rmtree(self.metadir)
+        client.blockRings.clear()
+
+    def leader(self, exclude=()):
+        """Wait for a single leader among the running nodes"""
+        for _ in range(50):
+            leaders = [url for url, node in self.nodes.items() if url not in exclude and node.surfstore.isleader()]
+            if len(leaders) == 1:
+                return leaders[0]
+            time.sleep(0.1)
+        self.fail('no leader elected')
+
+    def test_0_replicate(self):
+        leader = self.leader()
+        self.assertTrue(self.nodes[leader].surfstore.updatefile("a.txt", 1, ["h1"]))
+        self.assertFalse(self.nodes[leader].surfstore.updatefile("a.txt", 1, ["h2"]))
+        # followers send clients to the leader
+        follower = next(url for url in self.urls if url != leader)
+        with self.assertRaises(xmlrpc.client.Fault) as cm:
+            self.nodes[follower].surfstore.getfileinfomap()
+        self.assertEqual(cm.exception.faultString, leader)
+        self.assertEqual(client.connect(follower).surfstore.updatefiles([["b.txt", 1, ["h3"]]]), [True])
+
+        # the leader fails: another node takes over with every committed update
+        self.nodes[leader].surfstore.crash()
+        self.assertTrue(self.nodes[leader].surfstore.iscrashed())
+        self.assertFalse(self.nodes[leader].surfstore.isleader())
+        with self.assertRaises(xmlrpc.client.Fault):
+            self.nodes[leader].surfstore.getfileinfomap()
+        with self.assertRaises(xmlrpc.client.Fault):
+            self.nodes[leader].surfstore.ping()
+        with self.assertRaises(xmlrpc.client.Fault):
+            self.nodes[leader].surfstore.hasblocks([])
+        conn = http.client.HTTPConnection('localhost', int(leader[-4:]))
+        conn.request('POST', wire.PATH, wire.HAS, {'Content-Type': wire.CONTENT_TYPE})
+        self.assertEqual(conn.getresponse().status, 503)
+        conn.close()
+        second = self.leader(exclude=[leader])
+        self.assertEqual(client.connect(second).surfstore.getfileinfomap(), {"a.txt": [1, ["h1"]], "b.txt": [1, ["h3"]]})
+        self.assertTrue(client.connect(second).surfstore.updatefile("a.txt", 2, ["h4"]))
+
+        # the old leader catches up once restored: it can win the next election
+        self.nodes[leader].surfstore.restore()
+        self.assertFalse(self.nodes[leader].surfstore.iscrashed())
+        time.sleep(0.5)
+        self.nodes[second].surfstore.crash()
+        third = self.leader(exclude=[second])
+        self.assertEqual(client.connect(third).surfstore.getfileinfomap(), {"a.txt": [2, ["h4"]], "b.txt": [1, ["h3"]]})
+
+    def test_1_restart(self):
+        leader = self.leader()
+        follower = next(url for url in self.urls if url != leader)
+        self.nodes[follower].surfstore.crash()
+        # more updates than a snapshot covers: the follower is sent the snapshot when restored
+        for version in range(1, 13):
+            self.assertTrue(self.nodes[leader].surfstore.updatefile("a.txt", version, ["h{}".format(version)]))
+        self.nodes[follower].surfstore.restore()
+        time.sleep(0.5)
+        # with the third node down, an update needs the follower, which now holds the snapshot
+        other = next(url for url in self.urls if url not in (leader, follower))
+        self.nodes[other].surfstore.crash()
+        self.assertTrue(self.nodes[leader].surfstore.updatefile("a.txt", 13, ["h13"]))
+        cursor = client.connect(leader).surfstore.getseq()
+
+        # every node is restarted: the cluster keeps the updates and the change sequence
+        for proc in self.procs[1:]:
+            proc.terminate()
+            proc.wait()
+        self.procs[1:] = [self.startNode(url) for url in self.urls]
+        time.sleep(SLEEPTIME)
+        self.nodes[leader].surfstore.crash()
+        second = self.leader(exclude=[leader])
+        for _ in range(50):
+            try:
+                self.assertEqual(client.connect(second).surfstore.getfileinfomap(), {"a.txt": [13, ["h13"]]})
+                break
+            except xmlrpc.client.Fault:
+                time.sleep(0.1)
+        self.assertEqual(client.connect(second).surfstore.getseq(), cursor)
+
+
+class TestReplicaServer(unittest.TestCase):
+    def setUp(self):
+        # a primary and a read replica following it
+        self.primaryUrl, self.replicaUrl = 'http://localhost:8110', 'http://localhost:8111'
+        self.primary = subprocess.Popen("python server.py --port 8110".split())
+        bashCommand = "python server.py --port 8111 --maxstaleness 0.5 --follow " + self.primaryUrl
+        self.replica = subprocess.Popen(bashCommand.split())
+        time.sleep(SLEEPTIME)
+
+    def tearDown(self):
+        for proc in (self.primary, self.replica):
+            proc.terminate()
+            proc.wait()
+        client.blockRings.clear()
+
+    def test_0_readReplica(self):
+        replica = xmlrpc.client.ServerProxy(self.replicaUrl)
+        self.assertFalse(replica.surfstore.isleader())
+        # writes are sent to the primary
+        with self.assertRaises(xmlrpc.client.Fault) as cm:
+            replica.surfstore.updatefile("a.txt", 1, ["h1"])
+        self.assertEqual(cm.exception.faultString, self.primaryUrl)
+        proxy = client.connect(self.replicaUrl)
+        self.assertEqual(proxy.surfstore.updatefiles([["a.txt", 1, ["h1"]]]), [True])
+        # the writer reads its write from the replica
+        self.assertEqual(proxy.token[1], 1)
+        self.assertEqual(proxy.surfstore.getfileinfomap(), {"a.txt": [1, ["h1"]]})
+        self.assertEqual(replica.surfstore.getfileinfomap(1), {"a.txt": [1, ["h1"]]})
+        changes = replica.surfstore.getchanges(0)
+        self.assertEqual(changes['epoch'], xmlrpc.client.ServerProxy(self.primaryUrl).surfstore.getchanges(0)['epoch'])
+        self.assertEqual(changes['changes'], {"a.txt": [1, ["h1"]]})
+        # blocks are kept by the primary
+        self.assertEqual(replica.surfstore.getblockservers()['servers'], [self.primaryUrl])
+
+        # without the primary the replica goes stale and refuses reads
+        self.primary.terminate()
+        self.primary.wait()
+        time.sleep(0.6)
+        with self.assertRaises(xmlrpc.client.Fault) as cm:
+            replica.surfstore.getfileinfomap()
+        self.assertEqual(cm.exception.faultString, self.primaryUrl)
+
+
+class TestPooledServer(unittest.TestCase):
+    def setUp(self):
+        # one worker, one connection may wait for it
+        bashCommand = "python server.py --port 8081 --workers 1 --queuesize 1"
+        self.server = subprocess.Popen(bashCommand.split())
+        time.sleep(SLEEPTIME)
+        self.url = 'http://localhost:8081'
+
+    def tearDown(self):
+        self.server.terminate()
+        self.server.wait()
+
+    def test_0_overload(self):
+        # a connection that has not sent its request holds the worker, a second one waits in the queue
+        busy = socket.create_connection(('localhost', 8081))
+        time.sleep(0.1)
+        waiting = socket.create_connection(('localhost', 8081))
+        time.sleep(0.1)
+        # a third one is turned away with a retriable error
+        with self.assertRaises(xmlrpc.client.ProtocolError) as cm:
+            xmlrpc.client.ServerProxy(self.url).surfstore.ping()
+        self.assertEqual(cm.exception.errcode, 503)
+
+        # the client transport backs off until the worker frees up
+        def release():
+            time.sleep(0.5)
+            busy.close()
+            waiting.close()
+        threading.Thread(target=release).start()
+        proxy = client.connect(self.url)
+        self.assertTrue(proxy.surfstore.ping())
+        self.assertGreaterEqual(proxy.surfstore.getstats()['rejected'], 2)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
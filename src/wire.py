@@ -0,0 +1,61 @@
+"""
+Binary framing for block transfers.
+
+XML-RPC carries every block as base64 inside XML, a third larger than the block and
+costly to encode and parse. Servers that list 'binary' in surfstore.protocols() also
+accept block calls as a single binary frame POSTed to PATH, and reply with one:
+
+    request:  op (1 byte) + payload
+    HAS       payload: 32-byte digests        reply: one byte per digest, 1 if the block is stored
+    GET       payload: 32-byte digests        reply: blocks, a prefix of the list under the byte budget
+    PUT       payload: blocks                 reply: empty
+
+where blocks are each a 4-byte big-endian length followed by the block encoded as in
+codec.py (a codec id byte, then the raw or compressed bytes); servers list the codecs
+they accept after 'binary'. A missing block is answered with HTTP 404 and a malformed
+frame with 400.
+"""
+import struct
+
+PATH = '/BLOCKS'
+CONTENT_TYPE = 'application/octet-stream'
+
+HAS = b'H'
+GET = b'G'
+PUT = b'P'
+
+DIGEST_SIZE = 32
+LENGTH = struct.Struct('>I')
+
+def packDigests(hashes):
+    """Raw digests of a list of hex hash values"""
+    return b''.join(bytes.fromhex(h) for h in hashes)
+
+def unpackDigests(buf):
+    """Hex hash values of a buffer of raw digests"""
+    if len(buf) % DIGEST_SIZE:
+        raise ValueError('truncated digest')
+    return [bytes(buf[i:i + DIGEST_SIZE]).hex() for i in range(0, len(buf), DIGEST_SIZE)]
+
+def packBlocks(blocks):
+    parts = []
+    for b in blocks:
+        parts.append(LENGTH.pack(len(b)))
+        parts.append(b)
+    return b''.join(parts)
+
+def unpackBlocks(buf):
+    """List of the blocks in a buffer of length-prefixed blocks, as memoryview slices of it"""
+    view = memoryview(buf)
+    blocks = []
+    off = 0
+    while off < len(view):
+        if off + LENGTH.size > len(view):
+            raise ValueError('truncated block length')
+        n, = LENGTH.unpack_from(view, off)
+        off += LENGTH.size
+        if off + n > len(view):
+            raise ValueError('truncated block')
+        blocks.append(view[off:off + n])
+        off += n
+    return blocks